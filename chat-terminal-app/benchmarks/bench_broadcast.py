@@ -0,0 +1,83 @@
+"""CPU cost of one chat broadcast, before/after encode-once frames.
+
+Run from the project root::
+
+    python -m benchmarks.bench_broadcast
+
+Both columns go through ``ConnectionManager`` and its per-connection writer
+tasks. "before" uses plain text connections, where every ``send_text``
+re-encodes the string for each recipient; "after" uses connections that
+negotiated binary frames and share one encoded buffer. The fake sockets
+frame the payload the way the ASGI server would, so encoding and framing
+costs are both counted. Only the broadcast loop is timed.
+"""
+from __future__ import annotations
+
+import asyncio
+import struct
+import time
+
+from server.websocket_handler import ConnectionManager
+from shared import protocol
+from shared.protocol import BINARY_SUBPROTOCOL
+
+RECIPIENTS = (10, 100, 1000)
+PAYLOADS = {"64 B": "x" * 56, "4 KiB": "é" * 2040}
+ROUNDS = 200
+
+
+class _FakeSocket:
+    def __init__(self, binary: bool) -> None:
+        self.scope = {"subprotocols": [BINARY_SUBPROTOCOL] if binary else []}
+        self.sent_bytes = 0
+
+    async def accept(self, subprotocol: str | None = None) -> None:
+        pass
+
+    async def send_text(self, text: str) -> None:
+        self._frame(0x1, text.encode("utf-8"))
+
+    async def send_bytes(self, data: bytes) -> None:
+        self._frame(0x2, data)
+
+    async def close(self, code: int = 1000) -> None:
+        pass
+
+    def _frame(self, opcode: int, payload: bytes) -> None:
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+        self.sent_bytes += len(header + payload)
+
+
+async def _broadcast_cpu(recipients: int, binary: bool, text: str) -> float:
+    manager = ConnectionManager(max_queue_messages=ROUNDS + 1, max_total_bytes=1 << 30)
+    sockets = [_FakeSocket(binary) for _ in range(recipients)]
+    for socket in sockets:
+        await manager.connect(socket)
+    start = time.process_time()
+    for _ in range(ROUNDS):
+        await manager.broadcast_event(protocol.chat("alice", text))
+        while manager.total_queued_bytes:
+            await asyncio.sleep(0)
+    elapsed = time.process_time() - start
+    for socket in sockets:
+        await manager.close(socket)
+    return elapsed / ROUNDS * 1e6
+
+
+def main() -> None:
+    print(f"{'payload':>8} {'recipients':>10} {'before (µs)':>12} {'after (µs)':>11} {'ratio':>6}")
+    for label, text in PAYLOADS.items():
+        for recipients in RECIPIENTS:
+            before = asyncio.run(_broadcast_cpu(recipients, False, text))
+            after = asyncio.run(_broadcast_cpu(recipients, True, text))
+            print(f"{label:>8} {recipients:>10} {before:>12.1f} {after:>11.1f} {before / after:>6.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""/files latency: in-memory catalog vs. listing the uploads directory.
+
+Run from the project root::
+
+    python -m benchmarks.bench_files_listing [files]
+
+Creates ``files`` small files (default 100,000) in a scratch directory
+and the same names in an upload index, then times one page of 100 names
+the way ``/files`` used to build it (``iterdir`` + ``is_file`` + sort on
+every call) against ``FileCatalog.query`` (by name, by name prefix, by
+size with a size filter) and ``changed_since`` after one upload. The
+catalog's initial load from the index is printed for reference.
+"""
+from __future__ import annotations
+
+import asyncio
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from server.catalog import FileCatalog
+from server.file_handler import UploadStorage
+
+PAGE = 100
+
+
+def _populate(root: Path, storage: UploadStorage, count: int) -> None:
+    rng = random.Random(42)
+    loose = root / "loose"
+    loose.mkdir()
+    rows = []
+    for index in range(count):
+        name = f"doc-{index:06d}.txt"
+        (loose / name).touch()
+        rows.append((name, f"{index:064x}", rng.randrange(1 << 24), 1_700_000_000 + index, None, "text/plain", 0))
+    with storage._transaction() as db:
+        db.executemany(
+            "INSERT INTO files (name, sha256, size, created_at, uploader, mime, seq) VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+        )
+
+
+def _iterdir(directory: Path) -> list:
+    return sorted(path.name for path in directory.iterdir() if path.is_file())[:PAGE]
+
+
+def _time(func, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+async def main(count: int) -> None:
+    root = Path(tempfile.mkdtemp(prefix="chat-files-"))
+    storage = UploadStorage(root / "uploads", root / "uploads.partial", fsync="none")
+    storage.open()
+    _populate(root, storage, count)
+    catalog = FileCatalog(storage)
+    start = time.perf_counter()
+    await catalog.refresh()
+    print(f"{count} files, catalog loaded in {time.perf_counter() - start:.2f}s")
+    print(f"{'listing':>24} {'ms':>9}")
+    print(f"{'iterdir + is_file':>24} {_time(lambda: _iterdir(root / 'loose'), 3):>9.1f}")
+    print(f"{'catalog, by name':>24} {_time(lambda: catalog.query(limit=PAGE), 200):>9.3f}")
+    print(f"{'catalog, prefix':>24} {_time(lambda: catalog.query(limit=PAGE, prefix='doc-0421'), 200):>9.3f}")
+    print(f"{'catalog, size filter':>24} "
+          f"{_time(lambda: catalog.query(sort='size', limit=PAGE, min_size=1 << 20), 200):>9.3f}")
+    seq = catalog.seq
+    source = storage.temp_path()
+    source.write_bytes(b"new")
+    storage.publish(source, "fresh.txt")
+    start = time.perf_counter()
+    await catalog.refresh(force=True)
+    changes = catalog.changed_since(seq)
+    elapsed = (time.perf_counter() - start) * 1000
+    assert [entry["name"] for entry in changes["changed"]] == ["fresh.txt"]
+    print(f"{'refresh + changed since':>24} {elapsed:>9.3f}")
+    storage.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000))
@@ -0,0 +1,119 @@
+"""Broadcast latency while a storm of logins hashes passwords.
+
+Run from the project root::
+
+    python -m benchmarks.bench_login_storm [logins]
+
+A ticker broadcasts a chat message to 100 connections every 10 ms through
+``ConnectionManager`` and records how long each message takes to reach the
+sockets. Meanwhile 50 clients log in concurrently with the configured KDF
+(scrypt by default, see ``CHAT_KDF*``): "inline" calls ``AuthManager.login``
+on the event loop as the server used to, "pool" awaits ``login_async``,
+which hashes in the bounded thread pool. "resume" is the reconnect storm
+after a server restart: a fresh ``AuthManager`` (empty token cache) checks
+the tokens saved by the clients off the loop, as ``/resume`` does. The
+idle row is the baseline.
+"""
+from __future__ import annotations
+
+import asyncio
+import statistics
+import sys
+import tempfile
+import time
+
+from client.auth_manager import AuthManager
+from client.user_store import User
+from server.websocket_handler import ConnectionManager
+from shared import protocol
+
+LOGINS = 100
+CONCURRENCY = 50
+RECIPIENTS = 100
+TICK = 0.01
+
+
+class _FakeSocket:
+    def __init__(self, latencies: list) -> None:
+        self.scope = {"subprotocols": []}
+        self.latencies = latencies
+
+    async def accept(self, subprotocol: str | None = None) -> None:
+        pass
+
+    async def send_text(self, text: str) -> None:
+        sent = float(text.rsplit(" ", 1)[1])
+        self.latencies.append(time.perf_counter() - sent)
+
+    async def close(self, code: int = 1000) -> None:
+        pass
+
+
+async def _ticker(manager: ConnectionManager, done: asyncio.Event) -> None:
+    while not done.is_set():
+        await manager.broadcast_event(protocol.chat("ticker", f"tick {time.perf_counter()}"))
+        await asyncio.sleep(TICK)
+
+
+async def _storm(auth: AuthManager, mode: str, logins: int) -> None:
+    remaining = iter(range(logins))
+    if mode == "resume":
+        # One token per user (the per-user cap would evict shared ones),
+        # then a restart: a new manager on the same files.
+        password_hash = auth.users.get("storm").password_hash
+        tokens = []
+        for index in range(logins):
+            user = User(f"storm{index}", password_hash)
+            auth.users.add(user)
+            tokens.append(auth.issue_token(user))
+        auth = AuthManager(config_dir=str(auth.config_dir))
+        remaining = iter(tokens)
+
+    async def client() -> None:
+        for item in remaining:
+            if mode == "resume":
+                assert await auth.verify_token_async(item) is not None
+            elif mode == "pool":
+                await auth.login_async("storm", "correct horse")
+            else:
+                auth.login("storm", "correct horse")
+            await asyncio.sleep(0)
+
+    await asyncio.gather(*(client() for _ in range(CONCURRENCY)))
+
+
+async def _run(auth: AuthManager, mode: str, logins: int) -> tuple:
+    latencies: list = []
+    manager = ConnectionManager()
+    sockets = [_FakeSocket(latencies) for _ in range(RECIPIENTS)]
+    for socket in sockets:
+        await manager.connect(socket)
+    done = asyncio.Event()
+    ticker = asyncio.create_task(_ticker(manager, done))
+    started = time.perf_counter()
+    if mode == "idle":
+        await asyncio.sleep(1.0)
+    else:
+        await _storm(auth, mode, logins)
+    elapsed = time.perf_counter() - started
+    done.set()
+    await ticker
+    for socket in sockets:
+        await manager.close(socket)
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99)]
+    return elapsed, statistics.median(latencies) * 1e3, p99 * 1e3, latencies[-1] * 1e3
+
+
+def main(logins: int) -> None:
+    auth = AuthManager(config_dir=tempfile.mkdtemp(prefix="chat-login-storm-"))
+    auth.register("storm", "correct horse")
+    print(f"KDF: {auth.hasher.algorithm}, pool of {auth.hasher.workers} threads, {logins} logins")
+    print(f"{'mode':>7} {'storm (s)':>10} {'p50 (ms)':>9} {'p99 (ms)':>9} {'max (ms)':>9}")
+    for mode in ("idle", "inline", "pool", "resume"):
+        elapsed, p50, p99, worst = asyncio.run(_run(auth, mode, logins))
+        print(f"{mode:>7} {elapsed:>10.2f} {p50:>9.2f} {p99:>9.2f} {worst:>9.2f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else LOGINS)
@@ -0,0 +1,85 @@
+"""/search latency: inverted index vs. a linear scan of the history.
+
+Run from the project root::
+
+    python -m benchmarks.bench_search [messages]
+
+Builds an in-memory index over ``messages`` synthetic chat lines (default
+1,000,000) drawn from a Zipf-like vocabulary, then times a few queries
+(common word, rare word, two-word AND, sender filter) against the index
+and against scanning every message. Only the lookups are timed; the
+build time is printed for reference.
+"""
+from __future__ import annotations
+
+import itertools
+import random
+import sys
+import time
+
+from server.search import _Index, tokenize
+
+VOCABULARY = [f"mot{i}" for i in range(20000)]
+CUM_WEIGHTS = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(VOCABULARY))))
+USERS = [f"user{i}" for i in range(200)]
+ROOMS = ["general", "dev", "random"]
+QUERIES = {
+    "common": ("mot1", ""),
+    "rare": ("mot15000", ""),
+    "two words": ("mot3 mot40", ""),
+    "from:user": ("mot2", "user7"),
+}
+LIMIT = 20
+
+
+def _build(count: int):
+    rng = random.Random(42)
+    index = _Index()
+    messages = []
+    words = rng.choices(VOCABULARY, cum_weights=CUM_WEIGHTS, k=count * 8)
+    start = time.perf_counter()
+    for seq in range(1, count + 1):
+        text = " ".join(words[seq * 8 - 8:seq * 8])
+        name = rng.choice(USERS)
+        room = rng.choice(ROOMS)
+        index.add(seq, 1_700_000_000 + seq, name, room, tokenize(text))
+        messages.append((seq, name, room, text))
+    return index, messages, time.perf_counter() - start
+
+
+def _scan(messages, text: str, name: str) -> list:
+    terms = tokenize(text)
+    found = []
+    for seq, sender, room, body in reversed(messages):
+        if name and sender != name:
+            continue
+        if terms <= tokenize(body):
+            found.append(seq)
+            if len(found) >= LIMIT:
+                break
+    return found
+
+
+def _time(func, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    index, messages, build = _build(count)
+    print(f"{count} messages indexed in {build:.1f}s")
+    print(f"{'query':>10} {'index (ms)':>11} {'scan (ms)':>10} {'hits':>5}")
+    for label, (text, name) in QUERIES.items():
+        terms = sorted(tokenize(text))
+        hits = index.search(terms, ROOMS, name, 0.0, 0.0, LIMIT)
+        assert hits == _scan(messages, text, name)
+        indexed = _time(lambda: index.search(terms, ROOMS, name, 0.0, 0.0, LIMIT), 200)
+        scanned = _time(lambda: _scan(messages, text, name), 3)
+        print(f"{label:>10} {indexed:>11.3f} {scanned:>10.1f} {len(hits):>5}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Cold-start cost of the client and the server: import time and disk I/O.
+
+Run from the project root::
+
+    python -m benchmarks.bench_startup [runs] [--json results.jsonl]
+
+Each run starts a fresh interpreter with ``-X importtime`` in an empty
+scratch directory and imports the client entry point
+(``client.chat_handler``) or the server application (``server.app``),
+without connecting or serving. Reported per target, as medians over the
+runs: wall time of the process, total import time, the slowest top-level
+imports, the bytes read and written (``/proc/self/io``, Linux only) and
+the files the import left in the working directory (there should be
+none: configuration, databases and upload folders are only created on
+first use). ``--json`` appends one line per target, to track the numbers
+over time.
+"""
+from __future__ import annotations
+
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+TARGETS = {"client": "client.chat_handler", "server": "server.app"}
+RUNS = 5
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+IMPORT_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+# Printed by the child after the import: its own I/O counters.
+_CHILD = """
+import {module}
+try:
+    with open('/proc/self/io') as f:
+        print(f.read())
+except OSError:
+    pass
+"""
+
+
+def _run(module: str) -> dict:
+    scratch = Path(tempfile.mkdtemp(prefix="chat-startup-"))
+    env = dict(os.environ, PYTHONPATH=str(PROJECT_ROOT))
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _CHILD.format(module=module)],
+        cwd=scratch, env=env, capture_output=True, text=True, check=True,
+    )
+    wall = time.perf_counter() - started
+    top_level = {}
+    for line in completed.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match and len(match.group(3)) == 1:
+            top_level[match.group(4)] = int(match.group(2))
+    io = {}
+    for line in completed.stdout.splitlines():
+        key, _, value = line.partition(":")
+        if value.strip().isdigit():
+            io[key] = int(value)
+    return {
+        "wall_ms": wall * 1e3,
+        "import_ms": sum(top_level.values()) / 1e3,
+        "top": sorted(top_level.items(), key=lambda item: -item[1])[:5],
+        "read_bytes": io.get("rchar"),
+        "written_bytes": io.get("wchar"),
+        "created": sorted(str(path.relative_to(scratch)) for path in scratch.rglob("*")),
+    }
+
+
+def _median(runs: list, key: str):
+    values = [run[key] for run in runs if run[key] is not None]
+    return statistics.median(values) if values else None
+
+
+def main(argv: list) -> None:
+    json_path = None
+    if "--json" in argv:
+        index = argv.index("--json")
+        json_path = argv[index + 1]
+        del argv[index:index + 2]
+    runs = int(argv[0]) if argv else RUNS
+    for target, module in TARGETS.items():
+        results = [_run(module) for _ in range(runs)]
+        summary = {
+            "target": target,
+            "module": module,
+            "runs": runs,
+            "wall_ms": _median(results, "wall_ms"),
+            "import_ms": _median(results, "import_ms"),
+            "read_bytes": _median(results, "read_bytes"),
+            "written_bytes": _median(results, "written_bytes"),
+            "created": results[-1]["created"],
+            "top": [(name, micros / 1e3) for name, micros in results[-1]["top"]],
+        }
+        print(f"{target} ({module}), median of {runs} runs")
+        print(f"  wall {summary['wall_ms']:.0f} ms, imports {summary['import_ms']:.0f} ms")
+        if summary["read_bytes"] is not None:
+            print(f"  I/O: {summary['read_bytes'] / 1024:.0f} KiB read, {summary['written_bytes'] / 1024:.1f} KiB written")
+        print("  slowest imports: " + ", ".join(f"{name} {ms:.0f} ms" for name, ms in summary["top"]))
+        print("  files created: " + (", ".join(summary["created"]) or "none"))
+        if json_path:
+            summary["at"] = time.time()
+            with open(json_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(summary) + "\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,47 +1,50 @@
 from __future__ import annotations
 
+import asyncio
+import atexit
 import json
-import hashlib
+import os
 import secrets
-import jwt
-from datetime import datetime, timedelta
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import cached_property
 from pathlib import Path
-from typing import Optional, Dict, Any
-from dataclasses import dataclass, asdict
+from typing import Optional, Tuple
 
-@dataclass
-class User:
-    """Structure pour représenter un utilisateur."""
-    username: str
-    password_hash: str
-    email: Optional[str] = None
-    created_at: Optional[datetime] = None
-    last_login: Optional[datetime] = None
-    permissions: list[str] = None
-    is_active: bool = True
-    
-    def __post_init__(self):
-        if self.created_at is None:
-            self.created_at = datetime.now()
-        if self.permissions is None:
-            self.permissions = ["user"]
+from shared.utils import env_float, env_int
+
+from .passwords import PasswordHasher, create_password_hasher
+from .token_store import TokenStore, VerifiedTokenCache
+from .user_store import User, UserStore
+
+# Durée de validité d'un token
+TOKEN_LIFETIME = timedelta(hours=24)
 
 class AuthManager:
-    """Gestionnaire d'authentification pour l'application."""
+    """Gestionnaire d'authentification pour l'application.
+    
+    Le constructeur ne touche pas au disque : la clé secrète et les bases
+    (utilisateurs, tokens) sont ouvertes au premier usage, ce qui rend
+    l'import du module et l'instance globale gratuits.
+    """
     
     def __init__(self, config_dir: str = ".config"):
         self.config_dir = Path(config_dir)
-        self.config_dir.mkdir(exist_ok=True)
         self.users_file = self.config_dir / "users.json"
+        self.users_db = self.config_dir / "users.db"
         self.tokens_file = self.config_dir / "tokens.json"
-        self.secret_key = self._load_or_generate_secret()
+        self.tokens_db = self.config_dir / "tokens.db"
+        # Tokens reçus des serveurs, côté client
+        self.sessions_file = self.config_dir / "session.json"
         self.current_user: Optional[User] = None
         self.current_token: Optional[str] = None
-        self.users = self._load_users()
-        self.active_tokens = self._load_tokens()
+        self._db_executor: Optional[ThreadPoolExecutor] = None
     
-    def _load_or_generate_secret(self) -> str:
+    @cached_property
+    def secret_key(self) -> str:
         """Charge ou génère une clé secrète pour JWT."""
+        self.config_dir.mkdir(exist_ok=True)
         secret_file = self.config_dir / "secret.key"
         if secret_file.exists():
             return secret_file.read_text().strip()
@@ -50,159 +53,186 @@ class AuthManager:
             secret_file.write_text(secret)
             return secret
     
-    def _load_users(self) -> Dict[str, User]:
-        """Charge les utilisateurs depuis le fichier."""
-        if not self.users_file.exists():
+    @cached_property
+    def hasher(self) -> PasswordHasher:
+        return create_password_hasher()
+    
+    @cached_property
+    def users(self) -> UserStore:
+        store = self._open_users()
+        # Les dates de dernière connexion sont écrites en différé
+        atexit.register(store.flush)
+        return store
+    
+    @cached_property
+    def active_tokens(self) -> TokenStore:
+        return self._open_tokens()
+    
+    @cached_property
+    def verified(self) -> VerifiedTokenCache:
+        """Tokens déjà vérifiés (reconnexions sans mot de passe)."""
+        return VerifiedTokenCache(
+            capacity=env_int("CHAT_TOKEN_CACHE_SIZE", 10_000),
+            recheck=env_float("CHAT_TOKEN_RECHECK", 5.0),
+        )
+    
+    def open(self) -> None:
+        """Ouvre tout de suite ce qui l'est sinon au premier usage (serveur)."""
+        self.secret_key
+        self.users
+        self.active_tokens
+    
+    async def _run_db(self, function, *args):
+        """Exécute ``function`` (accès aux bases SQLite) hors de la boucle.
+        
+        Un seul thread : les bases et ``verified`` ne sont jamais touchés
+        par deux requêtes à la fois, et le pool par défaut reste aux fichiers.
+        """
+        if self._db_executor is None:
+            self._db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="auth-db")
+        return await asyncio.get_running_loop().run_in_executor(self._db_executor, function, *args)
+    
+    def _open_users(self) -> UserStore:
+        """Ouvre la base des utilisateurs (import de users.json au premier lancement)."""
+        self.config_dir.mkdir(exist_ok=True)
+        created = not self.users_db.exists()
+        store = UserStore(self.users_db, cache_size=env_int("CHAT_USER_CACHE_SIZE", 10_000))
+        if created and self.users_file.exists():
+            try:
+                store.import_json(self.users_file)
+            except Exception as e:
+                print(f"Erreur lors de l'import des utilisateurs: {e}")
+        if created and len(store) == 0:
             # Créer un utilisateur par défaut
-            default_user = User(
+            store.add(User(
                 username="admin",
                 password_hash=self._hash_password("admin"),
                 created_at=datetime.now(),
                 permissions=["admin"]
-            )
-            self._save_users({"admin": default_user})
-            return {"admin": default_user}
-        
-        try:
-            with open(self.users_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                users = {}
-                for username, user_data in data.items():
-                    user_data['created_at'] = datetime.fromisoformat(user_data['created_at'])
-                    if user_data.get('last_login'):
-                        user_data['last_login'] = datetime.fromisoformat(user_data['last_login'])
-                    users[username] = User(**user_data)
-                return users
-        except Exception as e:
-            print(f"Erreur lors du chargement des utilisateurs: {e}")
-            return {}
-    
-    def _save_users(self, users: Dict[str, User]) -> None:
-        """Sauvegarde les utilisateurs dans le fichier."""
-        try:
-            data = {}
-            for username, user in users.items():
-                user_dict = asdict(user)
-                user_dict['created_at'] = user.created_at.isoformat()
-                if user.last_login:
-                    user_dict['last_login'] = user.last_login.isoformat()
-                data[username] = user_dict
-            
-            with open(self.users_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
-        except Exception as e:
-            print(f"Erreur lors de la sauvegarde des utilisateurs: {e}")
-    
-    def _load_tokens(self) -> Dict[str, Dict[str, Any]]:
-        """Charge les tokens actifs."""
-        if not self.tokens_file.exists():
-            return {}
-        
-        try:
-            with open(self.tokens_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"Erreur lors du chargement des tokens: {e}")
-            return {}
+            ))
+        return store
     
-    def _save_tokens(self) -> None:
-        """Sauvegarde les tokens actifs."""
-        try:
-            with open(self.tokens_file, 'w', encoding='utf-8') as f:
-                json.dump(self.active_tokens, f, indent=2, ensure_ascii=False)
-        except Exception as e:
-            print(f"Erreur lors de la sauvegarde des tokens: {e}")
+    def _open_tokens(self) -> TokenStore:
+        """Ouvre la base des tokens actifs (import de tokens.json au premier lancement)."""
+        self.config_dir.mkdir(exist_ok=True)
+        created = not self.tokens_db.exists()
+        store = TokenStore(self.tokens_db, per_user=env_int("CHAT_TOKENS_PER_USER", 5))
+        if created and self.tokens_file.exists():
+            try:
+                store.import_json(self.tokens_file)
+            except Exception as e:
+                print(f"Erreur lors de l'import des tokens: {e}")
+        store.start()
+        return store
     
     def _hash_password(self, password: str) -> str:
-        """Hash un mot de passe avec salt."""
-        salt = secrets.token_hex(16)
-        hash_obj = hashlib.sha256()
-        hash_obj.update((password + salt).encode('utf-8'))
-        return f"{salt}${hash_obj.hexdigest()}"
+        """Hash un mot de passe avec salt (KDF configurée, voir passwords.py)."""
+        return self.hasher.hash(password)
     
     def _verify_password(self, password: str, password_hash: str) -> bool:
         """Vérifie un mot de passe contre son hash."""
-        try:
-            # Séparer le salt et le hash
-            parts = password_hash.split('$', 1)
-            if len(parts) != 2:
-                return False
-            
-            salt, hash_value = parts
-            
-            # Recréer le hash avec le même salt
-            hash_obj = hashlib.sha256()
-            hash_obj.update((password + salt).encode('utf-8'))
-            calculated_hash = hash_obj.hexdigest()
-            
-            # Comparer les hashes
-            return calculated_hash == hash_value
-        except Exception as e:
-            print(f"Erreur lors de la vérification du mot de passe: {e}")
-            return False
+        return self.hasher.verify(password, password_hash)
     
-    def register(self, username: str, password: str, email: Optional[str] = None) -> bool:
-        """Enregistre un nouvel utilisateur."""
-        if username in self.users:
-            return False
-        
-        user = User(
+    def _new_user(self, username: str, password_hash: str, email: Optional[str]) -> User:
+        return User(
             username=username,
-            password_hash=self._hash_password(password),
+            password_hash=password_hash,
             email=email,
             created_at=datetime.now(),
             permissions=["user"]
         )
-        
-        self.users[username] = user
-        self._save_users(self.users)
-        return True
+    
+    def register(self, username: str, password: str, email: Optional[str] = None) -> bool:
+        """Enregistre un nouvel utilisateur."""
+        if username in self.users:
+            return False
+        return self.users.add(self._new_user(username, self._hash_password(password), email))
+    
+    async def register_async(self, username: str, password: str, email: Optional[str] = None) -> bool:
+        """Comme ``register``, le hachage et les accès à la base tournant hors de la boucle asyncio."""
+        if await self._run_db(self.users.get, username) is not None:
+            return False
+        password_hash = await self.hasher.hash_async(password)
+        return await self._run_db(self.users.add, self._new_user(username, password_hash, email))
     
     def login(self, username: str, password: str) -> Optional[str]:
         """Connecte un utilisateur et retourne un token JWT."""
-        if username not in self.users:
+        user = self.users.get(username)
+        if user is None or not user.is_active:
             return None
         
-        user = self.users[username]
-        if not user.is_active:
+        if not self._verify_password(password, user.password_hash):
             return None
         
-        if not self._verify_password(password, user.password_hash):
+        # Mettre à niveau les anciens hashes avec le mot de passe en clair
+        if self.hasher.needs_rehash(user.password_hash):
+            user.password_hash = self._hash_password(password)
+            self.users.save(user)
+        
+        token = self.issue_token(user)
+        self.current_user = user
+        self.current_token = token
+        return token
+    
+    async def login_async(self, username: str, password: str) -> Optional[str]:
+        """Comme ``login``, la KDF tournant dans le pool de hachage.
+        
+        Sans état : retourne le token sans changer ``current_user``, le
+        serveur gardant l'utilisateur de chaque connexion dans sa session.
+        Les bases sont lues et écrites hors de la boucle (``_run_db``).
+        Lève ``HasherBusy`` si trop de connexions attendent déjà le pool.
+        """
+        user = await self._run_db(self.users.get, username)
+        if user is None or not user.is_active:
             return None
         
+        if not await self.hasher.verify_async(password, user.password_hash):
+            return None
+        
+        if self.hasher.needs_rehash(user.password_hash):
+            user.password_hash = await self.hasher.hash_async(password)
+            await self._run_db(self.users.save, user)
+        
+        return await self._run_db(self.issue_token, user)
+    
+    def issue_token(self, user: User) -> str:
+        """Génère et enregistre le token d'un utilisateur authentifié.
+        
+        Ne touche pas à ``current_user`` : c'est ``login`` qui en fait
+        l'utilisateur courant de ce processus (client).
+        """
+        username = user.username
+        
         # Mettre à jour la dernière connexion
-        user.last_login = datetime.now()
-        self._save_users(self.users)
+        self.users.touch_login(user, datetime.now())
+        
+        import jwt
         
         # Générer un token JWT
+        issued_at = datetime.now(timezone.utc)
+        expires_at = issued_at + TOKEN_LIFETIME
         token = jwt.encode(
             {
                 'username': username,
-                'exp': datetime.utcnow() + timedelta(hours=24),
-                'iat': datetime.utcnow()
+                'exp': expires_at,
+                'iat': issued_at,
+                # Deux connexions dans la même seconde donnent des tokens distincts
+                'jti': secrets.token_hex(8)
             },
             self.secret_key,
             algorithm='HS256'
         )
         
-        # Sauvegarder le token
-        self.active_tokens[token] = {
-            'username': username,
-            'created_at': datetime.now().isoformat(),
-            'expires_at': (datetime.now() + timedelta(hours=24)).isoformat()
-        }
-        self._save_tokens()
+        # Sauvegarder le token (les plus anciens au-delà du quota sont révoqués)
+        for evicted in self.active_tokens.issue(token, username, expires_at.timestamp()):
+            self.verified.discard(evicted)
         
-        self.current_user = user
-        self.current_token = token
         return token
     
     def logout(self) -> bool:
         """Déconnecte l'utilisateur actuel."""
         if self.current_token:
-            if self.current_token in self.active_tokens:
-                del self.active_tokens[self.current_token]
-                self._save_tokens()
+            self.revoke_token(self.current_token)
             
             self.current_user = None
             self.current_token = None
@@ -210,31 +240,90 @@ class AuthManager:
         return False
     
     def verify_token(self, token: str) -> Optional[User]:
-        """Vérifie un token JWT et retourne l'utilisateur."""
-        try:
-            payload = jwt.decode(token, self.secret_key, algorithms=['HS256'])
-            username = payload['username']
+        """Vérifie un token JWT et retourne l'utilisateur.
+        
+        Les tokens déjà vérifiés sont servis par ``self.verified`` sans
+        décoder le JWT ni relire la base.
+        """
+        now = time.time()
+        username = self.verified.get(token, now)
+        if username is None:
+            import jwt
             
-            if username not in self.users:
+            try:
+                payload = jwt.decode(token, self.secret_key, algorithms=['HS256'])
+            except jwt.ExpiredSignatureError:
+                # Token expiré, le supprimer
+                self.active_tokens.revoke(token)
                 return None
-            
-            user = self.users[username]
-            if not user.is_active:
+            except jwt.InvalidTokenError:
                 return None
             
             # Vérifier si le token est dans la liste des tokens actifs
-            if token not in self.active_tokens:
+            entry = self.active_tokens.get(token)
+            if entry is None or entry.username != payload.get('username'):
+                self.verified.discard(token)
                 return None
-            
-            return user
-        except jwt.ExpiredSignatureError:
-            # Token expiré, le supprimer
-            if token in self.active_tokens:
-                del self.active_tokens[token]
-                self._save_tokens()
+            username = entry.username
+            self.verified.put(token, username, entry.expires_at, now)
+        
+        user = self.users.get(username)
+        if user is None or not user.is_active:
             return None
-        except jwt.InvalidTokenError:
+        return user
+    
+    def revoke_token(self, token: str) -> bool:
+        """Révoque un token (déconnexion d'une session)."""
+        self.verified.discard(token)
+        return self.active_tokens.revoke(token)
+    
+    async def verify_token_async(self, token: str) -> Optional[User]:
+        """``verify_token`` hors de la boucle (serveur)."""
+        return await self._run_db(self.verify_token, token)
+    
+    async def revoke_token_async(self, token: str) -> bool:
+        """``revoke_token`` hors de la boucle (serveur)."""
+        return await self._run_db(self.revoke_token, token)
+    
+    async def forget_token_async(self, token: str) -> None:
+        """Retire ``token`` de ``verified`` (révoqué par un autre worker)."""
+        await self._run_db(self.verified.discard, token)
+    
+    def _load_sessions(self) -> dict:
+        try:
+            with open(self.sessions_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    def server_token(self, server: str) -> Optional[Tuple[str, str]]:
+        """(utilisateur, token) mémorisés pour ce serveur, pour ``/resume``."""
+        saved = self._load_sessions().get(server)
+        if not saved:
             return None
+        return saved['username'], saved['token']
+    
+    def remember_server_token(self, server: str, username: str, token: str) -> None:
+        """Mémorise le token de session reçu d'un serveur (fichier privé)."""
+        sessions = self._load_sessions()
+        sessions[server] = {'username': username, 'token': token}
+        self._save_sessions(sessions)
+    
+    def forget_server_token(self, server: str) -> None:
+        sessions = self._load_sessions()
+        if sessions.pop(server, None) is not None:
+            self._save_sessions(sessions)
+    
+    def _save_sessions(self, sessions: dict) -> None:
+        temporary = self.sessions_file.with_suffix('.tmp')
+        try:
+            self.config_dir.mkdir(exist_ok=True)
+            fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(sessions, f, indent=2)
+            os.replace(temporary, self.sessions_file)
+        except OSError as e:
+            print(f"Erreur lors de la sauvegarde de la session: {e}")
     
     def get_current_user(self) -> Optional[User]:
         """Retourne l'utilisateur actuellement connecté."""
@@ -250,20 +339,19 @@ class AuthManager:
         """Liste tous les utilisateurs (admin seulement)."""
         if not self.has_permission("admin"):
             return []
-        return list(self.users.keys())
+        return self.users.usernames()
     
     def delete_user(self, username: str) -> bool:
         """Supprime un utilisateur (admin seulement)."""
         if not self.has_permission("admin"):
             return False
         
-        if username in self.users:
-            del self.users[username]
-            self._save_users(self.users)
-            return True
-        return False
+        self.active_tokens.revoke_user(username)
+        self.verified.discard_user(username)
+        return self.users.delete(username)
 
-# Instance globale du gestionnaire d'authentification
+# Instance globale du gestionnaire d'authentification (rien n'est ouvert
+# avant le premier usage)
 auth_manager = AuthManager()
 
 def login_user(username: str, password: str) -> Optional[str]:
@@ -4,19 +4,21 @@ import asyncio
 import os
 from typing import Awaitable, Callable
 import shutil
+import signal
 import re
 from datetime import datetime
 
-import httpx
-import websockets
 from colorama import init, Fore, Back, Style
+# httpx et websockets sont importés par les fonctions qui s'en servent,
+# pour que le client démarre vite.
 
-from .file_sender import send_file
-from .file_receiver import download_file
+from .file_sender import send_file, send_file_with_progress
+from .file_receiver import download_file, download_file_with_progress
+from .progress_bar import format_size
 from .runner import run_code
 from .theme_manager import theme_manager, get_color
-from .progress_bar import create_async_progress_bar
 from .auth_manager import auth_manager, login_user, logout_user, get_current_user, is_authenticated
+from shared import protocol
 
 # Initialize colorama for cross-platform colored output
 init(autoreset=True)
@@ -32,8 +34,14 @@ class UIState:
         self.http_url: str = ""
         self.ws_url: str = ""
         self.online_users: int = 0
+        self.online: set[str] = set()  # tenu à jour par les deltas de présence
+        self.pending_username: str | None = None  # /login envoyé, pas encore confirmé
+        self.resuming: bool = False  # /resume envoyé avec le token mémorisé
+        self.awaiting_session: bool = False  # /backfill et /presence on attendent l'événement SESSION
+        self.status_redraw: asyncio.TimerHandle | None = None
         self.last_author: str | None = None
         self.last_minute: str | None = None  # YYYY-MM-DD HH:MM
+        self.last_seq: int = 0  # dernier numéro de séquence serveur reçu
 
 
 ui_state = UIState()
@@ -99,6 +107,18 @@ def draw_status_line() -> None:
     print(line)
 
 
+def _schedule_status_redraw(delay: float = 1.0) -> None:
+    """Redraw the status line once per burst of presence changes."""
+    if ui_state.status_redraw is not None:
+        return
+
+    def redraw() -> None:
+        ui_state.status_redraw = None
+        draw_status_line()
+
+    ui_state.status_redraw = asyncio.get_running_loop().call_later(delay, redraw)
+
+
 def _prompt() -> str:
     # Plain prompt to avoid PSReadLine rendering issues
     return "V-Send: "
@@ -181,10 +201,10 @@ def print_server(message: str):
     print(server_message)
 
 
-def print_peer(username: str, message: str):
+def print_peer(username: str, message: str, sent_at: float = 0.0):
     """Print a peer user message with special styling."""
     _maybe_group(username or "peer")
-    timestamp = datetime.now().strftime("%H:%M:%S")
+    timestamp = (datetime.fromtimestamp(sent_at) if sent_at else datetime.now()).strftime("%H:%M:%S")
     timestamp_color = get_color("timestamp")
     user_color = get_color("user")
     text_color = get_color("text_primary")
@@ -192,24 +212,33 @@ def print_peer(username: str, message: str):
     print(_format_left(peer_message))
 
 async def _print_files(http_base_url: str) -> None:
+    import httpx
+    entries = []
+    params = {"limit": 1000}
     async with httpx.AsyncClient(timeout=30) as client:
-        response = await client.get(http_base_url.rstrip("/") + "/files")
-        response.raise_for_status()
-        files = response.json().get("files", [])
-        if not files:
-            print_info("Aucun fichier côté serveur.")
-        else:
-            print_info(f"Fichiers côté serveur ({len(files)} fichiers):")
-            primary_color = get_color("primary")
-            text_color = get_color("text_primary")
-            name_width = max((len(n) for n in files), default=10)
-            header = f"{primary_color}{'Nom'.ljust(name_width)}  {text_color}Taille   Date"
-            print(header)
-            print(get_color('text_muted') + '─' * (name_width + 18) + Style.RESET_ALL)
-            for name in files:
-                # Taille/Date non disponibles via /files actuel; placeholders
-                line = f"{text_color}{name.ljust(name_width)}  --      --"
-                print(line)
+        # Le serveur pagine la liste : suivre les curseurs jusqu'à la fin
+        while True:
+            response = await client.get(http_base_url.rstrip("/") + "/files", params=params)
+            response.raise_for_status()
+            data = response.json()
+            entries.extend(data.get("entries") or [{"name": name} for name in data.get("files", [])])
+            if not data.get("next_cursor"):
+                break
+            params["cursor"] = data["next_cursor"]
+    if not entries:
+        print_info("Aucun fichier côté serveur.")
+    else:
+        print_info(f"Fichiers côté serveur ({len(entries)} fichiers):")
+        primary_color = get_color("primary")
+        text_color = get_color("text_primary")
+        name_width = max((len(entry["name"]) for entry in entries), default=10)
+        header = f"{primary_color}{'Nom'.ljust(name_width)}  {text_color}{'Taille'.rjust(10)}  Date"
+        print(header)
+        print(get_color('text_muted') + '─' * (name_width + 30) + Style.RESET_ALL)
+        for entry in entries:
+            size = format_size(entry["size"]) if "size" in entry else "--"
+            date = datetime.fromtimestamp(entry["mtime"]).strftime("%Y-%m-%d %H:%M") if entry.get("mtime") else "--"
+            print(f"{text_color}{entry['name'].ljust(name_width)}  {size.rjust(10)}  {date}")
 
 
 async def _print_local_files(directory: str = ".") -> None:
@@ -239,6 +268,34 @@ async def _print_local_files(directory: str = ".") -> None:
         print_error(f"Erreur lors de la lecture des fichiers locaux: {exc}")
 
 
+class TransferCancelled(Exception):
+    """Transfert interrompu par Ctrl+C."""
+
+
+async def _interruptible(coro: Awaitable):
+    """Attend ``coro`` ; un Ctrl+C l'annule sans fermer le client.
+
+    Sans gestion des signaux par la boucle (Windows), Ctrl+C garde son
+    comportement habituel et arrête le client, le transfert étant annulé.
+    """
+    task = asyncio.ensure_future(coro)
+    loop = asyncio.get_running_loop()
+    previous = signal.getsignal(signal.SIGINT)
+    try:
+        loop.add_signal_handler(signal.SIGINT, task.cancel)
+    except (NotImplementedError, RuntimeError, ValueError):
+        return await task
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if asyncio.current_task().cancelling():
+            raise
+        raise TransferCancelled() from None
+    finally:
+        loop.remove_signal_handler(signal.SIGINT)
+        signal.signal(signal.SIGINT, previous)
+
+
 async def chat_send_loop(websocket, http_base_url: str) -> None:
     """Reads user input, handles slash-commands, or sends text over WS."""
     primary_color = get_color("primary")
@@ -257,6 +314,11 @@ async def chat_send_loop(websocket, http_base_url: str) -> None:
 {primary_color}|{primary_color} {success_color}/whoami{primary_color}                  Afficher l'utilisateur actuel            {primary_color}|
 {primary_color}|{primary_color} {success_color}/users{primary_color}                   Lister les utilisateurs connectés         {primary_color}|
 {primary_color}|{primary_color} {success_color}/msg <user> <message>{primary_color}    Envoyer un message privé                 {primary_color}|
+{primary_color}|{primary_color} {success_color}/join <salon>{primary_color}            Rejoindre un salon (et y écrire)          {primary_color}|
+{primary_color}|{primary_color} {success_color}/leave [salon]{primary_color}           Quitter un salon                          {primary_color}|
+{primary_color}|{primary_color} {success_color}/rooms{primary_color}                   Lister les salons                         {primary_color}|
+{primary_color}|{primary_color} {success_color}/history [n|10m|HH:MM] [@user]{primary_color} Historique du salon           {primary_color}|
+{primary_color}|{primary_color} {success_color}/search <mots> [from:user]{primary_color} Rechercher dans l'historique     {primary_color}|
 {primary_color}|{primary_color} {success_color}/send <chemin>{primary_color}          Envoyer un fichier vers le serveur        {primary_color}|
 {primary_color}|{primary_color} {success_color}/files{primary_color}                  Lister les fichiers sur le serveur        {primary_color}|
 {primary_color}|{primary_color} {success_color}/download <nom> [dir]{primary_color}  Télécharger un fichier depuis le serveur  {primary_color}|
@@ -333,6 +395,13 @@ async def chat_send_loop(websocket, http_base_url: str) -> None:
                 continue
             try:
                 await websocket.send(stripped)
+                ui_state.pending_username = parts[1]
+                if websocket.subprotocol in (protocol.JSON_SUBPROTOCOL, protocol.BIN_SUBPROTOCOL):
+                    # envoyés quand le serveur aura confirmé la connexion
+                    ui_state.awaiting_session = True
+                else:
+                    # protocole texte : pas d'événement SESSION à attendre
+                    await _after_login(websocket)
             except Exception as e:
                 print_error(f"Erreur lors de l'envoi de la commande de connexion: {e}")
             continue
@@ -341,6 +410,10 @@ async def chat_send_loop(websocket, http_base_url: str) -> None:
             try:
                 await websocket.send("/logout")
                 logout_user()
+                auth_manager.forget_server_token(ui_state.ws_url)
+                ui_state.username = None
+                ui_state.online.clear()
+                ui_state.online_users = 0
                 print_success("Déconnexion réussie")
             except Exception as e:
                 print_error(f"Erreur lors de la déconnexion: {e}")
@@ -387,9 +460,14 @@ async def chat_send_loop(websocket, http_base_url: str) -> None:
         if stripped.lower().startswith("/send "):
             path = stripped.split(" ", 1)[1].strip().strip('"')
             try:
-                print_info(f"Envoi du fichier: {path}")
-                filename = await send_file_with_progress(http_base_url, path)
+                print_info(f"Envoi du fichier: {path} (Ctrl+C pour annuler)")
+                session = auth_manager.server_token(ui_state.ws_url)
+                token = session[1] if session else None
+                filename = await _interruptible(send_file_with_progress(http_base_url, path, token))
                 print_success(f"Fichier envoyé avec succès: {filename}")
+            except TransferCancelled:
+                print()
+                print_warning("Envoi annulé")
             except Exception as exc:  # noqa: BLE001
                 print_error(f"Échec de l'envoi: {exc}")
             continue
@@ -416,14 +494,17 @@ async def chat_send_loop(websocket, http_base_url: str) -> None:
                 filename = args[1]
                 dest_dir = args[2] if len(args) >= 3 else "."
                 try:
-                    print_info(f"Téléchargement de: {filename}")
-                    saved = await download_file_with_progress(http_base_url, filename, dest_dir)
+                    print_info(f"Téléchargement de: {filename} (Ctrl+C pour annuler)")
+                    saved = await _interruptible(download_file_with_progress(http_base_url, filename, dest_dir))
                     print_success(f"Fichier téléchargé: {saved}")
                     
                     # Afficher les fichiers locaux après téléchargement
                     print_info("Fichiers locaux après téléchargement:")
                     await _print_local_files(dest_dir)
                     
+                except TransferCancelled:
+                    print()
+                    print_warning("Téléchargement annulé")
                 except Exception as exc:  # noqa: BLE001
                     print_error(f"Échec du téléchargement: {exc}")
             else:
@@ -467,113 +548,74 @@ async def chat_send_loop(websocket, http_base_url: str) -> None:
                 await websocket.send(stripped)
             except Exception as exc:  # noqa: BLE001
                 print_error(f"Erreur d'envoi de la commande: {exc}")
-                continue
+            continue
 
         # Sécurité (ne devrait pas arriver)
         print_error(f"Commande inconnue: '{stripped}'. Utilisez /help pour voir les commandes disponibles.")
 
 
-async def send_file_with_progress(http_base_url: str, file_path: str) -> str:
-    """Send a file with progress bar."""
-    from pathlib import Path
-    
-    path = Path(file_path).expanduser().resolve()
-    if not path.exists() or not path.is_file():
-        raise FileNotFoundError(f"Fichier introuvable: {path}")
-    
-    file_size = path.stat().st_size
-    progress_bar = create_async_progress_bar(file_size, f"Envoi de {path.name}")
-    
-    # la progression (dans un vrai cas, il faudrait intercepter les chunks)
-    chunk_size = 8192
-    sent_bytes = 0
-    
-    url = http_base_url.rstrip("/") + "/upload"
-    async with httpx.AsyncClient(timeout=60) as client:
-        with path.open("rb") as fp:
-            files = {"file": (path.name, fp, "application/octet-stream")}
-            response = await client.post(url, files=files)
-            response.raise_for_status()
-            
-            # Marquer comme terminé
-            await progress_bar.set_progress(file_size)
-            await progress_bar.finish()
-            
-            return response.json().get("filename", path.name)
-
-
-async def download_file_with_progress(http_base_url: str, filename: str, destination_dir: str) -> Path:
-    """Download a file with progress bar."""
-    from pathlib import Path
-    
-    destination_directory = Path(destination_dir).expanduser().resolve()
-    destination_directory.mkdir(parents=True, exist_ok=True)
-    
-    url = http_base_url.rstrip("/") + f"/uploads/{filename}"
-    destination_path = destination_directory / filename
-    
-    async with httpx.AsyncClient(timeout=60) as client:
-        # D'abord, obtenir la taille du fichier
-        head_response = await client.head(url)
-        if head_response.status_code == 200:
-            content_length = head_response.headers.get('content-length')
-            total_size = int(content_length) if content_length else 0
+def _show_event(event: protocol.Event) -> None:
+    """Display one server event according to its type."""
+    if event.seq > ui_state.last_seq:
+        ui_state.last_seq = event.seq
+    kind = event.type
+    if kind == protocol.ECHO:
+        # already printed locally
+        return
+    if kind == protocol.ERROR:
+        if ui_state.resuming:
+            # token refusé (expiré ou révoqué): il faudra un /login
+            ui_state.resuming = False
+            auth_manager.forget_server_token(ui_state.ws_url)
+        print_error(event.text)
+    elif kind == protocol.INFO:
+        print_info(event.text)
+    elif kind == protocol.CHAT:
+        if event.room and event.room != protocol.DEFAULT_ROOM:
+            print_peer(f"{event.name} #{event.room}", event.text, event.ts)
         else:
-            total_size = 0
-        
-        progress_bar = create_async_progress_bar(total_size, f"Téléchargement de {filename}")
-        
-        response = await client.get(url)
-        response.raise_for_status()
-        
-        # Écrire le fichier
-        destination_path.write_bytes(response.content)
-        
-        # Marquer comme terminé
-        await progress_bar.set_progress(len(response.content))
-        await progress_bar.finish()
-        
-        return destination_path
+            print_peer(event.name, event.text, event.ts)
+    elif kind == protocol.PM:
+        print_peer(f"(privé) {event.name}", event.text)
+    elif kind == protocol.PM_SENT:
+        print_info(f"Message privé envoyé à {event.name}: {event.text}")
+    elif kind == protocol.SESSION:
+        ui_state.username = event.name
+        ui_state.pending_username = None
+        auth_manager.remember_server_token(ui_state.ws_url, event.name, event.text)
+        print_info(f"Connecté en tant que {event.name}")
+        draw_status_line()
+    elif kind == protocol.USERS:
+        # instantané reçu après une connexion réussie
+        ui_state.online = set(event.text.split())
+        ui_state.online_users = len(ui_state.online)
+        ui_state.username = ui_state.pending_username or ui_state.username
+        draw_status_line()
+    elif kind in (protocol.ONLINE, protocol.OFFLINE):
+        if kind == protocol.ONLINE:
+            ui_state.online.add(event.name)
+        else:
+            ui_state.online.discard(event.name)
+        ui_state.online_users = len(ui_state.online)
+        _schedule_status_redraw()
+    else:
+        print_server(event.text)
 
 
 async def chat_receive_loop(websocket) -> None:
+    import websockets
+
+    # Codec agreed during the handshake (legacy text if none)
+    codec = protocol.codec_for(websocket.subprotocol)
     try:
-        async for message in websocket:
-            if message.startswith("[ERROR]"):
-                # Error message
-                print_error(message[8:])  # Remove "[ERROR] " prefix
-            elif message.startswith("[INFO]"):
-                # Info message
-                print_info(message[7:])  # Remove "[INFO] " prefix
-            else:
-                # Generic parser for tagged messages: [tag:name] text
-                import re as _re
-                m = _re.match(r"^\[(?P<tag>[^:\]]+):(?P<name>[^\]]+)\]\s?(?P<text>.*)$", message)
-                if m:
-                    tag = m.group("tag")
-                    name = m.group("name")
-                    text = m.group("text")
-                    if tag == "you":
-                        # already printed locally
-                        continue
-                    if tag == "peer":
-                        print_peer(name, text)
-                    elif tag == "pm":
-                        print_peer(f"(privé) {name}", text)
-                    elif tag == "pm-sent":
-                        print_info(f"Message privé envoyé à {name}: {text}")
-                    else:
-                        if tag == "peer":
-                            print_peer(name, text)
-                        elif tag == "pm":
-                            print_peer(f"(privé) {name}", text)
-                        elif tag == "pm-sent":
-                            print_info(f"Message privé envoyé à {name}: {text}")
-                        else:
-                            print_server(message)
-                else:
-                    # Regular server message
-                    print_server(message)
+        async for frame in websocket:
+            for event in codec.decode(frame):
+                if event.type == protocol.SESSION:
+                    ui_state.resuming = False
+                    if ui_state.awaiting_session:
+                        ui_state.awaiting_session = False
+                        await _after_login(websocket)
+                _show_event(event)
     except websockets.ConnectionClosedOK:
         print_info("Connexion WebSocket fermée proprement")
     except websockets.ConnectionClosedError:
@@ -582,7 +624,29 @@ async def chat_receive_loop(websocket) -> None:
         print_error(f"Erreur inattendue: {e}")
 
 
-async def run_chat(websocket_url: str, http_base_url: str) -> None:
+async def _after_login(websocket) -> None:
+    """Commandes qui suivent une connexion acceptée par le serveur."""
+    # rattraper les messages manqués depuis le dernier numéro reçu
+    await websocket.send(f"/backfill {ui_state.last_seq}")
+    # présence en direct (instantané puis deltas) pour la ligne d'état
+    await websocket.send("/presence on")
+
+
+async def _resume_session(websocket) -> None:
+    """Reprend la session précédente avec le token mémorisé pour ce serveur."""
+    saved = auth_manager.server_token(ui_state.ws_url)
+    if saved is None or websocket.subprotocol not in (protocol.JSON_SUBPROTOCOL, protocol.BIN_SUBPROTOCOL):
+        return
+    username, token = saved
+    print_info(f"Reprise de la session de {username}...")
+    ui_state.pending_username = username
+    ui_state.resuming = True
+    # comme après /login : /backfill et /presence on suivent la confirmation
+    ui_state.awaiting_session = True
+    await websocket.send(f"/resume {token}")
+
+
+async def run_chat(websocket_url: str, http_base_url: str, wire_protocol: str = "json") -> None:
     print_banner()
     print_info(f"Connexion au serveur: {websocket_url}")
     print_info(f"Base URL HTTP: {http_base_url}")
@@ -597,11 +661,21 @@ async def run_chat(websocket_url: str, http_base_url: str) -> None:
     
     print()
     
+    import websockets
+
     async with websockets.connect(
-        websocket_url, ping_interval=20, ping_timeout=20
+        websocket_url,
+        ping_interval=20,
+        ping_timeout=20,
+        subprotocols=protocol.CLIENT_OFFERS[wire_protocol],
     ) as websocket:
         print_success("Connexion WebSocket établie!")
+        ui_state.connected = True
+        ui_state.ws_url = websocket_url
+        ui_state.http_url = http_base_url
+        draw_status_line()
         print()
+        await _resume_session(websocket)
         
         sender_task = asyncio.create_task(chat_send_loop(websocket, http_base_url))
         receiver_task = asyncio.create_task(chat_receive_loop(websocket))
@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Optional, Tuple
+
+from shared.utils import env_int
+
+
+class DownloadCache:
+    """Copies des fichiers téléchargés, rangées par ETag.
+
+    ``index.json`` retient le dernier ETag reçu pour chaque URL ; chaque
+    contenu n'est gardé qu'une fois par ETag. ``/download`` envoie cet ETag
+    dans ``If-None-Match`` et, sur ``304 Not Modified``, copie le contenu
+    du cache au lieu de le transférer à nouveau. Au-delà de ``max_bytes``,
+    les contenus les moins récemment utilisés sont supprimés.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int) -> None:
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.index_file = self.directory / "index.json"
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _content_path(self, etag: str) -> Path:
+        return self.directory / hashlib.sha256(etag.encode("utf-8")).hexdigest()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.index_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, index: dict) -> None:
+        temporary = self.index_file.with_suffix(".tmp")
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(temporary, self.index_file)
+
+    def lookup(self, url: str) -> Optional[Tuple[str, int]]:
+        """(ETag, taille) du contenu en cache pour ``url``, s'il est encore là."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._load().get(url)
+            if not entry:
+                return None
+            try:
+                size = self._content_path(entry["etag"]).stat().st_size
+            except OSError:
+                return None
+            if size != entry["size"]:
+                return None
+            return entry["etag"], size
+
+    def restore(self, etag: str, destination: str) -> None:
+        """Copie le contenu en cache dans ``destination`` (qui existe déjà)."""
+        path = self._content_path(etag)
+        shutil.copyfile(path, destination)
+        # l'heure d'accès sert à l'éviction
+        os.utime(path)
+
+    def store(self, url: str, etag: str, source: str) -> None:
+        """Garde une copie de ``source`` (le fichier téléchargé) sous ``etag``."""
+        size = os.stat(source).st_size
+        if not self.enabled or size > self.max_bytes:
+            return
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            path = self._content_path(etag)
+            if not path.exists():
+                # Une copie et non un lien : modifier le fichier téléchargé ne touche pas au cache
+                temporary = path.with_suffix(".part")
+                shutil.copyfile(source, temporary)
+                os.replace(temporary, path)
+            else:
+                os.utime(path)
+            index = self._load()
+            index[url] = {"etag": etag, "size": size}
+            self._evict(index)
+            self._save(index)
+
+    def _evict(self, index: dict) -> None:
+        contents = []
+        for path in self.directory.iterdir():
+            if path.name != self.index_file.name and path.suffix not in (".tmp", ".part"):
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                contents.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in contents)
+        removed = set()
+        for _, size, path in sorted(contents, key=lambda item: item[0]):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            removed.add(path.name)
+            total -= size
+        for url in [url for url, entry in index.items() if self._content_path(entry["etag"]).name in removed]:
+            del index[url]
+
+
+def create_download_cache() -> DownloadCache:
+    directory = Path(os.getenv("CHAT_DOWNLOAD_CACHE_DIR", os.path.join(".config", "downloads"))).expanduser()
+    return DownloadCache(directory, env_int("CHAT_DOWNLOAD_CACHE_SIZE", 512 * 1024 * 1024))
+
+
+download_cache = create_download_cache()
@@ -1,59 +1,207 @@
 from __future__ import annotations
 
+import asyncio
+import os
+import re
+import tempfile
 from pathlib import Path
-import httpx
-from .progress_bar import create_async_progress_bar
+from typing import List, Optional, Tuple
+from urllib.parse import quote
 
+from shared.compression import is_compressible
+from shared.utils import env_int
+from .download_cache import download_cache
+from .progress_bar import AsyncProgressBar, create_async_progress_bar
 
-async def download_file(
-    http_base_url: str, filename: str, destination_dir: str | Path
-) -> Path:
-    """Download a file from the server's static uploads and save it locally."""
+# Taille des lectures sur le réseau et des écritures sur disque
+READ_SIZE = 1024 * 1024
+CONTENT_RANGE = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+
+
+class DownloadFailed(Exception):
+    """Réponse inattendue du serveur pendant un téléchargement."""
+
+
+def _prepare(http_base_url: str, filename: str, destination_dir: str | Path) -> Tuple[str, Path]:
     destination_directory = Path(destination_dir).expanduser().resolve()
     destination_directory.mkdir(parents=True, exist_ok=True)
+    url = http_base_url.rstrip("/") + "/uploads/" + quote(filename)
+    return url, destination_directory / Path(filename).name
+
+
+async def _write_body(response, path: str, offset: int, progress: Optional[AsyncProgressBar]) -> int:
+    """Écrit le corps de ``response`` à partir de ``offset``, bloc par bloc."""
+    written = 0
+    downloaded = response.num_bytes_downloaded
+    # Un descripteur par segment : les segments parallèles n'ont pas à partager la position
+    with open(path, "r+b") as fp:
+        fp.seek(offset)
+        async for chunk in response.aiter_bytes(READ_SIZE):
+            await asyncio.to_thread(fp.write, chunk)
+            written += len(chunk)
+            if progress is not None:
+                # octets reçus du réseau : ceux du corps compressé s'il l'est
+                await progress.update(response.num_bytes_downloaded - downloaded)
+                downloaded = response.num_bytes_downloaded
+    return written
+
+
+async def _fetch_range(client, url: str, path: str, start: int, end: int, total: int,
+                       progress: Optional[AsyncProgressBar], etag: Optional[str]) -> None:
+    headers = {"Range": f"bytes={start}-{end}"}
+    if etag is not None:
+        # Si le fichier change entre deux segments, le serveur répond 200 et on s'arrête
+        headers["If-Range"] = etag
+    async with client.stream("GET", url, headers=headers) as response:
+        match = CONTENT_RANGE.match(response.headers.get("content-range", ""))
+        if response.status_code != 206 or match is None or int(match.group(3)) != total:
+            raise DownloadFailed(f"Segment {start}-{end} refusé (HTTP {response.status_code})")
+        written = await _write_body(response, path, start, progress)
+    if written != end - start + 1:
+        raise DownloadFailed(f"Segment {start}-{end} incomplet: {written} octets")
+
+
+def _segments(start: int, total: int, size: int) -> List[Tuple[int, int]]:
+    return [(offset, min(offset + size, total) - 1) for offset in range(start, total, size)]
+
+
+async def _open(client, url: str, segment_size: int, parallel: int, cached_etag: Optional[str]):
+    """Première requête : le premier segment si le serveur gère ``Range``,
+    ou 304 si le contenu en cache (``cached_etag``) est toujours le bon.
 
-    url = http_base_url.rstrip("/") + f"/uploads/{filename}"
-    destination_path = destination_directory / filename
+    ``parallel`` à 1 demande le fichier entier, que le serveur peut alors
+    envoyer compressé (il ne compresse pas les intervalles)."""
+    headers = {"If-None-Match": cached_etag} if cached_etag is not None else {}
+    if parallel > 1:
+        response = await client.send(
+            client.build_request("GET", url, headers={**headers, "Range": f"bytes=0-{segment_size - 1}"}), stream=True
+        )
+        if response.status_code != 416:
+            return response
+        # Fichier vide : aucun octet à demander
+        await response.aclose()
+    return await client.send(client.build_request("GET", url, headers=headers), stream=True)
 
-    async with httpx.AsyncClient(timeout=60) as client:
-        response = await client.get(url)
-        response.raise_for_status()
-        destination_path.write_bytes(response.content)
 
+def _strong_etag(response) -> Optional[str]:
+    etag = response.headers.get("etag")
+    return etag if etag and not etag.startswith("W/") else None
+
+
+async def _download(url: str, destination_path: Path, description: Optional[str]) -> Path:
+    """Télécharge ``url`` dans un fichier temporaire renommé à la fin.
+
+    La première requête demande le premier segment ; si le serveur répond
+    206, le reste du fichier est demandé en segments ``Range`` parallèles,
+    sinon le corps complet (200) est écrit au fil de l'eau. La mémoire
+    utilisée ne dépend pas de la taille du fichier. Un fichier déjà
+    téléchargé et inchangé (même ETag) est copié depuis le cache local
+    sans transférer le corps.
+    """
+    import httpx
+    parallel = max(1, env_int("CHAT_DOWNLOAD_PARALLEL", 4))
+    # Fichier texte : un seul flux, compressé par le serveur, vaut mieux que des segments
+    first_parallel = 1 if is_compressible(destination_path.name) else parallel
+    segment_size = max(READ_SIZE, env_int("CHAT_DOWNLOAD_SEGMENT_SIZE", 8 * 1024 * 1024))
+    progress: Optional[AsyncProgressBar] = None
+    cached = await asyncio.to_thread(download_cache.lookup, url)
+    etag: Optional[str] = None
+    fd, temp_name = tempfile.mkstemp(dir=destination_path.parent, prefix=f".{destination_path.name}.", suffix=".part")
+    os.close(fd)
+    limits = httpx.Limits(max_connections=parallel, max_keepalive_connections=parallel)
+    try:
+        async with httpx.AsyncClient(timeout=httpx.Timeout(60, connect=10), limits=limits) as client:
+            response = await _open(client, url, segment_size, first_parallel, cached[0] if cached else None)
+            try:
+                if response.status_code == 304 and cached is not None:
+                    try:
+                        # Inchangé depuis le dernier téléchargement : copie locale
+                        await asyncio.to_thread(download_cache.restore, cached[0], temp_name)
+                    except FileNotFoundError:
+                        # Copie évincée depuis ``lookup`` (autre client) : corps complet
+                        await response.aclose()
+                        response = await _open(client, url, segment_size, first_parallel, None)
+                    else:
+                        if description is not None:
+                            progress = create_async_progress_bar(cached[1], description)
+                            await progress.set_progress(cached[1])
+                if response.status_code != 304 or cached is None:
+                    response.raise_for_status()
+                    etag = _strong_etag(response)
+                    match = CONTENT_RANGE.match(response.headers.get("content-range", ""))
+                    ranged = response.status_code == 206 and match is not None
+                    length = response.headers.get("content-length")
+                    received = int(length) if length and length.isdigit() else 0
+                    if ranged:
+                        total, expected = int(match.group(3)), int(match.group(2)) + 1
+                    elif received and "content-encoding" not in response.headers:
+                        total = expected = received
+                    else:
+                        # Taille décodée inconnue (corps compressé) : on écrit ce qui arrive
+                        total, expected = 0, None
+                    if description is not None:
+                        # La barre suit les octets transférés (compressés ou non)
+                        progress = create_async_progress_bar(total if ranged else received, description)
+                    await asyncio.to_thread(os.truncate, temp_name, total)
+                    semaphore = asyncio.Semaphore(max(1, parallel - 1))
+
+                    async def fetch(start: int, end: int) -> None:
+                        async with semaphore:
+                            await _fetch_range(client, url, temp_name, start, end, total, progress, etag)
+
+                    # Le reste du fichier arrive pendant qu'on lit le premier segment
+                    rest = [asyncio.create_task(fetch(start, end))
+                            for start, end in (_segments(expected, total, segment_size) if ranged else [])]
+                    try:
+                        written = await _write_body(response, temp_name, 0, progress)
+                        if expected is not None and written != expected:
+                            raise DownloadFailed(f"Téléchargement incomplet: {written}/{expected} octets")
+                        await asyncio.gather(*rest)
+                    except BaseException:
+                        for task in rest:
+                            task.cancel()
+                        await asyncio.gather(*rest, return_exceptions=True)
+                        raise
+            finally:
+                await response.aclose()
+        if etag is not None:
+            try:
+                await asyncio.to_thread(download_cache.store, url, etag, temp_name)
+            except OSError:
+                # Le cache est une optimisation : le téléchargement reste valable
+                pass
+        # mkstemp crée le fichier en 0600 : reprendre les droits habituels
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_name, 0o666 & ~umask)
+        os.replace(temp_name, destination_path)
+    except BaseException:
+        Path(temp_name).unlink(missing_ok=True)
+        raise
+    if progress is not None:
+        await progress.finish()
     return destination_path
 
 
-async def download_file_with_progress(
+async def download_file(
     http_base_url: str, filename: str, destination_dir: str | Path
 ) -> Path:
-    """Download a file from the server's static uploads and save it locally with progress bar."""
-    destination_directory = Path(destination_dir).expanduser().resolve()
-    destination_directory.mkdir(parents=True, exist_ok=True)
+    """Download a file from the server's static uploads and save it locally.
 
-    url = http_base_url.rstrip("/") + f"/uploads/{filename}"
-    destination_path = destination_directory / filename
-
-    async with httpx.AsyncClient(timeout=60) as client:
-        # D'abord, obtenir la taille du fichier
-        head_response = await client.head(url)
-        if head_response.status_code == 200:
-            content_length = head_response.headers.get('content-length')
-            total_size = int(content_length) if content_length else 0
-        else:
-            total_size = 0
-        
-        progress_bar = create_async_progress_bar(total_size, f"Téléchargement de {filename}")
-        
-        response = await client.get(url)
-        response.raise_for_status()
-        
-        # Écrire le fichier
-        destination_path.write_bytes(response.content)
-        
-        # Marquer comme terminé
-        await progress_bar.set_progress(len(response.content))
-        await progress_bar.finish()
-        
-        return destination_path
+    The body is streamed to a temporary file next to the destination and
+    renamed into place once complete, so an interrupted download never
+    leaves a truncated file. Servers that honour ``Range`` get the file in
+    ``CHAT_DOWNLOAD_PARALLEL`` segments of ``CHAT_DOWNLOAD_SEGMENT_SIZE``.
+    Files already downloaded are revalidated with their ETag and copied
+    from the local cache (``CHAT_DOWNLOAD_CACHE_DIR``) when unchanged.
+    """
+    url, destination_path = _prepare(http_base_url, filename, destination_dir)
+    return await _download(url, destination_path, None)
 
 
+async def download_file_with_progress(
+    http_base_url: str, filename: str, destination_dir: str | Path
+) -> Path:
+    """Download a file from the server's static uploads and save it locally with progress bar."""
+    url, destination_path = _prepare(http_base_url, filename, destination_dir)
+    return await _download(url, destination_path, f"Téléchargement de {filename}")
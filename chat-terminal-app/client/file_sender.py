@@ -1,51 +1,247 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
 from pathlib import Path
-import httpx
-from .progress_bar import create_async_progress_bar
+from typing import AsyncIterator, List, Optional, Tuple
 
+from shared.compression import ENCODINGS, MAX_RATIO, MIN_SIZE, compress, is_compressible
+from shared.utils import compute_sha256, env_int
+from .progress_bar import AsyncProgressBar, create_async_progress_bar
 
-async def send_file(http_base_url: str, file_path: str) -> str:
-    """Send a local file to the server via HTTP upload.
+# Tentatives par bloc (erreurs réseau, 5xx, empreinte refusée) avant d'abandonner
+CHUNK_RETRIES = 3
+# Lectures disque pendant l'envoi : seule cette quantité est en mémoire par bloc envoyé
+READ_SIZE = 256 * 1024
 
-    Returns the filename recorded by the server.
-    """
+
+class UploadFailed(Exception):
+    """Le serveur a refusé l'envoi (message d'erreur du serveur)."""
+
+
+def _resolve(file_path: str) -> Path:
     path = Path(file_path).expanduser().resolve()
     if not path.exists() or not path.is_file():
         raise FileNotFoundError(f"Fichier introuvable: {path}")
+    return path
 
-    url = http_base_url.rstrip("/") + "/upload"
-    async with httpx.AsyncClient(timeout=60) as client:
-        with path.open("rb") as fp:
-            files = {"file": (path.name, fp, "application/octet-stream")}
-            response = await client.post(url, files=files)
-            response.raise_for_status()
-            return response.json().get("filename", path.name)
 
+def _check(response) -> dict:
+    """Le corps JSON de la réponse, ou ``UploadFailed`` avec l'erreur du serveur."""
+    if response.status_code >= 400:
+        try:
+            message = response.json().get("error") or response.text
+        except ValueError:
+            message = response.text
+        raise UploadFailed(f"{message} (HTTP {response.status_code})")
+    return response.json()
 
-async def send_file_with_progress(http_base_url: str, file_path: str) -> str:
-    """Send a local file to the server via HTTP upload with progress bar.
 
-    Returns the filename recorded by the server.
+async def _stream(path: Path, offset: int, length: int, progress: Optional[AsyncProgressBar],
+                  sent: List[int]) -> AsyncIterator[bytes]:
+    """Corps de requête lu par morceaux de ``READ_SIZE`` ; la progression
+    avance quand httpx a écrit le morceau sur la connexion."""
+    with path.open("rb") as fp:
+        fp.seek(offset)
+        remaining = length
+        while remaining > 0:
+            data = await asyncio.to_thread(fp.read, min(READ_SIZE, remaining))
+            if not data:
+                raise UploadFailed(f"{path.name} a été modifié pendant l'envoi")
+            remaining -= len(data)
+            yield data
+            sent[0] += len(data)
+            if progress is not None:
+                await progress.update(len(data))
+
+
+def _compress_chunk(path: Path, offset: int, length: int, encoding: str) -> Tuple[str, Optional[bytes]]:
+    """Empreinte du bloc et bloc compressé (None s'il ne gagne pas assez)."""
+    with path.open("rb") as fp:
+        fp.seek(offset)
+        data = fp.read(length)
+    if len(data) != length:
+        raise UploadFailed(f"{path.name} a été modifié pendant l'envoi")
+    body = compress(data, encoding)
+    return hashlib.sha256(data).hexdigest(), (body if len(body) <= length * MAX_RATIO else None)
+
+
+async def _stream_compressed(body: bytes, length: int, progress: Optional[AsyncProgressBar],
+                             sent: List[int]) -> AsyncIterator[bytes]:
+    """Bloc compressé envoyé par morceaux ; la barre avance en octets du fichier."""
+    for start in range(0, len(body), READ_SIZE):
+        end = min(start + READ_SIZE, len(body))
+        yield body[start:end]
+        advanced = length * end // len(body) - sent[0]
+        sent[0] += advanced
+        if progress is not None:
+            await progress.update(advanced)
+
+
+class _ProgressReader:
+    """Fichier dont les lectures (faites par httpx) font avancer la barre."""
+
+    def __init__(self, fp, progress: Optional[AsyncProgressBar]) -> None:
+        self.fp = fp
+        self.progress = progress
+        self.updates: List[asyncio.Task] = []
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fp.read(READ_SIZE if size is None or size < 0 else size)
+        if self.progress is not None and data:
+            # httpx lit sans ``await`` depuis la boucle : la mise à jour y est planifiée
+            self.updates.append(asyncio.ensure_future(self.progress.update(len(data))))
+        return data
+
+
+async def _send_multipart(client, base_url: str, path: Path, progress: Optional[AsyncProgressBar]) -> str:
+    """Envoi en un seul POST, pour les serveurs sans ``/upload/init``."""
+    with path.open("rb") as fp:
+        reader = _ProgressReader(fp, progress)
+        files = {"file": (path.name, reader, "application/octet-stream")}
+        try:
+            response = await client.post(base_url + "/upload", files=files, timeout=None)
+        finally:
+            await asyncio.gather(*reader.updates, return_exceptions=True)
+    return _check(response).get("filename", path.name)
+
+
+async def _send_chunked(
+    client, base_url: str, path: Path, parallel: int, progress: Optional[AsyncProgressBar]
+) -> Optional[str]:
+    """Envoi par blocs vérifiés, repris là où le serveur s'est arrêté.
+
+    Retourne None si le serveur ne connaît pas le protocole par blocs.
     """
-    path = Path(file_path).expanduser().resolve()
-    if not path.exists() or not path.is_file():
-        raise FileNotFoundError(f"Fichier introuvable: {path}")
+    size = path.stat().st_size
+    sha256 = await asyncio.to_thread(compute_sha256, path)
+    response = await client.post(
+        base_url + "/upload/init", json={"filename": path.name, "size": size, "sha256": sha256}
+    )
+    if response.status_code in (404, 405):
+        return None
+    state = _check(response)
+    if state.get("linked"):
+        # Contenu déjà présent sur le serveur : seul le nom a été ajouté
+        if progress is not None:
+            await progress.set_progress(size)
+        return state["filename"]
+    upload_url = f"{base_url}/upload/{state['upload_id']}"
+    chunk_size = state["chunk_size"]
+    # Fichiers texte : blocs compressés si le serveur sait les décoder
+    encoding = None
+    if size >= MIN_SIZE and is_compressible(path.name):
+        encoding = next((name for name in ENCODINGS if name in state.get("encodings", ())), None)
+    # Le serveur décrit les blocs reçus par plages [premier, dernier]
+    received = set()
+    for first, last in state["received_ranges"]:
+        received.update(range(first, last + 1))
+    missing = [index for index in range(state["chunks"]) if index not in received]
+    if progress is not None:
+        # Blocs déjà reçus lors d'un envoi interrompu
+        await progress.set_progress(size - sum(min(chunk_size, size - index * chunk_size) for index in missing))
 
-    file_size = path.stat().st_size
-    progress_bar = create_async_progress_bar(file_size, f"Envoi de {path.name}")
+    semaphore = asyncio.Semaphore(parallel)
+
+    async def put(index: int) -> None:
+        offset = index * chunk_size
+        length = min(chunk_size, size - offset)
+        async with semaphore:
+            body = None
+            if encoding is not None:
+                digest, body = await asyncio.to_thread(_compress_chunk, path, offset, length, encoding)
+            else:
+                digest = await asyncio.to_thread(compute_sha256, path, offset, length)
+            headers = {
+                "X-Chunk-SHA256": digest,
+                "Content-Type": "application/octet-stream",
+                # longueur annoncée : pas d'envoi « chunked » pour le serveur
+                "Content-Length": str(length if body is None else len(body)),
+            }
+            if body is not None:
+                headers["Content-Encoding"] = encoding
+            for attempt in range(1, CHUNK_RETRIES + 1):
+                sent = [0]
+                if body is None:
+                    content = _stream(path, offset, length, progress, sent)
+                else:
+                    content = _stream_compressed(body, length, progress, sent)
+                try:
+                    response = await client.put(
+                        upload_url, params={"offset": offset}, content=content, headers=headers,
+                    )
+                except UploadFailed:
+                    raise
+                except Exception:  # noqa: BLE001 - erreur réseau, on retente
+                    if attempt == CHUNK_RETRIES:
+                        raise
+                else:
+                    if (response.status_code < 500 and response.status_code != 422) or attempt == CHUNK_RETRIES:
+                        _check(response)
+                        break
+                # ces octets seront renvoyés
+                if progress is not None:
+                    await progress.update(-sent[0])
+                await asyncio.sleep(0.5 * attempt)
+
+    tasks = [asyncio.create_task(put(index)) for index in missing]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException as exc:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if isinstance(exc, (asyncio.CancelledError, KeyboardInterrupt)):
+            # Annulé par l'utilisateur : le serveur jette le fichier partiel.
+            # Sur une erreur, les blocs acceptés restent et le prochain /send reprendra.
+            try:
+                await client.delete(upload_url, timeout=5)
+            except Exception:  # noqa: BLE001
+                pass
+        raise
+    # Le serveur relit tout le fichier pour vérifier l'empreinte globale
+    response = await client.post(upload_url + "/finalize", timeout=None)
+    return _check(response).get("filename", path.name)
+
+
+async def _send(http_base_url: str, path: Path, progress: Optional[AsyncProgressBar] = None,
+                token: Optional[str] = None) -> str:
+    import httpx
+    base_url = http_base_url.rstrip("/")
+    parallel = env_int("CHAT_UPLOAD_PARALLEL", 4)
+    limits = httpx.Limits(max_connections=parallel, max_keepalive_connections=parallel)
+    # Le token de session fait enregistrer l'auteur de l'envoi côté serveur
+    headers = {"Authorization": f"Bearer {token}"} if token else None
+    async with httpx.AsyncClient(timeout=httpx.Timeout(60, connect=10), limits=limits, headers=headers) as client:
+        filename = await _send_chunked(client, base_url, path, parallel, progress)
+        if filename is None:
+            filename = await _send_multipart(client, base_url, path, progress)
+    return filename
+
+
+async def send_file(http_base_url: str, file_path: str, token: Optional[str] = None) -> str:
+    """Send a local file to the server via HTTP upload.
 
-    url = http_base_url.rstrip("/") + "/upload"
-    async with httpx.AsyncClient(timeout=60) as client:
-        with path.open("rb") as fp:
-            files = {"file": (path.name, fp, "application/octet-stream")}
-            response = await client.post(url, files=files)
-            response.raise_for_status()
-            
-            # Marquer comme terminé
-            await progress_bar.set_progress(file_size)
-            await progress_bar.finish()
-            
-            return response.json().get("filename", path.name)
+    The file goes in SHA-256 checked chunks, several at a time over pooled
+    connections; after an interruption the next call only sends the
+    chunks the server is missing. Chunks of text-like files are sent
+    compressed when the server accepts it.
 
+    With a session ``token`` the server records who uploaded the file.
 
+    Returns the filename recorded by the server.
+    """
+    return await _send(http_base_url, _resolve(file_path), token=token)
+
+
+async def send_file_with_progress(http_base_url: str, file_path: str, token: Optional[str] = None) -> str:
+    """Send a local file to the server via HTTP upload with progress bar.
+
+    Returns the filename recorded by the server.
+    """
+    path = _resolve(file_path)
+    file_size = path.stat().st_size
+    progress_bar = create_async_progress_bar(file_size, f"Envoi de {path.name}")
+    filename = await _send(http_base_url, path, progress_bar, token)
+    await progress_bar.finish()
+    return filename
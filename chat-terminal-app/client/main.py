@@ -20,6 +20,13 @@ def parse_args() -> argparse.Namespace:
         default="ws://127.0.0.1:8000/ws",
         help="URL WebSocket du serveur (par défaut: ws://127.0.0.1:8000/ws)",
     )
+    parser.add_argument(
+        "--protocol",
+        dest="wire_protocol",
+        choices=["json", "bin", "text"],
+        default="json",
+        help="Format des messages négocié avec le serveur (par défaut: json)",
+    )
     return parser.parse_args()
 
 
@@ -30,7 +37,7 @@ def main() -> None:
         f"  HTTP: {args.http_base_url}\n"
         f"  WS:   {args.websocket_url}\n"
     )
-    asyncio.run(run_chat(args.websocket_url, args.http_base_url))
+    asyncio.run(run_chat(args.websocket_url, args.http_base_url, args.wire_protocol))
 
 
 if __name__ == "__main__":
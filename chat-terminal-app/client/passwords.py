@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from shared.utils import env_int
+
+SCRYPT = "scrypt"
+PBKDF2 = "pbkdf2_sha256"
+
+
+class HasherBusy(Exception):
+    """Too many password hashes are already waiting for the pool."""
+
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii").rstrip("=")
+
+
+def _unb64(text: str) -> bytes:
+    return base64.b64decode(text + "=" * (-len(text) % 4))
+
+
+class PasswordHasher:
+    """Salted KDF password hashes, computed off the event loop.
+
+    Hashes are stored as ``scrypt$n$r$p$salt$hash`` or
+    ``pbkdf2_sha256$iterations$salt$hash``, so the cost travels with each
+    hash and can be raised later: ``needs_rehash`` tells which stored hashes
+    (including the old ``salt$sha256`` ones) should be replaced at the next
+    successful login. The async methods run the KDF in a pool of
+    ``workers`` threads (hashlib releases the GIL while it works), which
+    caps the CPU and memory spent on hashing; past ``max_pending`` queued
+    requests they raise ``HasherBusy`` instead of queueing more.
+    """
+
+    def __init__(
+        self,
+        algorithm: str = SCRYPT,
+        scrypt_n: int = 1 << 14,
+        scrypt_r: int = 8,
+        scrypt_p: int = 1,
+        pbkdf2_iterations: int = 600_000,
+        workers: int = 2,
+        max_pending: int = 64,
+    ) -> None:
+        if algorithm not in (SCRYPT, PBKDF2):
+            algorithm = PBKDF2 if algorithm.startswith("pbkdf2") else SCRYPT
+        if algorithm == SCRYPT and not hasattr(hashlib, "scrypt"):
+            # Python built against an OpenSSL without scrypt
+            algorithm = PBKDF2
+        self.algorithm = algorithm
+        self.scrypt_n = scrypt_n
+        self.scrypt_r = scrypt_r
+        self.scrypt_p = scrypt_p
+        self.pbkdf2_iterations = pbkdf2_iterations
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        self._pending = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    # -- synchronous API ------------------------------------------------------
+
+    def hash(self, password: str) -> str:
+        salt = secrets.token_bytes(16)
+        secret = password.encode("utf-8")
+        if self.algorithm == SCRYPT:
+            n, r, p = self.scrypt_n, self.scrypt_r, self.scrypt_p
+            digest = self._scrypt(secret, salt, n, r, p)
+            return f"{SCRYPT}${n}${r}${p}${_b64(salt)}${_b64(digest)}"
+        iterations = self.pbkdf2_iterations
+        digest = hashlib.pbkdf2_hmac("sha256", secret, salt, iterations)
+        return f"{PBKDF2}${iterations}${_b64(salt)}${_b64(digest)}"
+
+    def verify(self, password: str, password_hash: str) -> bool:
+        parts = password_hash.split("$")
+        secret = password.encode("utf-8")
+        try:
+            if parts[0] == SCRYPT and len(parts) == 6:
+                n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+                expected = _unb64(parts[5])
+                return hmac.compare_digest(self._scrypt(secret, _unb64(parts[4]), n, r, p), expected)
+            if parts[0] == PBKDF2 and len(parts) == 4:
+                expected = _unb64(parts[3])
+                digest = hashlib.pbkdf2_hmac("sha256", secret, _unb64(parts[2]), int(parts[1]))
+                return hmac.compare_digest(digest, expected)
+            if len(parts) == 2:
+                # Legacy: sha256(password + salt), hex encoded
+                salt, hash_value = parts
+                digest = hashlib.sha256((password + salt).encode("utf-8")).hexdigest()
+                return hmac.compare_digest(digest, hash_value)
+        except (ValueError, TypeError):
+            pass
+        return False
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        parts = password_hash.split("$")
+        if self.algorithm == SCRYPT:
+            return parts[:4] != [SCRYPT, str(self.scrypt_n), str(self.scrypt_r), str(self.scrypt_p)]
+        return parts[:2] != [PBKDF2, str(self.pbkdf2_iterations)]
+
+    @staticmethod
+    def _scrypt(secret: bytes, salt: bytes, n: int, r: int, p: int) -> bytes:
+        # OpenSSL's default 32 MiB cap is just short of what n=2^14, r=8 needs
+        maxmem = 128 * n * r * (p + 2) + (1 << 20)
+        return hashlib.scrypt(secret, salt=salt, n=n, r=r, p=p, maxmem=maxmem, dklen=32)
+
+    # -- off-loop API ---------------------------------------------------------
+
+    async def _run(self, function, *args):
+        if self._pending >= self.max_pending:
+            raise HasherBusy()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hash")
+        self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+        finally:
+            self._pending -= 1
+
+    async def hash_async(self, password: str) -> str:
+        return await self._run(self.hash, password)
+
+    async def verify_async(self, password: str, password_hash: str) -> bool:
+        return await self._run(self.verify, password, password_hash)
+
+    def stats(self) -> dict:
+        return {
+            "algorithm": self.algorithm,
+            "workers": self.workers,
+            "pending": self._pending,
+            "max_pending": self.max_pending,
+        }
+
+
+def create_password_hasher() -> PasswordHasher:
+    """Build the hasher configured by the ``CHAT_KDF*``/``CHAT_HASH_*`` variables."""
+    return PasswordHasher(
+        algorithm=os.environ.get("CHAT_KDF", SCRYPT),
+        scrypt_n=env_int("CHAT_KDF_SCRYPT_N", 1 << 14),
+        scrypt_r=env_int("CHAT_KDF_SCRYPT_R", 8),
+        scrypt_p=env_int("CHAT_KDF_SCRYPT_P", 1),
+        pbkdf2_iterations=env_int("CHAT_KDF_PBKDF2_ITERATIONS", 600_000),
+        workers=env_int("CHAT_HASH_WORKERS", min(4, os.cpu_count() or 1)),
+        max_pending=env_int("CHAT_HASH_MAX_PENDING", 64),
+    )
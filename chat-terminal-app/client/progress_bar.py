@@ -8,6 +8,21 @@ from datetime import datetime
 
 from .theme_manager import get_color
 
+
+def format_size(size_bytes: float) -> str:
+    """Formate une taille en bytes en format lisible."""
+    if size_bytes == 0:
+        return "0 B"
+
+    size_names = ["B", "KB", "MB", "GB", "TB"]
+    i = 0
+    while size_bytes >= 1024 and i < len(size_names) - 1:
+        size_bytes /= 1024.0
+        i += 1
+
+    return f"{size_bytes:.1f} {size_names[i]}"
+
+
 class ProgressBar:
     """Barre de progression pour les uploads et downloads."""
     
@@ -84,16 +99,7 @@ class ProgressBar:
     
     def _format_size(self, size_bytes: float) -> str:
         """Formate une taille en bytes en format lisible."""
-        if size_bytes == 0:
-            return "0 B"
-        
-        size_names = ["B", "KB", "MB", "GB", "TB"]
-        i = 0
-        while size_bytes >= 1024 and i < len(size_names) - 1:
-            size_bytes /= 1024.0
-            i += 1
-        
-        return f"{size_bytes:.1f} {size_names[i]}"
+        return format_size(size_bytes)
     
     def _format_time(self, seconds: float) -> str:
         """Formate un temps en secondes en format lisible."""
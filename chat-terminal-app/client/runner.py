@@ -3,7 +3,6 @@ from __future__ import annotations
 from pathlib import Path
 from typing import List, Dict, Any
 
-import httpx
 
 
 async def run_code(http_base_url: str, language: str, file_path: str, args: List[str] | None = None, stdin_text: str | None = None) -> Dict[str, Any]:
@@ -23,6 +22,7 @@ async def run_code(http_base_url: str, language: str, file_path: str, args: List
     }
 
     url = http_base_url.rstrip("/") + "/run"
+    import httpx
     async with httpx.AsyncClient(timeout=60) as client:
         response = await client.post(url, json=payload)
         response.raise_for_status()
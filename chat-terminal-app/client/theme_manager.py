@@ -38,11 +38,33 @@ class ThemeManager:
     
     def __init__(self, config_dir: str = ".config"):
         self.config_dir = Path(config_dir)
-        self.config_dir.mkdir(exist_ok=True)
         self.config_file = self.config_dir / "theme_config.json"
-        self.current_theme = "default"
-        self.themes = self._load_default_themes()
-        self._load_config()
+        self._current_theme = "default"
+        # Thème choisi avant le chargement : la configuration ne l'écrase pas
+        self._theme_set = False
+        self._themes: Optional[Dict[str, ThemeColors]] = None
+    
+    def _ensure_loaded(self) -> Dict[str, ThemeColors]:
+        """Charge les thèmes et la configuration au premier appel."""
+        if self._themes is None:
+            self._themes = self._load_default_themes()
+            self._load_config()
+        return self._themes
+    
+    @property
+    def themes(self) -> Dict[str, ThemeColors]:
+        """Thèmes disponibles, chargés avec la configuration au premier accès."""
+        return self._ensure_loaded()
+    
+    @property
+    def current_theme(self) -> str:
+        self._ensure_loaded()
+        return self._current_theme
+    
+    @current_theme.setter
+    def current_theme(self, theme_name: str) -> None:
+        self._current_theme = theme_name
+        self._theme_set = True
     
     def _load_default_themes(self) -> Dict[str, ThemeColors]:
         """Charge les thèmes par défaut."""
@@ -130,12 +152,13 @@ class ThemeManager:
             try:
                 with open(self.config_file, 'r', encoding='utf-8') as f:
                     config = json.load(f)
-                    self.current_theme = config.get('current_theme', 'default')
+                    if not self._theme_set:
+                        self._current_theme = config.get('current_theme', 'default')
                     
                     # Charger les thèmes personnalisés
                     custom_themes = config.get('custom_themes', {})
                     for theme_name, theme_data in custom_themes.items():
-                        self.themes[theme_name] = ThemeColors(**theme_data)
+                        self._themes[theme_name] = ThemeColors(**theme_data)
             except Exception as e:
                 print(f"Erreur lors du chargement de la configuration: {e}")
     
@@ -152,6 +175,7 @@ class ThemeManager:
                 if theme_name not in ['default', 'dark', 'light', 'neon', 'monochrome']:
                     config['custom_themes'][theme_name] = asdict(theme_colors)
             
+            self.config_dir.mkdir(exist_ok=True)
             with open(self.config_file, 'w', encoding='utf-8') as f:
                 json.dump(config, f, indent=2, ensure_ascii=False)
         except Exception as e:
@@ -196,7 +220,7 @@ class ThemeManager:
             return True
         return False
 
-# Instance globale du gestionnaire de thèmes
+# Instance globale du gestionnaire de thèmes (configuration lue au premier usage)
 theme_manager = ThemeManager()
 
 def get_color(color_name: str) -> str:
@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokens (
+    token TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tokens_expiry ON tokens (expires_at);
+CREATE INDEX IF NOT EXISTS tokens_user ON tokens (username, created_at);
+"""
+
+
+class TokenEntry:
+    __slots__ = ("token", "username", "created_at", "expires_at")
+
+    def __init__(self, token: str, username: str, created_at: float, expires_at: float) -> None:
+        self.token = token
+        self.username = username
+        self.created_at = created_at
+        self.expires_at = expires_at
+
+
+class TokenStore:
+    """Active JWTs in SQLite, indexed by token, by user and by expiry.
+
+    Issuing or revoking a token writes that row only, and a lookup is a
+    primary-key read, so neither depends on how many tokens have piled up.
+    Expired tokens are removed in bulk by a sweeper thread every
+    ``sweep_interval`` seconds with one range delete on the expiry index.
+    A user keeps at most ``per_user`` tokens: issuing one more evicts the
+    oldest. The database is the only copy (nothing is cached), so a logout
+    or an eviction on one server worker is seen at once by the others.
+    """
+
+    def __init__(self, path: Path, per_user: int = 5, sweep_interval: float = 60.0) -> None:
+        self.path = Path(path)
+        self.per_user = per_user
+        self.sweep_interval = sweep_interval
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(str(self.path), timeout=10.0, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        self._stop = threading.Event()
+        self._sweeper: Optional[threading.Thread] = None
+        self.sweep()
+
+    # -- tokens ---------------------------------------------------------------
+
+    def issue(self, token: str, username: str, expires_at: float) -> List[str]:
+        """Record a new token; returns the tokens evicted by the per-user cap."""
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO tokens (token, username, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                (token, username, time.time(), expires_at),
+            )
+            return [row[0] for row in self._db.execute(
+                "DELETE FROM tokens WHERE username = ? AND token NOT IN ("
+                " SELECT token FROM tokens WHERE username = ? ORDER BY created_at DESC LIMIT ?"
+                ") RETURNING token",
+                (username, username, self.per_user),
+            ).fetchall()]
+
+    def get(self, token: str) -> Optional[TokenEntry]:
+        """The live entry for ``token``, or None if unknown, revoked or expired."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT token, username, created_at, expires_at FROM tokens WHERE token = ?", (token,)
+            ).fetchone()
+        if row is None or row[3] <= time.time():
+            return None
+        return TokenEntry(*row)
+
+    def revoke(self, token: str) -> bool:
+        with self._lock, self._db:
+            return self._db.execute("DELETE FROM tokens WHERE token = ?", (token,)).rowcount > 0
+
+    def revoke_user(self, username: str) -> int:
+        with self._lock, self._db:
+            return self._db.execute("DELETE FROM tokens WHERE username = ?", (username,)).rowcount
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM tokens").fetchone()[0]
+
+    # -- expiry ---------------------------------------------------------------
+
+    def sweep(self, now: Optional[float] = None, batch: int = 1000) -> int:
+        """Drop every expired token; returns how many were deleted.
+
+        Deletes ``batch`` rows per transaction so a large backlog never
+        holds up logins for long.
+        """
+        now = time.time() if now is None else now
+        deleted = 0
+        while True:
+            with self._lock, self._db:
+                count = self._db.execute(
+                    "DELETE FROM tokens WHERE token IN ("
+                    " SELECT token FROM tokens WHERE expires_at <= ? LIMIT ?)",
+                    (now, batch),
+                ).rowcount
+            deleted += count
+            if count < batch:
+                return deleted
+
+    def start(self) -> None:
+        """Run ``sweep`` every ``sweep_interval`` seconds in a daemon thread."""
+        if self._sweeper is not None:
+            return
+        self._stop.clear()
+        self._sweeper = threading.Thread(target=self._sweep_loop, name="token-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def _sweep_loop(self) -> None:
+        while not self._stop.wait(self.sweep_interval):
+            try:
+                self.sweep()
+            except sqlite3.Error as e:
+                print(f"Erreur lors de la purge des tokens: {e}")
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._sweeper is not None:
+            self._sweeper.join()
+            self._sweeper = None
+
+    # -- migration ------------------------------------------------------------
+
+    def import_json(self, path: Path) -> int:
+        """Import the still valid tokens of a legacy ``tokens.json``."""
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        now = time.time()
+        imported = 0
+        for token, info in sorted(data.items(), key=lambda item: item[1].get("created_at", "")):
+            expires_at = datetime.fromisoformat(info["expires_at"]).timestamp()
+            if expires_at > now:
+                self.issue(token, info["username"], expires_at)
+                imported += 1
+        return imported
+
+
+class VerifiedTokenCache:
+    """LRU of tokens whose signature and store entry were already checked.
+
+    Maps a token to ``(username, expires_at, checked_at)`` for at most
+    ``capacity`` tokens. ``get`` drops expired tokens and reports a miss
+    for entries checked more than ``recheck`` seconds ago, so a token
+    revoked by another process stops working within ``recheck`` seconds;
+    revocations in this process call ``discard`` and take effect at once.
+    """
+
+    def __init__(self, capacity: int = 10_000, recheck: float = 5.0) -> None:
+        self.capacity = capacity
+        self.recheck = recheck
+        self._entries: "OrderedDict[str, Tuple[str, float, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str, now: float) -> Optional[str]:
+        """The cached username, or None if the token must be verified again."""
+        entry = self._entries.get(token)
+        if entry is None:
+            self.misses += 1
+            return None
+        username, expires_at, checked_at = entry
+        if expires_at <= now:
+            del self._entries[token]
+            self.misses += 1
+            return None
+        if checked_at + self.recheck <= now:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(token)
+        self.hits += 1
+        return username
+
+    def put(self, token: str, username: str, expires_at: float, now: float) -> None:
+        self._entries[token] = (username, expires_at, now)
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def discard(self, token: str) -> None:
+        self._entries.pop(token, None)
+
+    def discard_user(self, username: str) -> None:
+        for token in [token for token, entry in self._entries.items() if entry[0] == username]:
+            del self._entries[token]
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+
+@dataclass
+class User:
+    """Structure pour représenter un utilisateur."""
+    username: str
+    password_hash: str
+    email: Optional[str] = None
+    created_at: Optional[datetime] = None
+    last_login: Optional[datetime] = None
+    permissions: list[str] = None
+    is_active: bool = True
+
+    def __post_init__(self):
+        if self.created_at is None:
+            self.created_at = datetime.now()
+        if self.permissions is None:
+            self.permissions = ["user"]
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password_hash TEXT NOT NULL,
+    email TEXT,
+    created_at TEXT NOT NULL,
+    last_login TEXT,
+    permissions TEXT NOT NULL,
+    is_active INTEGER NOT NULL DEFAULT 1
+) WITHOUT ROWID
+"""
+
+_COLUMNS = "username, password_hash, email, created_at, last_login, permissions, is_active"
+
+
+def _to_row(user: User) -> tuple:
+    return (
+        user.username,
+        user.password_hash,
+        user.email,
+        user.created_at.isoformat(),
+        user.last_login.isoformat() if user.last_login else None,
+        json.dumps(user.permissions),
+        int(user.is_active),
+    )
+
+
+def _from_row(row: tuple) -> User:
+    username, password_hash, email, created_at, last_login, permissions, is_active = row
+    return User(
+        username=username,
+        password_hash=password_hash,
+        email=email,
+        created_at=datetime.fromisoformat(created_at),
+        last_login=datetime.fromisoformat(last_login) if last_login else None,
+        permissions=json.loads(permissions),
+        is_active=bool(is_active),
+    )
+
+
+class UserStore:
+    """Users in SQLite, read on demand and written one row at a time.
+
+    Lookups go through the primary key and the ``cache_size`` users most
+    recently seen are kept in memory, so nothing is parsed up front and a
+    login never touches the other accounts. The cache is dropped whenever
+    another connection (another server worker, the client) has committed
+    to the database, as told by ``PRAGMA data_version``. Account changes
+    (creation, deletion, password) are committed immediately;
+    ``last_login`` is write-behind: logins only mark the user dirty and a
+    timer commits every pending timestamp in one transaction
+    ``flush_interval`` seconds later (or on ``flush()`` / ``close()``). A
+    crash can lose at most those timestamps, never an account. The
+    database is in WAL mode, so the server workers and the client can
+    share it.
+    """
+
+    def __init__(self, path: Path, flush_interval: float = 2.0, cache_size: int = 10_000) -> None:
+        self.path = Path(path)
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(str(self.path), timeout=10.0, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(_SCHEMA)
+        self._db.commit()
+        self._cache: "OrderedDict[str, User]" = OrderedDict()
+        self._data_version = self._version()
+        self._dirty: Dict[str, str] = {}
+        self._timer: Optional[threading.Timer] = None
+
+    # -- lookups --------------------------------------------------------------
+
+    def get(self, username: str) -> Optional[User]:
+        with self._lock:
+            version = self._version()
+            if version != self._data_version:
+                # changed by another connection: what we hold may be stale
+                self._data_version = version
+                self._cache.clear()
+            user = self._cache.get(username)
+            if user is not None:
+                self._cache.move_to_end(username)
+                return user
+            row = self._db.execute(
+                f"SELECT {_COLUMNS} FROM users WHERE username = ?", (username,)
+            ).fetchone()
+            if row is None:
+                return None
+            user = _from_row(row)
+            self._remember(user)
+            return user
+
+    def _version(self) -> int:
+        return self._db.execute("PRAGMA data_version").fetchone()[0]
+
+    def _remember(self, user: User) -> None:
+        self._cache[user.username] = user
+        self._cache.move_to_end(user.username)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def __contains__(self, username: str) -> bool:
+        return self.get(username) is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def usernames(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._db.execute("SELECT username FROM users ORDER BY username")]
+
+    # -- writes ---------------------------------------------------------------
+
+    def add(self, user: User) -> bool:
+        """Create an account; False if the name is taken."""
+        with self._lock:
+            try:
+                with self._db:
+                    self._db.execute(f"INSERT INTO users ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)", _to_row(user))
+            except sqlite3.IntegrityError:
+                return False
+            self._remember(user)
+            return True
+
+    def save(self, user: User) -> None:
+        """Write every field of an existing account now."""
+        with self._lock:
+            self._dirty.pop(user.username, None)
+            with self._db:
+                self._db.execute(f"INSERT OR REPLACE INTO users ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)", _to_row(user))
+            self._remember(user)
+
+    def delete(self, username: str) -> bool:
+        with self._lock:
+            self._cache.pop(username, None)
+            self._dirty.pop(username, None)
+            with self._db:
+                return self._db.execute("DELETE FROM users WHERE username = ?", (username,)).rowcount > 0
+
+    def touch_login(self, user: User, when: datetime) -> None:
+        """Record a login; written with the next batch, not now."""
+        with self._lock:
+            user.last_login = when
+            self._dirty[user.username] = when.isoformat()
+            if self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self) -> None:
+        """Commit the pending ``last_login`` updates in one transaction."""
+        with self._lock:
+            self._timer = None
+            if not self._dirty:
+                return
+            pending = [(when, username) for username, when in self._dirty.items()]
+            self._dirty.clear()
+            with self._db:
+                self._db.executemany("UPDATE users SET last_login = ? WHERE username = ?", pending)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self.flush()
+            self._db.close()
+
+    # -- migration ------------------------------------------------------------
+
+    def import_json(self, path: Path) -> int:
+        """Import a legacy ``users.json`` in one transaction; returns the count.
+
+        Names already in the database are kept as they are, so importing
+        twice is harmless.
+        """
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        rows = []
+        for username, user_data in data.items():
+            user_data["created_at"] = datetime.fromisoformat(user_data["created_at"])
+            if user_data.get("last_login"):
+                user_data["last_login"] = datetime.fromisoformat(user_data["last_login"])
+            user_data["username"] = username
+            rows.append(_to_row(User(**user_data)))
+        with self._lock, self._db:
+            cursor = self._db.executemany(
+                f"INSERT OR IGNORE INTO users ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            return cursor.rowcount
@@ -0,0 +1,20 @@
+# Lets pytest import the server, client and shared packages from the project root.
+
+
+def pytest_addoption(parser):
+    parser.addoption("--slow", action="store_true", help="also run the long tests (100k-cycle churn)")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "slow: long test, only run with --slow")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--slow"):
+        return
+    import pytest
+
+    skip = pytest.mark.skip(reason="long test: run with --slow")
+    for item in items:
+        if "slow" in item.keywords:
+            item.add_marker(skip)
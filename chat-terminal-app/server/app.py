@@ -1,31 +1,102 @@
 from __future__ import annotations
 
+import asyncio
 import os
+import re
 import subprocess
 import tempfile
+import time
+from datetime import datetime
+from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import Any
 
-from fastapi import FastAPI, File, UploadFile, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, File, Request, UploadFile, WebSocket, WebSocketDisconnect
 from fastapi.responses import JSONResponse
-from fastapi.staticfiles import StaticFiles
+from starlette.requests import ClientDisconnect
 
 from .websocket_handler import manager
-from .file_handler import save_upload_file
+from .bus import create_bus
+from .history import create_history
+from .search import SearchIndex
+from .presence import PresenceService
+from .rate_limit import Traffic, create_rate_limiter
+from .sessions import Session, SessionRegistry
+from shared import protocol
+from .file_handler import create_upload_storage
+from .catalog import create_file_catalog, describe
+from .file_response import stored_file_response
+from .variants import create_compressed_variants
+from .chunked_upload import UploadError, create_chunked_uploads
 from .executor import execute
-from client.auth_manager import AuthManager
+from client.auth_manager import auth_manager as auth
+from client.passwords import HasherBusy
 
-app = FastAPI(title="Chat Terminal Server", version="1.0.0")
-auth = AuthManager()
+# Cross-connection delivery and presence, shared by all workers (CHAT_BUS)
+bus = create_bus()
+# This worker's connections, the users signed in on them and their state
+sessions = SessionRegistry()
+# Online users and room members, pushed to subscribed clients as deltas
+presence = PresenceService(manager, sessions.presence_subscribers)
+bus.on_presence = presence.update
+# Token buckets per connection and per user (CHAT_RATE_*)
+limiter = create_rate_limiter()
+# Chat history (CHAT_HISTORY_*): recent messages in memory, the rest on disk
+history = create_history()
+search_index = SearchIndex(history)
 
-# Track authenticated users for each websocket
-authed_usernames: dict[WebSocket, str] = {}
-username_to_connections: dict[str, set[WebSocket]] = {}
 
-# Mount static files for uploads
-uploads_dir = Path("uploads")
-uploads_dir.mkdir(exist_ok=True)
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    auth.open()
+    await asyncio.to_thread(storage.open)
+    await asyncio.to_thread(variants.open)
+    await catalog.refresh(force=True)
+    await chunked_uploads.open()
+    await history.open()
+    # Keep numbering the stream where the log stopped.
+    bus.last_seq = max(bus.last_seq, history.last_seq)
+    search_index.start()
+    await bus.start(_deliver)
+    try:
+        yield
+    finally:
+        await bus.stop()
+        # Last writes first: the segments they seal are indexed by stop()
+        await asyncio.to_thread(history.close)
+        await search_index.stop()
+        await chunked_uploads.close()
+        variants.close()
+        storage.close()
+        auth.users.flush()
+
+
+app = FastAPI(title="Chat Terminal Server", version="1.0.0", lifespan=lifespan)
+
+# Room names accepted by /join (an optional leading "#" is ignored)
+ROOM_NAME = re.compile(r"^[\w-]{1,32}$")
+
+# /history and /backfill limits
+HISTORY_DEFAULT = 20
+HISTORY_MAX = 200
+BACKFILL_MAX = 500
+HISTORY_SINCE = re.compile(r"^(\d+)([smhj])$")
+HISTORY_UNITS = {"s": 1, "m": 60, "h": 3600, "j": 86400}
+SEARCH_LIMIT = 20
+
+# /files page sizes
+FILES_DEFAULT = 100
+FILES_MAX = 1000
+
+# Uploaded files (CHAT_UPLOADS_DIR): one blob per content, served by name
+# from /uploads/<name>; opened at startup (lifespan), not at import
+storage = create_upload_storage()
+# Their metadata in memory, for /files (pagination, filters, changes)
+catalog = create_file_catalog(storage)
+# Resumable uploads (CHAT_UPLOAD_*), partial files kept next to the root
+chunked_uploads = create_chunked_uploads(storage)
+# Compressed copies of text-like files for downloads (CHAT_COMPRESS_*)
+variants = create_compressed_variants(storage)
 
 
 @app.get("/health")
@@ -34,49 +105,428 @@ async def health() -> dict:
     return {"status": "healthy", "service": "chat-terminal-server"}
 
 
+@app.get("/stats")
+async def stats() -> dict:
+    """Runtime counters (outbound queues) to tune the server limits."""
+    return {
+        "worker": bus.worker_id,
+        "connections": manager.stats(),
+        "sessions": sessions.stats(),
+        "rate_limits": limiter.stats(),
+        "password_hashing": auth.hasher.stats(),
+        "token_cache": auth.verified.stats(),
+        "uploads": chunked_uploads.stats(),
+        "storage": await asyncio.to_thread(storage.stats),
+        "compression": variants.stats(),
+    }
+
+
+async def _http_account(request: Request):
+    """The account whose session token comes with an HTTP request, if any."""
+    scheme, _, credentials = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not credentials.strip():
+        return None
+    return await auth.verify_token_async(credentials.strip())
+
+
+async def _http_user(request: Request) -> str | None:
+    """The user whose session token comes with an HTTP request, if any."""
+    user = await _http_account(request)
+    return user.username if user is not None else None
+
+
+def _timestamp(value: str | None) -> float | None:
+    """Epoch seconds or an ISO 8601 date/time, as sent to /files."""
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
 @app.post("/upload")
-async def upload_file(file: UploadFile = File(...)) -> JSONResponse:
+async def upload_file(request: Request, file: UploadFile = File(...)) -> JSONResponse:
     """Upload a file to the server."""
     try:
-        filename = await save_upload_file(file)
+        filename = await storage.save(file, await _http_user(request))
+        await catalog.refresh(force=True)
         return JSONResponse(
             content={"message": "File uploaded successfully", "filename": filename.name},
             status_code=200,
         )
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
     except Exception as e:
         return JSONResponse(
             content={"error": f"Upload failed: {str(e)}"}, status_code=500
         )
 
 
+def _upload_error(e: UploadError) -> JSONResponse:
+    return JSONResponse(content={"error": e.message}, status_code=e.status)
+
+
+@app.post("/upload/init")
+async def upload_init(payload: dict, request: Request) -> JSONResponse:
+    """Start or resume a chunked upload; returns the chunks already received."""
+    try:
+        size = int(payload.get("size", -1))
+        chunk_size = int(payload["chunk_size"]) if payload.get("chunk_size") else None
+        state = await chunked_uploads.init(
+            str(payload.get("filename", "")), size, str(payload.get("sha256", "")), chunk_size,
+            await _http_user(request),
+        )
+        if state.get("linked"):
+            await catalog.refresh(force=True)
+    except (TypeError, ValueError):
+        return JSONResponse(content={"error": "Requête d'upload invalide"}, status_code=400)
+    except UploadError as e:
+        return _upload_error(e)
+    return JSONResponse(content=state, status_code=200)
+
+
+@app.put("/upload/{upload_id}")
+async def upload_chunk(upload_id: str, offset: int, request: Request) -> JSONResponse:
+    """Store one chunk at ``offset``; ``X-Chunk-SHA256`` is its SHA-256.
+
+    The body may be compressed (``Content-Encoding``, one of the
+    ``encodings`` returned by /upload/init); the hash is that of the
+    decoded bytes.
+    """
+    declared = request.headers.get("content-length")
+    if declared is not None and declared.isdigit() and int(declared) > chunked_uploads.max_chunk_size:
+        return JSONResponse(content={"error": "Bloc trop volumineux"}, status_code=413)
+    try:
+        result = await chunked_uploads.put_chunk(
+            upload_id, offset, request.stream(), request.headers.get("x-chunk-sha256", ""),
+            request.headers.get("content-encoding"),
+        )
+    except UploadError as e:
+        return _upload_error(e)
+    except ClientDisconnect:
+        # the client gave up (Ctrl+C); the chunk was not recorded
+        return JSONResponse(content={"error": "Bloc interrompu"}, status_code=400)
+    return JSONResponse(content=result, status_code=200)
+
+
+@app.get("/upload/{upload_id}")
+async def upload_status(upload_id: str) -> JSONResponse:
+    """Chunks received so far, to resume an interrupted upload."""
+    try:
+        return JSONResponse(content=await chunked_uploads.status(upload_id), status_code=200)
+    except UploadError as e:
+        return _upload_error(e)
+
+
+@app.post("/upload/{upload_id}/finalize")
+async def upload_finalize(upload_id: str) -> JSONResponse:
+    """Check the whole file against its SHA-256 and publish it in uploads/."""
+    try:
+        stored = await chunked_uploads.finalize(upload_id)
+    except UploadError as e:
+        return _upload_error(e)
+    await catalog.refresh(force=True)
+    return JSONResponse(
+        content={"message": "File uploaded successfully", "filename": stored.name},
+        status_code=200,
+    )
+
+
+@app.delete("/upload/{upload_id}")
+async def upload_abort(upload_id: str) -> JSONResponse:
+    """Drop an upload in progress and its partial file."""
+    try:
+        await chunked_uploads.abort(upload_id)
+    except UploadError as e:
+        return _upload_error(e)
+    return JSONResponse(content={"message": "Upload aborted"}, status_code=200)
+
+
 @app.get("/files")
-async def list_files() -> dict:
-    """List all uploaded files."""
+async def list_files(
+    limit: int = FILES_DEFAULT,
+    cursor: str | None = None,
+    sort: str = "name",
+    order: str = "asc",
+    prefix: str = "",
+    min_size: int | None = None,
+    max_size: int | None = None,
+    after: str | None = None,
+    before: str | None = None,
+    since: int | None = None,
+) -> JSONResponse:
+    """List uploaded files with their metadata, one page at a time.
+
+    ``files`` keeps the bare names for older clients; ``next_cursor``
+    fetches the following page. With ``since=<seq>``, only the names
+    written or deleted after that sequence number are returned.
+    """
+    await catalog.refresh()
+    if since is not None:
+        return JSONResponse(content=catalog.changed_since(since), status_code=200)
     try:
-        files = []
-        for file_path in uploads_dir.iterdir():
-            if file_path.is_file():
-                files.append(file_path.name)
-        return {"files": sorted(files)}
-    except Exception as e:
-        return {"error": f"Failed to list files: {str(e)}"}
+        entries, next_cursor = catalog.query(
+            sort=sort,
+            descending=order.lower() == "desc",
+            limit=max(1, min(limit, FILES_MAX)),
+            cursor=cursor,
+            prefix=prefix,
+            min_size=min_size,
+            max_size=max_size,
+            after=_timestamp(after),
+            before=_timestamp(before),
+        )
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    return JSONResponse(
+        content={
+            "files": [entry.name for entry in entries],
+            "entries": [describe(entry) for entry in entries],
+            "next_cursor": next_cursor,
+            "total": len(catalog),
+            "seq": catalog.seq,
+        },
+        status_code=200,
+    )
+
+
+@app.delete("/files/{name}")
+async def delete_file(name: str, request: Request) -> JSONResponse:
+    """Remove a file name; its content goes once no other name uses it.
+
+    Only the user who sent the file, or an admin, may delete it.
+    """
+    user = await _http_account(request)
+    if user is None:
+        return JSONResponse(content={"error": "Authentification requise"}, status_code=401)
+    # the owner may have changed on another worker since the last refresh
+    await catalog.refresh(force=True)
+    entry = catalog.get(name)
+    if entry is None:
+        return JSONResponse(content={"error": "Fichier introuvable"}, status_code=404)
+    if entry.uploader != user.username and "admin" not in user.permissions:
+        return JSONResponse(content={"error": "Seul l'auteur de l'envoi peut supprimer ce fichier"}, status_code=403)
+    if not await asyncio.to_thread(storage.delete, name):
+        return JSONResponse(content={"error": "Fichier introuvable"}, status_code=404)
+    await catalog.refresh(force=True)
+    return JSONResponse(content={"message": "File deleted", "filename": name}, status_code=200)
+
+
+@app.api_route("/uploads/{name}", methods=["GET", "HEAD"])
+async def download_file(name: str, request: Request):
+    """Serve a stored file by its name (ETag, conditional GET, byte ranges, compression)."""
+    await catalog.refresh()
+    for attempt in range(2):
+        entry = catalog.get(name)
+        if entry is not None:
+            try:
+                return await stored_file_response(request, entry, storage.blob_path(entry), variants)
+            except FileNotFoundError:
+                # re-bound by another worker and its old blob collected
+                pass
+        if attempt == 0:
+            # the catalog may be up to ``ttl`` seconds behind the other workers
+            await catalog.refresh(force=True)
+    return JSONResponse(content={"detail": "Not Found"}, status_code=404)
+
+
+async def _deliver(message: dict) -> None:
+    """Deliver a bus message to the connections held by this worker."""
+    event = message.get("event")
+    if message["op"] == "room":
+        if event.type == protocol.CHAT:
+            record = history.record(event, persist=bus.is_sequencer)
+            if record is not None:
+                search_index.add(record)
+        excluded = None
+        if message.get("origin") == bus.worker_id:
+            excluded = manager.connection(message.get("exclude"))
+        await manager.broadcast_event(event, excluded, message["room"])
+    elif message["op"] == "user":
+        targets = sessions.connections(message["user"])
+        if targets:
+            await manager.send_many(targets, event)
+    elif message["op"] == "revoke":
+        # Without this, the token would still pass /resume here until the
+        # cache rechecks it.
+        await auth.forget_token_async(message["token"])
+        for session in sessions.with_token(message["token"]):
+            await _sign_out(session)
+            await manager.send_event(
+                session.websocket, protocol.error("Session révoquée, reconnectez-vous avec /login <user> <pass>"),
+            )
+
+
+async def _publish_room(room: str, event: protocol.Event, excluded: WebSocket | None = None) -> None:
+    await bus.publish({
+        "op": "room",
+        "room": room,
+        "event": event,
+        "exclude": id(excluded) if excluded is not None else None,
+    })
+
+
+async def _join_room(session: Session, room: str) -> bool:
+    if not manager.join_room(session.websocket, room):
+        return False
+    session.joined_at_seq[room] = history.last_seq
+    await bus.presence(session.username, 1, room)
+    return True
+
+
+async def _leave_room(session: Session, room: str) -> bool:
+    if not manager.leave_room(session.websocket, room):
+        return False
+    session.joined_at_seq.pop(room, None)
+    await bus.presence(session.username, -1, room)
+    return True
+
+
+async def _sign_in(session: Session, username: str, token: str | None = None) -> None:
+    sessions.sign_in(session, username, token)
+    await bus.presence(username, 1)
+    await _join_room(session, protocol.DEFAULT_ROOM)
+
+
+async def _resume(session: Session, token: str) -> bool:
+    """Sign a connection in with a token from an earlier /login."""
+    user = await auth.verify_token_async(token)
+    if user is None:
+        await manager.send_event(session.websocket, protocol.error("Session expirée, reconnectez-vous avec /login <user> <pass>"))
+        return False
+    if session.username != user.username or session.token != token:
+        await _sign_out(session)
+        await _sign_in(session, user.username, token)
+    await manager.send_event(session.websocket, protocol.session(user.username, token))
+    return True
+
+
+def _handshake_token(websocket: WebSocket) -> str | None:
+    """Token sent with the upgrade request (``Authorization: Bearer`` or ``?token=``)."""
+    scheme, _, credentials = websocket.headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and credentials.strip():
+        return credentials.strip()
+    return websocket.query_params.get("token") or None
+
+
+async def _sign_out(session: Session) -> str | None:
+    """Detach the user from this connection, then announce it."""
+    # Local state first, without yielding to the loop in between.
+    username = sessions.sign_out(session)
+    if username is None:
+        return None
+    rooms = manager.leave_all_rooms(session.websocket)
+    if not sessions.has_connections(username):
+        limiter.forget_user(username)
+    for room in rooms:
+        await bus.presence(username, -1, room)
+    await bus.presence(username, -1)
+    return username
+
+
+async def _revoke(token: str) -> None:
+    """Revoke ``token`` and sign out the connections still using it, on every worker."""
+    await auth.revoke_token_async(token)
+    await bus.publish({"op": "revoke", "token": token})
+
+
+def _parse_when(value: str) -> float | None:
+    """``10m``/``2h``/``1j`` ago, ``HH:MM`` today or ``YYYY-MM-DD`` -> timestamp."""
+    since = HISTORY_SINCE.match(value.lower())
+    if since:
+        return time.time() - int(since.group(1)) * HISTORY_UNITS[since.group(2)]
+    for fmt in ("%H:%M", "%Y-%m-%d"):
+        try:
+            parsed = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if fmt == "%H:%M":
+            parsed = datetime.now().replace(hour=parsed.hour, minute=parsed.minute, second=0, microsecond=0)
+        return parsed.timestamp()
+    return None
+
+
+def _parse_history_args(args: list[str]) -> tuple[int, float, str] | None:
+    """``/history [n|durée|HH:MM] [@user]`` -> (limit, since_ts, name)."""
+    limit, since_ts, name = HISTORY_DEFAULT, 0.0, ""
+    for arg in args:
+        if arg.startswith("@") and len(arg) > 1:
+            name = arg[1:]
+        elif arg.isdigit():
+            limit = min(max(int(arg), 1), HISTORY_MAX)
+        else:
+            when = _parse_when(arg)
+            if when is None:
+                return None
+            since_ts, limit = when, HISTORY_MAX
+    return limit, since_ts, name
+
+
+def _parse_search_args(args: list[str]) -> tuple[str, str, float, float] | None:
+    """``/search <mots> [from:user] [after:x] [before:x]`` -> (text, name, after_ts, before_ts)."""
+    words, name, after_ts, before_ts = [], "", 0.0, 0.0
+    for arg in args:
+        key, _, value = arg.partition(":")
+        key = key.lower()
+        if key == "from" and value:
+            name = value.lstrip("@")
+        elif key in ("after", "before") and value:
+            when = _parse_when(value)
+            if when is None:
+                return None
+            if key == "after":
+                after_ts = when
+            else:
+                before_ts = when
+        else:
+            words.append(arg)
+    if not words:
+        return None
+    return " ".join(words), name, after_ts, before_ts
+
+
+async def _send_records(websocket: WebSocket, records: list) -> None:
+    for record in records:
+        await manager.send_event(websocket, record.to_event())
 
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket) -> None:
     await manager.connect(websocket)
+    session = sessions.open(websocket)
+    close_code = None
     try:
+        token = _handshake_token(websocket)
+        if token is not None:
+            await _resume(session, token)
         while True:
             incoming_text = await websocket.receive_text()
-            
+
+            # Flood protection: delay or reject input over the limits
+            kind = Traffic.of(incoming_text)
+            if not await limiter.admit(websocket, session.username, kind):
+                if limiter.is_flooding(websocket):
+                    await manager.send_event(websocket, protocol.error("Trop de messages, connexion fermée."))
+                    close_code = 1008
+                    break
+                if limiter.strikes(websocket) == 1:
+                    # once per burst, so a flood does not turn into an error flood
+                    await manager.send_event(websocket, protocol.error("Trop de messages, ralentissez (messages ignorés)."))
+                continue
+
             # If it's not a command, treat as chat message and broadcast
             if not incoming_text.strip().startswith("/"):
-                if websocket not in authed_usernames:
-                    await manager.send_personal_text(websocket, "[ERROR] Vous devez être connecté pour envoyer des messages. Utilisez /login <user> <pass>.")
+                if session.username is None:
+                    await manager.send_event(websocket, protocol.error("Vous devez être connecté pour envoyer des messages. Utilisez /login <user> <pass>."))
+                    continue
+                username = session.username
+                room = manager.current_room(websocket)
+                if room is None:
+                    await manager.send_event(websocket, protocol.error("Vous n'êtes dans aucun salon. Utilisez /join <salon>."))
                     continue
-                username = authed_usernames[websocket]
-                await manager.send_personal_text(websocket, f"[you:{username}] {incoming_text}")
-                await manager.broadcast_text_excluding(websocket, f"[peer:{username}] {incoming_text}")
+                await manager.send_event(websocket, protocol.echo(username, incoming_text, room))
+                await _publish_room(room, protocol.chat(username, incoming_text, room), websocket)
                 continue
             
             # Process commands
@@ -84,47 +534,66 @@ async def websocket_endpoint(websocket: WebSocket) -> None:
             command = command_parts[0].lower()
             
             if command == "/help":
-                help_text = """
-[INFO] Commandes disponibles:
+                help_text = """Commandes disponibles:
 - /help : Afficher cette aide
 - /register <user> <pass> [email] : Créer un compte
 - /login <user> <pass> : Se connecter
+- /resume <token> : Reprendre une session sans mot de passe
 - /logout : Se déconnecter
 - /users : Lister les utilisateurs connectés
+- /presence [on|off] : Suivre les connexions en direct
+- /join <salon> : Rejoindre un salon (et y écrire)
+- /leave [salon] : Quitter un salon
+- /rooms : Lister les salons
+- /history [n|10m|HH:MM] [@user] : Historique du salon courant
+- /search <mots> [from:user] [after:x] [before:x] : Rechercher dans l'historique
 - /send <chemin> : Envoyer un fichier au serveur
 - /files : Lister les fichiers côté serveur
 - /download <nom> [dir] : Télécharger un fichier
 - /local [dir] : Lister les fichiers locaux
 - /run <lang> <fichier> [args...] : Exécuter du code
-- /quit : Quitter
-"""
-                await manager.send_personal_text(websocket, help_text)
+- /quit : Quitter"""
+                await manager.send_event(websocket, protocol.info(help_text))
             elif command == "/users":
-                if websocket not in authed_usernames:
-                    await manager.send_personal_text(websocket, "[ERROR] Vous devez être connecté. Utilisez /login <user> <pass>.")
+                if session.username is None:
+                    await manager.send_event(websocket, protocol.error("Vous devez être connecté. Utilisez /login <user> <pass>."))
                     continue
-                users = sorted(set(authed_usernames.values()))
+                users = presence.online_users()
                 if users:
-                    await manager.send_personal_text(websocket, "[INFO] Utilisateurs connectés: " + ", ".join(users))
+                    await manager.send_event(websocket, protocol.info("Utilisateurs connectés: " + ", ".join(users)))
                 else:
-                    await manager.send_personal_text(websocket, "[INFO] Aucun utilisateur connecté")
+                    await manager.send_event(websocket, protocol.info("Aucun utilisateur connecté"))
             elif command == "/login":
                 if len(command_parts) < 3:
-                    await manager.send_personal_text(websocket, "[ERROR] Usage: /login <user> <pass>")
+                    await manager.send_event(websocket, protocol.error("Usage: /login <user> <pass>"))
                     continue
                 username = command_parts[1]
                 password = command_parts[2]
-                token = auth.login(username, password)
+                try:
+                    token = await auth.login_async(username, password)
+                except HasherBusy:
+                    await manager.send_event(websocket, protocol.error("Serveur occupé, réessayez dans un instant"))
+                    continue
                 if token:
-                    authed_usernames[websocket] = username
-                    username_to_connections.setdefault(username, set()).add(websocket)
-                    await manager.send_personal_text(websocket, f"[INFO] Connecté en tant que {username}")
+                    # A new login on this connection replaces its previous session
+                    previous = session.token
+                    await _sign_out(session)
+                    if previous is not None and previous != token:
+                        await _revoke(previous)
+                    await _sign_in(session, username, token)
+                    await manager.send_event(websocket, protocol.session(username, token))
                 else:
-                    await manager.send_personal_text(websocket, "[ERROR] Nom d'utilisateur ou mot de passe incorrect")
+                    await manager.send_event(websocket, protocol.error("Nom d'utilisateur ou mot de passe incorrect"))
+            elif command == "/resume":
+                # /resume <token>: sign in again without the password
+                if len(command_parts) < 2:
+                    await manager.send_event(websocket, protocol.error("Usage: /resume <token>"))
+                    continue
+                await _resume(session, command_parts[1])
             elif command == "/register":
                 # /register <user> <pass> [email]
                 if len(command_parts) < 3:
-                    await manager.send_personal_text(websocket, "[ERROR] Usage: /register <user> <pass> [email]")
+                    await manager.send_event(websocket, protocol.error("Usage: /register <user> <pass> [email]"))
                     continue
                 username = command_parts[1]
                 password = command_parts[2]
@@ -133,105 +602,211 @@ async def websocket_endpoint(websocket: WebSocket) -> None:
                 tokens = incoming_text.strip().split(" ", 3)
                 if len(tokens) >= 4:
                     email = tokens[3].strip()
-                ok = auth.register(username, password, email)
+                try:
+                    ok = await auth.register_async(username, password, email)
+                except HasherBusy:
+                    await manager.send_event(websocket, protocol.error("Serveur occupé, réessayez dans un instant"))
+                    continue
                 if ok:
-                    await manager.send_personal_text(websocket, f"[INFO] Compte créé: {username}")
+                    await manager.send_event(websocket, protocol.info(f"Compte créé: {username}"))
                 else:
-                    await manager.send_personal_text(websocket, f"[ERROR] Nom d'utilisateur déjà utilisé: {username}")
+                    await manager.send_event(websocket, protocol.error(f"Nom d'utilisateur déjà utilisé: {username}"))
             elif command == "/logout":
-                if websocket in authed_usernames:
-                    prev = authed_usernames.pop(websocket, None)
-                    if prev:
-                        conns = username_to_connections.get(prev)
-                        if conns:
-                            conns.discard(websocket)
-                            if not conns:
-                                username_to_connections.pop(prev, None)
-                auth.logout()
-                await manager.send_personal_text(websocket, "[INFO] Déconnecté")
-            elif command == "/users":
-                if websocket not in authed_usernames:
-                    await manager.send_personal_text(websocket, "[ERROR] Vous devez être connecté. Utilisez /login <user> <pass>.")
+                # Only this connection's session: its token is revoked (with
+                # the connections that resumed it), the user's other sessions
+                # stay signed in.
+                token = session.token
+                await _sign_out(session)
+                if token is not None:
+                    await _revoke(token)
+                await manager.send_event(websocket, protocol.info("Déconnecté"))
+            elif command == "/presence":
+                # /presence on|off: live online/offline deltas (the client
+                # subscribes right after /login)
+                if session.username is None:
+                    await manager.send_event(websocket, protocol.error("Vous devez être connecté. Utilisez /login <user> <pass>."))
                     continue
-                users = sorted([u for u, conns in username_to_connections.items() if conns])
-                if users:
-                    await manager.send_personal_text(websocket, "[INFO] Utilisateurs connectés: " + ", ".join(users))
+                if len(command_parts) >= 2 and command_parts[1].lower() == "off":
+                    presence.unsubscribe(websocket)
                 else:
-                    await manager.send_personal_text(websocket, "[INFO] Aucun utilisateur connecté")
+                    await presence.subscribe(websocket)
+            elif command == "/join":
+                if session.username is None:
+                    await manager.send_event(websocket, protocol.error("Vous devez être connecté. Utilisez /login <user> <pass>."))
+                    continue
+                room = command_parts[1].lstrip("#") if len(command_parts) >= 2 else ""
+                if not ROOM_NAME.match(room):
+                    await manager.send_event(websocket, protocol.error("Usage: /join <salon> (lettres, chiffres, _ ou -, 32 max)"))
+                    continue
+                username = session.username
+                if await _join_room(session, room):
+                    await _publish_room(room, protocol.info(f"{username} a rejoint #{room}"), websocket)
+                members = presence.room_users(room)
+                await manager.send_event(websocket, protocol.info(f"Salon actuel: #{room} ({len(members)} présents: {', '.join(members)})"))
+
+            elif command == "/leave":
+                if session.username is None:
+                    await manager.send_event(websocket, protocol.error("Vous devez être connecté. Utilisez /login <user> <pass>."))
+                    continue
+                room = command_parts[1].lstrip("#") if len(command_parts) >= 2 else manager.current_room(websocket)
+                if not room or not await _leave_room(session, room):
+                    await manager.send_event(websocket, protocol.error(f"Vous n'êtes pas dans le salon #{room}" if room else "Vous n'êtes dans aucun salon"))
+                    continue
+                await _publish_room(room, protocol.info(f"{session.username} a quitté #{room}"))
+                current = manager.current_room(websocket)
+                suffix = f" Salon actuel: #{current}" if current else " Utilisez /join <salon> pour écrire."
+                await manager.send_event(websocket, protocol.info(f"Vous avez quitté #{room}.{suffix}"))
+
+            elif command == "/rooms":
+                if session.username is None:
+                    await manager.send_event(websocket, protocol.error("Vous devez être connecté. Utilisez /login <user> <pass>."))
+                    continue
+                rooms = presence.rooms()
+                if not rooms:
+                    await manager.send_event(websocket, protocol.info("Aucun salon ouvert"))
+                    continue
+                joined = manager.joined_rooms(websocket)
+                current = manager.current_room(websocket)
+                lines = []
+                for name in sorted(rooms):
+                    marker = "*" if name == current else ("+" if name in joined else " ")
+                    detail = ": " + ", ".join(presence.room_users(name)) if name in joined else ""
+                    lines.append(f"{marker} #{name} ({rooms[name]}){detail}")
+                await manager.send_event(websocket, protocol.info("Salons:\n" + "\n".join(lines)))
+
+            elif command == "/history":
+                if session.username is None:
+                    await manager.send_event(websocket, protocol.error("Vous devez être connecté. Utilisez /login <user> <pass>."))
+                    continue
+                room = manager.current_room(websocket)
+                if room is None:
+                    await manager.send_event(websocket, protocol.error("Vous n'êtes dans aucun salon. Utilisez /join <salon>."))
+                    continue
+                parsed = _parse_history_args(command_parts[1:])
+                if parsed is None:
+                    await manager.send_event(websocket, protocol.error("Usage: /history [n|10m|2h|1j|HH:MM] [@user]"))
+                    continue
+                limit, since_ts, name = parsed
+                records = await history.query([room], limit, since_ts=since_ts, name=name)
+                if not records:
+                    await manager.send_event(websocket, protocol.info(f"Aucun message dans l'historique de #{room}"))
+                    continue
+                await manager.send_event(websocket, protocol.info(f"Historique de #{room} ({len(records)} messages):"))
+                await _send_records(websocket, records)
+
+            elif command == "/search":
+                if session.username is None:
+                    await manager.send_event(websocket, protocol.error("Vous devez être connecté. Utilisez /login <user> <pass>."))
+                    continue
+                parsed = _parse_search_args(command_parts[1:])
+                if parsed is None:
+                    await manager.send_event(websocket, protocol.error("Usage: /search <mots> [from:user] [after:10m|HH:MM|AAAA-MM-JJ] [before:...]"))
+                    continue
+                text, name, after_ts, before_ts = parsed
+                rooms = manager.joined_rooms(websocket)
+                records = await search_index.search(text, rooms, name, after_ts, before_ts, SEARCH_LIMIT)
+                if not records:
+                    await manager.send_event(websocket, protocol.info(f"Aucun résultat pour « {text} »"))
+                    continue
+                await manager.send_event(websocket, protocol.info(f"Résultats pour « {text} » ({len(records)}):"))
+                await _send_records(websocket, records)
+
+            elif command == "/backfill":
+                # Sent by the client after /login with the last seq it saw;
+                # silent when there is nothing to replay.
+                if session.username is None or len(command_parts) < 2 or not command_parts[1].isdigit():
+                    continue
+                after_seq = int(command_parts[1])
+                records = []
+                for room, upto_seq in session.joined_at_seq.items():
+                    if upto_seq > after_seq:
+                        limit = BACKFILL_MAX if after_seq else HISTORY_DEFAULT
+                        records += await history.query([room], limit, after_seq=after_seq, upto_seq=upto_seq)
+                if not records:
+                    continue
+                records.sort(key=lambda record: record.seq)
+                if after_seq:
+                    await manager.send_event(websocket, protocol.info(f"{len(records)} message(s) reçu(s) pendant votre absence:"))
+                else:
+                    await manager.send_event(websocket, protocol.info("Derniers messages:"))
+                await _send_records(websocket, records)
+
             elif command == "/msg":
-                if websocket not in authed_usernames:
-                    await manager.send_personal_text(websocket, "[ERROR] Vous devez être connecté. Utilisez /login <user> <pass>.")
+                if session.username is None:
+                    await manager.send_event(websocket, protocol.error("Vous devez être connecté. Utilisez /login <user> <pass>."))
                     continue
                 if len(command_parts) < 3:
-                    await manager.send_personal_text(websocket, "[ERROR] Usage: /msg <user> <message>")
+                    await manager.send_event(websocket, protocol.error("Usage: /msg <user> <message>"))
                     continue
                 recipient = command_parts[1]
                 # préserver les espaces du message
                 content = incoming_text.strip().split(" ", 2)[2]
-                sender = authed_usernames[websocket]
-                targets = username_to_connections.get(recipient)
-                if not targets:
-                    await manager.send_personal_text(websocket, f"[ERROR] Utilisateur '{recipient}' non connecté")
-                    continue
-                # envoyer au destinataire
-                for ws in list(targets):
-                    await manager.send_personal_text(ws, f"[pm:{sender}] {content}")
+                sender = session.username
+                if not presence.is_online(recipient):
+                    await manager.send_event(websocket, protocol.error(f"Utilisateur '{recipient}' non connecté"))
+                    continue
+                # envoyer au destinataire, quel que soit le worker qui le sert
+                await bus.publish({"op": "user", "user": recipient, "event": protocol.pm(sender, content)})
                 # accusé d'envoi pour l'expéditeur
-                await manager.send_personal_text(websocket, f"[pm-sent:{recipient}] {content}")
+                await manager.send_event(websocket, protocol.pm_sent(recipient, content))
             
             elif command == "/send":
-                if websocket not in authed_usernames:
-                    await manager.send_personal_text(websocket, "[ERROR] Vous devez être connecté. Utilisez /login <user> <pass>.")
+                if session.username is None:
+                    await manager.send_event(websocket, protocol.error("Vous devez être connecté. Utilisez /login <user> <pass>."))
                     continue
                 if len(command_parts) < 2:
-                    await manager.send_personal_text(websocket, "[ERROR] Usage: /send <chemin>")
+                    await manager.send_event(websocket, protocol.error("Usage: /send <chemin>"))
                 else:
-                    await manager.send_personal_text(websocket, f"[INFO] Commande /send reçue: {command_parts[1]}")
+                    await manager.send_event(websocket, protocol.info(f"Commande /send reçue: {command_parts[1]}"))
             
             elif command == "/files":
-                if websocket not in authed_usernames:
-                    await manager.send_personal_text(websocket, "[ERROR] Vous devez être connecté. Utilisez /login <user> <pass>.")
+                if session.username is None:
+                    await manager.send_event(websocket, protocol.error("Vous devez être connecté. Utilisez /login <user> <pass>."))
                     continue
-                await manager.send_personal_text(websocket, "[INFO] Commande /files reçue")
+                await manager.send_event(websocket, protocol.info("Commande /files reçue"))
             
             elif command == "/download":
-                if websocket not in authed_usernames:
-                    await manager.send_personal_text(websocket, "[ERROR] Vous devez être connecté. Utilisez /login <user> <pass>.")
+                if session.username is None:
+                    await manager.send_event(websocket, protocol.error("Vous devez être connecté. Utilisez /login <user> <pass>."))
                     continue
                 if len(command_parts) < 2:
-                    await manager.send_personal_text(websocket, "[ERROR] Usage: /download <nom> [dir]")
+                    await manager.send_event(websocket, protocol.error("Usage: /download <nom> [dir]"))
                 else:
-                    await manager.send_personal_text(websocket, f"[INFO] Commande /download reçue: {command_parts[1]}")
+                    await manager.send_event(websocket, protocol.info(f"Commande /download reçue: {command_parts[1]}"))
             
             elif command == "/local":
-                if websocket not in authed_usernames:
-                    await manager.send_personal_text(websocket, "[ERROR] Vous devez être connecté. Utilisez /login <user> <pass>.")
+                if session.username is None:
+                    await manager.send_event(websocket, protocol.error("Vous devez être connecté. Utilisez /login <user> <pass>."))
                     continue
-                await manager.send_personal_text(websocket, "[INFO] Commande /local reçue")
+                await manager.send_event(websocket, protocol.info("Commande /local reçue"))
             
             elif command == "/run":
-                if websocket not in authed_usernames:
-                    await manager.send_personal_text(websocket, "[ERROR] Vous devez être connecté. Utilisez /login <user> <pass>.")
+                if session.username is None:
+                    await manager.send_event(websocket, protocol.error("Vous devez être connecté. Utilisez /login <user> <pass>."))
                     continue
                 if len(command_parts) < 3:
-                    await manager.send_personal_text(websocket, "[ERROR] Usage: /run <lang> <fichier> [args...]")
+                    await manager.send_event(websocket, protocol.error("Usage: /run <lang> <fichier> [args...]"))
                 else:
-                    await manager.send_personal_text(websocket, f"[INFO] Commande /run reçue: {command_parts[1]} {command_parts[2]}")
+                    await manager.send_event(websocket, protocol.info(f"Commande /run reçue: {command_parts[1]} {command_parts[2]}"))
             
             elif command == "/quit":
-                await manager.send_personal_text(websocket, "[INFO] Déconnexion...")
+                await manager.send_event(websocket, protocol.info("Déconnexion..."))
                 break
             
             else:
-                await manager.send_personal_text(websocket, f"[ERROR] Commande inconnue: {command}. Utilisez /help pour voir les commandes disponibles.")
+                await manager.send_event(websocket, protocol.error(f"Commande inconnue: {command}. Utilisez /help pour voir les commandes disponibles."))
                 
     except WebSocketDisconnect:
         pass
     except Exception as e:
         print(f"Error in websocket: {e}")
     finally:
-        authed_usernames.pop(websocket, None)
-        manager.disconnect(websocket)
+        try:
+            await _sign_out(session)
+        finally:
+            sessions.close(session)
+            limiter.forget(websocket)
+            await manager.close(websocket, close_code)
 
 
 def _make_bot_reply(text: str) -> str | None:
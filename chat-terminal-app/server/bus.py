@@ -0,0 +1,391 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+import json
+import os
+import socket
+import tempfile
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from shared.protocol import Event
+from shared.utils import env_float
+
+Message = Dict[str, object]
+Handler = Callable[[Message], Awaitable[None]]
+# (user, room, present): a presence key appeared or disappeared host-wide
+PresenceListener = Callable[[str, str, bool], Awaitable[None]]
+PresenceKey = Tuple[str, str]  # (username, room); room "" means "online"
+Changes = Dict[PresenceKey, bool]
+
+# Operations carrying an Event; "room" events get a stream sequence number.
+EVENT_OPS = {"room", "user"}
+# Longest newline-delimited message accepted on the Unix socket
+_LINE_LIMIT = 16 * 1024 * 1024
+# Unsent bytes for one worker past which the broker waits for it to read
+_HIGH_WATER = 1024 * 1024
+
+
+class MessageBus(ABC):
+    """Routes cross-connection messages between server workers.
+
+    Every delivery that may concern a connection held by another worker goes
+    through ``publish``. Each worker receives every message (its own
+    included) and delivers it to its local connections via the handler given
+    to ``start``:
+
+    - ``{"op": "room", "room": r, "event": e, "exclude": conn_id}``
+    - ``{"op": "user", "user": u, "event": e}``
+    - ``{"op": "revoke", "token": t}``: sign out the connections using ``t``
+
+    The bus also replicates presence: connection counts per user and per
+    (user, room), merged across workers. Only the transitions (a user or a
+    room membership appearing or disappearing anywhere) are reported, to
+    ``on_presence``.
+    """
+
+    def __init__(self) -> None:
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.last_seq = 0
+        self.on_presence: Optional[PresenceListener] = None
+        self._handler: Optional[Handler] = None
+        self._tables: Dict[str, Dict[PresenceKey, int]] = {}
+        self._counts: Dict[PresenceKey, int] = {}
+
+    async def start(self, handler: Handler) -> None:
+        self._handler = handler
+
+    async def stop(self) -> None:
+        self._handler = None
+
+    @abstractmethod
+    async def publish(self, message: Message) -> None:
+        """Send ``message`` to every worker, this one included."""
+
+    @property
+    def is_sequencer(self) -> bool:
+        """Whether this worker numbers the room stream (and so persists it)."""
+        return True
+
+    async def presence(self, user: str, delta: int, room: str = "") -> None:
+        """Announce that ``user`` gained or lost a connection (in ``room``)."""
+        await self.publish({"op": "presence", "user": user, "room": room, "delta": delta})
+
+    # -- presence table -------------------------------------------------------
+
+    def _local_entries(self) -> List[list]:
+        return _entries(self._tables.get(self.worker_id, {}))
+
+    def _apply_presence(self, worker: str, key: PresenceKey, delta: int, changes: Changes) -> None:
+        table = self._tables.setdefault(worker, {})
+        count = table.get(key, 0) + delta
+        if count > 0:
+            table[key] = count
+        else:
+            table.pop(key, None)
+        self._adjust(key, delta, changes)
+
+    def _drop_worker(self, worker: str, changes: Changes) -> None:
+        for key, count in self._tables.pop(worker, {}).items():
+            self._adjust(key, -count, changes)
+
+    def _set_worker(self, worker: str, entries: List[list], changes: Changes) -> None:
+        self._drop_worker(worker, changes)
+        for user, room, count in entries:
+            self._apply_presence(worker, (user, room), count, changes)
+
+    def _adjust(self, key: PresenceKey, delta: int, changes: Changes) -> None:
+        before = key in self._counts
+        total = self._counts.get(key, 0) + delta
+        if total > 0:
+            self._counts[key] = total
+        else:
+            self._counts.pop(key, None)
+        if before != (key in self._counts):
+            # A key that flips back (worker snapshot replaced) is no change.
+            if changes.pop(key, None) is None:
+                changes[key] = not before
+
+    async def _notify(self, changes: Changes) -> None:
+        if self.on_presence is not None:
+            for (user, room), present in changes.items():
+                await self.on_presence(user, room, present)
+
+    async def _dispatch(self, message: Message) -> None:
+        op = message["op"]
+        changes: Changes = {}
+        if op == "presence":
+            key = (message["user"], message.get("room", ""))
+            self._apply_presence(message["origin"], key, message["delta"], changes)
+        elif op == "worker":
+            self._set_worker(message["worker"], message["presence"], changes)
+        elif op == "worker_gone":
+            if message["worker"] != self.worker_id:
+                self._drop_worker(message["worker"], changes)
+        elif self._handler is not None:
+            event = message.get("event")
+            if isinstance(event, Event) and event.seq > self.last_seq:
+                self.last_seq = event.seq
+            await self._handler(message)
+        await self._notify(changes)
+
+
+class LocalBus(MessageBus):
+    """Single-process bus: publishing delivers directly to this worker."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._seq = itertools.count(1)
+
+    async def start(self, handler: Handler) -> None:
+        await super().start(handler)
+        self._seq = itertools.count(self.last_seq + 1)
+
+    async def publish(self, message: Message) -> None:
+        message["origin"] = self.worker_id
+        if message["op"] == "room":
+            message["event"].stamp(next(self._seq))
+        await self._dispatch(message)
+
+
+class UnixSocketBus(MessageBus):
+    """Bus shared by the worker processes of one host over a Unix socket.
+
+    The first worker to take an exclusive lock next to the socket hosts the
+    broker; the others connect to it. The broker relays every message to
+    all workers, stamps room events with a host-wide sequence number and
+    remembers each worker's presence so late joiners get a snapshot. If the
+    broker's worker exits, the others reconnect and one of them takes over.
+    A worker that does not read what the broker sends for ``drain_timeout``
+    seconds is disconnected rather than holding the others back; it
+    reconnects and gets a fresh presence snapshot.
+    """
+
+    def __init__(self, path: str, reconnect_delay: float = 0.5, drain_timeout: float = 5.0) -> None:
+        super().__init__()
+        self.path = path
+        self.reconnect_delay = reconnect_delay
+        self.drain_timeout = drain_timeout
+        self._broker: Optional[_Broker] = None
+        self._lock_fd: Optional[int] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._connected = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, handler: Handler) -> None:
+        await super().start(handler)
+        self._task = asyncio.create_task(self._run())
+        await asyncio.wait_for(self._connected.wait(), 10)
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+        if self._broker is not None:
+            await self._broker.stop()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+        await super().stop()
+
+    @property
+    def is_sequencer(self) -> bool:
+        return self._broker is not None
+
+    async def publish(self, message: Message) -> None:
+        message["origin"] = self.worker_id
+        event = message.get("event")
+        if isinstance(event, Event):
+            event.stamp()  # same timestamp on every worker
+        if message["op"] == "presence":
+            # Applied locally right away so our own view is never stale.
+            key = (message["user"], message.get("room", ""))
+            changes: Changes = {}
+            self._apply_presence(self.worker_id, key, message["delta"], changes)
+            await self._notify(changes)
+            if not self._connected.is_set():
+                return  # the next hello carries our whole presence table
+        await self._connected.wait()
+        self._writer.write(_encode(message))
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self._maybe_become_broker()
+                reader, self._writer = await asyncio.open_unix_connection(self.path, limit=_LINE_LIMIT)
+            except OSError:
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+            self._writer.write(_encode({
+                "op": "hello",
+                "worker": self.worker_id,
+                "last_seq": self.last_seq,
+                "presence": self._local_entries(),
+            }))
+            self._connected.set()
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    await self._dispatch(_decode(line))
+            except (OSError, ValueError):
+                pass
+            finally:
+                self._connected.clear()
+                self._writer.close()
+            # Broker gone: forget remote presence, keep ours for the next hello.
+            changes: Changes = {}
+            for worker in [w for w in self._tables if w != self.worker_id]:
+                self._drop_worker(worker, changes)
+            await self._notify(changes)
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def _dispatch(self, message: Message) -> None:
+        if message["op"] == "presence" and message["origin"] == self.worker_id:
+            return  # already applied in publish()
+        if message["op"] == "worker" and message["worker"] == self.worker_id:
+            return
+        await super()._dispatch(message)
+
+    async def _maybe_become_broker(self) -> None:
+        if self._broker is not None:
+            return
+        import fcntl
+
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return
+        self._lock_fd = fd
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # left over by a dead broker
+        self._broker = _Broker(self.path, self.drain_timeout)
+        await self._broker.start()
+
+
+class _Broker:
+    """Relay run by one worker for the whole host."""
+
+    def __init__(self, path: str, drain_timeout: float = 5.0) -> None:
+        self.path = path
+        self.drain_timeout = drain_timeout
+        self.seq = 0
+        self.disconnected_slow = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._clients: Dict[asyncio.StreamWriter, str] = {}
+        self._presence: Dict[str, Dict[PresenceKey, int]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_unix_server(self._serve, self.path, limit=_LINE_LIMIT)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+        for writer in list(self._clients):
+            writer.close()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        worker: Optional[str] = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                op = message["op"]
+                if op == "hello":
+                    worker = message["worker"]
+                    self.seq = max(self.seq, message.get("last_seq", 0))
+                    for other, table in self._presence.items():
+                        writer.write(_encode({"op": "worker", "worker": other, "presence": _entries(table)}))
+                    self._clients[writer] = worker
+                    entries = message.get("presence", [])
+                    self._presence[worker] = {(user, room): count for user, room, count in entries}
+                    await self._relay({"op": "worker", "worker": worker, "presence": entries})
+                    continue
+                if op == "presence" and worker is not None:
+                    self._track(worker, message)
+                elif op == "room":
+                    self.seq += 1
+                    message["event"]["seq"] = self.seq
+                await self._relay(message)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self._clients.pop(writer, None)
+            writer.close()
+            if worker is not None:
+                self._presence.pop(worker, None)
+                await self._relay({"op": "worker_gone", "worker": worker})
+
+    def _track(self, worker: str, message: Message) -> None:
+        table = self._presence.setdefault(worker, {})
+        key = (message["user"], message.get("room", ""))
+        count = table.get(key, 0) + message["delta"]
+        if count > 0:
+            table[key] = count
+        else:
+            table.pop(key, None)
+
+    async def _relay(self, message: Message) -> None:
+        # Written to every worker before waiting on any: messages keep the
+        # order in which they were numbered.
+        data = _encode(message)
+        behind = []
+        for writer in list(self._clients):
+            if writer.is_closing():
+                self._clients.pop(writer, None)
+                continue
+            writer.write(data)
+            if writer.transport.get_write_buffer_size() > _HIGH_WATER:
+                behind.append(writer)
+        if behind:
+            await asyncio.gather(*(self._drain(writer) for writer in behind))
+
+    async def _drain(self, writer: asyncio.StreamWriter) -> None:
+        try:
+            await asyncio.wait_for(writer.drain(), self.drain_timeout)
+        except (asyncio.TimeoutError, OSError):
+            # Dropped with what it has not read (close() would wait for it);
+            # its _serve task sees the connection end and reports it gone.
+            if self._clients.pop(writer, None) is not None:
+                self.disconnected_slow += 1
+            writer.transport.abort()
+
+
+def _entries(table: Dict[PresenceKey, int]) -> List[list]:
+    return [[user, room, count] for (user, room), count in table.items()]
+
+
+def _encode(message: Message) -> bytes:
+    event = message.get("event")
+    if isinstance(event, Event):
+        message = {**message, "event": event.to_dict()}
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+def _decode(line: bytes) -> Message:
+    message = json.loads(line)
+    if message.get("op") in EVENT_OPS:
+        message["event"] = Event.from_dict(message["event"])
+    return message
+
+
+def create_bus() -> MessageBus:
+    """Build the bus selected by ``CHAT_BUS`` (``local`` or ``unix``)."""
+    backend = os.environ.get("CHAT_BUS", "local").lower()
+    if backend == "unix":
+        default_path = os.path.join(tempfile.gettempdir(), "chat-terminal-bus.sock")
+        return UnixSocketBus(
+            os.environ.get("CHAT_BUS_PATH", default_path),
+            drain_timeout=env_float("CHAT_BUS_DRAIN_TIMEOUT", 5.0),
+        )
+    if backend != "local":
+        raise ValueError(f"Unknown CHAT_BUS backend: {backend}")
+    return LocalBus()
@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+import json
+import time
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from shared.utils import env_float
+from .file_handler import StoredFile, UploadStorage
+
+SORTS = ("name", "size", "mtime")
+
+
+def _sort_key(entry: StoredFile, sort: str):
+    if sort == "size":
+        return (entry.size, entry.name)
+    if sort == "mtime":
+        return (entry.created_at, entry.name)
+    return entry.name
+
+
+def encode_cursor(key) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str, sort: str):
+    """The sort key stored in ``cursor``; ValueError if it is not one for ``sort``."""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, UnicodeError) as e:
+        raise ValueError("Curseur invalide") from e
+    if sort == "name" and isinstance(key, str):
+        return key
+    if (
+        sort != "name" and isinstance(key, list) and len(key) == 2
+        # compared with sizes and dates: a string here would make bisect raise
+        and isinstance(key[0], (int, float)) and not isinstance(key[0], bool)
+        and isinstance(key[1], str)
+    ):
+        return (key[0], key[1])
+    raise ValueError("Curseur invalide")
+
+
+def describe(entry: StoredFile) -> dict:
+    return {
+        "name": entry.name,
+        "size": entry.size,
+        "mtime": entry.created_at,
+        "sha256": entry.sha256,
+        "uploader": entry.uploader,
+        "mime": entry.mime,
+        "seq": entry.seq,
+    }
+
+
+class FileCatalog:
+    """The stored files with their metadata, in memory and kept sorted.
+
+    Loaded once from the storage index, then brought up to date by
+    ``refresh``, which only reads the rows written since the last sequence
+    number it has seen, and only when the index changed (this worker or
+    another). Unless forced (after a write by this worker), ``refresh``
+    looks at the index at most every ``ttl`` seconds, so reads do not pay
+    for a trip to SQLite each time. Listing never touches the file system: each sort order is a
+    sorted list searched with ``bisect``, so a page costs the entries it
+    skips over for the filters, not the size of the directory. Entries are
+    also kept in sequence order, which answers "changed since" by walking
+    back from the newest change.
+    """
+
+    def __init__(self, storage: UploadStorage, ttl: float = 1.0) -> None:
+        self.storage = storage
+        self.ttl = ttl
+        self.seq = -1
+        self.horizon = 0
+        self._version: Optional[int] = None
+        self._checked = float("-inf")
+        self._entries: "OrderedDict[str, StoredFile]" = OrderedDict()
+        self._deleted: "OrderedDict[str, int]" = OrderedDict()
+        self._sorted: Dict[str, list] = {sort: [] for sort in SORTS}
+        self._lock = asyncio.Lock()
+
+    async def refresh(self, force: bool = False) -> None:
+        if not force and time.monotonic() - self._checked < self.ttl:
+            return
+        async with self._lock:
+            if not force and time.monotonic() - self._checked < self.ttl:
+                return
+            version = await asyncio.to_thread(self.storage.version)
+            self._checked = time.monotonic()
+            if version == self._version:
+                return
+            files, deleted, seq, horizon = await asyncio.to_thread(self.storage.changes, self.seq)
+            for entry in files:
+                self._remove(entry.name)
+                self._add(entry)
+                self._deleted.pop(entry.name, None)
+            for name, deleted_seq in deleted:
+                self._remove(name)
+                self._deleted.pop(name, None)
+                self._deleted[name] = deleted_seq
+            while self._deleted and next(iter(self._deleted.values())) <= horizon:
+                self._deleted.popitem(last=False)
+            self.seq = max(self.seq, seq)
+            self.horizon = horizon
+            self._version = version
+
+    def _add(self, entry: StoredFile) -> None:
+        self._entries[entry.name] = entry
+        for sort, keys in self._sorted.items():
+            insort(keys, _sort_key(entry, sort))
+
+    def _remove(self, name: str) -> None:
+        entry = self._entries.pop(name, None)
+        if entry is None:
+            return
+        for sort, keys in self._sorted.items():
+            key = _sort_key(entry, sort)
+            index = bisect_left(keys, key)
+            if index < len(keys) and keys[index] == key:
+                del keys[index]
+
+    def get(self, name: str) -> Optional[StoredFile]:
+        return self._entries.get(name)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def query(
+        self,
+        sort: str = "name",
+        descending: bool = False,
+        limit: int = 100,
+        cursor: Optional[str] = None,
+        prefix: str = "",
+        min_size: Optional[int] = None,
+        max_size: Optional[int] = None,
+        after: Optional[float] = None,
+        before: Optional[float] = None,
+    ) -> Tuple[List[StoredFile], Optional[str]]:
+        """One page of entries and the cursor of the next page (None at the end)."""
+        if sort not in SORTS:
+            raise ValueError(f"Tri inconnu: {sort}")
+        keys = self._sorted[sort]
+        low, high = 0, len(keys)
+        if sort == "name" and prefix:
+            # names sharing the prefix are contiguous in name order
+            low = bisect_left(keys, prefix)
+            high = bisect_left(keys, prefix + "\U0010ffff", low)
+        if cursor:
+            key = decode_cursor(cursor, sort)
+            if descending:
+                high = min(high, bisect_left(keys, key))
+            else:
+                low = max(low, bisect_right(keys, key))
+        positions = range(high - 1, low - 1, -1) if descending else range(low, high)
+        page: List[StoredFile] = []
+        for position in positions:
+            key = keys[position]
+            entry = self._entries[key if sort == "name" else key[1]]
+            if prefix and not entry.name.startswith(prefix):
+                continue
+            if min_size is not None and entry.size < min_size:
+                continue
+            if max_size is not None and entry.size > max_size:
+                continue
+            if after is not None and entry.created_at < after:
+                continue
+            if before is not None and entry.created_at >= before:
+                continue
+            if len(page) == limit:
+                return page, encode_cursor(_sort_key(page[-1], sort))
+            page.append(entry)
+        return page, None
+
+    def changed_since(self, since: int) -> dict:
+        """Entries written and names deleted after sequence ``since``.
+
+        ``reset`` is true when deletions that old are no longer known: the
+        caller must list everything again.
+        """
+        if since < self.horizon:
+            return {"seq": self.seq, "reset": True, "changed": [], "deleted": []}
+        changed = []
+        for entry in reversed(self._entries.values()):
+            if entry.seq <= since:
+                break
+            changed.append(entry)
+        deleted = []
+        for name, deleted_seq in reversed(self._deleted.items()):
+            if deleted_seq <= since:
+                break
+            deleted.append(name)
+        changed.reverse()
+        deleted.reverse()
+        return {"seq": self.seq, "reset": False, "changed": [describe(entry) for entry in changed], "deleted": deleted}
+
+
+def create_file_catalog(storage: UploadStorage) -> FileCatalog:
+    """``CHAT_FILES_REFRESH_SECONDS``: how stale another worker's changes may be."""
+    return FileCatalog(storage, ttl=env_float("CHAT_FILES_REFRESH_SECONDS", 1.0))
@@ -0,0 +1,522 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import secrets
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Set
+
+try:
+    import fcntl
+except ImportError:  # Windows: one worker, the in-process checks are enough
+    fcntl = None
+
+from shared.compression import ENCODINGS, Decoder
+from shared.utils import compute_sha256, env_int
+from .file_handler import StoredFile, UploadStorage, sanitize_filename
+
+UPLOAD_ID = re.compile(r"^[0-9a-f]{32}$")
+SHA256_HEX = re.compile(r"^[0-9a-f]{64}$")
+# Bounds the per-upload bookkeeping (journal, received set, ranges)
+MAX_CHUNKS = 10000
+# Smallest chunk a client may ask for
+MIN_CHUNK_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    """A chunked upload request that cannot be honoured; carries an HTTP status."""
+
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class _Upload:
+    """One transfer in progress, mirrored on disk as ``<id>.json`` + ``<id>.part``.
+
+    ``received`` follows the ``<id>.chunks`` journal, which any worker may
+    append to: ``journal_offset`` is how far this worker has read it.
+    """
+
+    __slots__ = ("upload_id", "filename", "size", "sha256", "chunk_size", "uploader", "received", "writing", "created",
+                 "journal_offset", "journal_inode")
+
+    def __init__(self, upload_id: str, filename: str, size: int, sha256: str, chunk_size: int, created: float,
+                 uploader: Optional[str] = None) -> None:
+        self.upload_id = upload_id
+        self.filename = filename
+        self.size = size
+        self.sha256 = sha256
+        self.chunk_size = chunk_size
+        self.uploader = uploader
+        self.created = created
+        self.received: Set[int] = set()
+        self.writing: Set[int] = set()
+        self.journal_offset = 0
+        self.journal_inode: Optional[int] = None
+
+    @property
+    def chunks(self) -> int:
+        return max(1, -(-self.size // self.chunk_size))
+
+    def chunk_length(self, index: int) -> int:
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def first_missing(self) -> Optional[int]:
+        if len(self.received) == self.chunks:
+            return None
+        index = 0
+        while index in self.received:
+            index += 1
+        return index
+
+    def received_ranges(self) -> List[List[int]]:
+        """Received chunk indexes as ``[first, last]`` runs."""
+        ranges: List[List[int]] = []
+        for index in sorted(self.received):
+            if ranges and ranges[-1][1] == index - 1:
+                ranges[-1][1] = index
+            else:
+                ranges.append([index, index])
+        return ranges
+
+    def describe(self) -> dict:
+        missing = self.first_missing()
+        return {
+            "upload_id": self.upload_id,
+            "filename": self.filename,
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "chunks": self.chunks,
+            "received_ranges": self.received_ranges(),
+            # everything before this offset is on disk and verified
+            "next_offset": missing * self.chunk_size if missing is not None else self.size,
+            "complete": missing is None,
+            # Content-Encoding values accepted on PUT
+            "encodings": list(ENCODINGS),
+        }
+
+
+class ChunkedUploads:
+    """Resumable uploads: ``init``, ``PUT`` chunks at any offset, ``finalize``.
+
+    A transfer is identified by its file name, size and whole-file SHA-256;
+    calling ``init`` again for the same file returns the transfer already in
+    progress with the chunks the server holds, so an interrupted client
+    only sends what is missing. When the storage already holds that
+    content, ``init`` just links the name to it (``"linked": true``) and
+    no transfer is created. Each chunk carries its own SHA-256 and is
+    rejected when it does not match. Chunks are written in place into a
+    preallocated ``.part`` file (several may arrive in parallel) and their
+    indexes appended to a journal, which is what survives a restart.
+    ``finalize`` checks the whole file against the announced hash before
+    publishing it through ``storage``.
+
+    The files in ``partial_directory`` are the state: with several server
+    workers, the requests of one upload can reach any of them. Creating
+    and removing uploads is serialized by a lock file; chunk writes hold a
+    shared lock on ``<id>.json`` and ``finalize`` an exclusive one, so a
+    file is never published while a chunk is being written into it.
+    Uploads older than ``max_age`` are deleted every ``sweep_interval``
+    seconds.
+    """
+
+    def __init__(
+        self,
+        storage: UploadStorage,
+        chunk_size: int = 4 * 1024 * 1024,
+        max_chunk_size: int = 16 * 1024 * 1024,
+        max_age: float = 24 * 3600.0,
+        max_size: int = 4 * 1024 * 1024 * 1024,
+        sweep_interval: float = 600.0,
+    ) -> None:
+        self.storage = storage
+        self.partial_directory = storage.partial_root
+        self.chunk_size = chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.max_age = max_age
+        self.max_size = max_size
+        self.sweep_interval = sweep_interval
+        self._uploads: Dict[str, _Upload] = {}
+        self._finalizing: Set[str] = set()
+        self._thread_lock = threading.Lock()
+        self._sweeper: Optional[asyncio.Task] = None
+
+    # -- lifecycle ------------------------------------------------------------
+
+    async def open(self) -> None:
+        self.partial_directory.mkdir(parents=True, exist_ok=True)
+        await asyncio.to_thread(self.expire)
+        self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def close(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await asyncio.to_thread(self.expire)
+            except OSError:
+                pass
+
+    def expire(self, now: Optional[float] = None) -> int:
+        """Delete the uploads older than ``max_age`` (blocking); returns how many."""
+        now = time.time() if now is None else now
+        removed = 0
+        with self._locked():
+            for meta_path in self.partial_directory.glob("*.json"):
+                upload_id = meta_path.stem
+                upload = self._read(upload_id)
+                if upload is not None and now - upload.created <= self.max_age:
+                    continue
+                fd = self._hold(upload_id, exclusive=True)
+                if fd is None:
+                    continue  # being written or finalized right now
+                try:
+                    self._remove_files(upload_id, upload)
+                finally:
+                    os.close(fd)
+                self._uploads.pop(upload_id, None)
+                removed += 1
+            for key_path in self.partial_directory.glob("*.key"):
+                try:
+                    target = key_path.read_text(encoding="ascii").strip()
+                except OSError:
+                    continue
+                if not self._path(target, ".json").exists():
+                    key_path.unlink(missing_ok=True)
+        return removed
+
+    # -- files and locks (blocking, run them in a thread) ---------------------
+
+    def _path(self, upload_id: str, suffix: str) -> Path:
+        return self.partial_directory / f"{upload_id}{suffix}"
+
+    @staticmethod
+    def _key(filename: str, size: int, sha256: str) -> str:
+        return hashlib.sha256(f"{filename}\n{size}\n{sha256}".encode("utf-8")).hexdigest()[:32]
+
+    def _remove_files(self, upload_id: str, upload: Optional[_Upload] = None) -> None:
+        for suffix in (".json", ".part", ".chunks"):
+            self._path(upload_id, suffix).unlink(missing_ok=True)
+        if upload is not None:
+            self._path(self._key(upload.filename, upload.size, upload.sha256), ".key").unlink(missing_ok=True)
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """Serialize creating and removing uploads, across server workers."""
+        with self._thread_lock:
+            if fcntl is None:
+                yield
+                return
+            fd = os.open(self.partial_directory / ".uploads.lock", os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+    def _hold(self, upload_id: str, exclusive: bool) -> Optional[int]:
+        """Lock ``<id>.json``: shared to write chunks, exclusive to finalize
+        or remove. Returns the descriptor to close to release it, or None
+        when the upload is gone or locked the other way."""
+        try:
+            fd = os.open(self._path(upload_id, ".json"), os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return None
+        if not self._path(upload_id, ".json").exists():
+            # removed between the open and the lock
+            os.close(fd)
+            return None
+        return fd
+
+    async def _acquire(self, upload_id: str, exclusive: bool, busy: str) -> int:
+        fd = await asyncio.to_thread(self._hold, upload_id, exclusive)
+        if fd is not None:
+            return fd
+        if not self._path(upload_id, ".json").exists():
+            self._uploads.pop(upload_id, None)
+            raise UploadError(404, "Upload inconnu ou expiré")
+        raise UploadError(409, busy)
+
+    def _read(self, upload_id: str) -> Optional[_Upload]:
+        try:
+            meta = json.loads(self._path(upload_id, ".json").read_text(encoding="utf-8"))
+            upload = _Upload(
+                upload_id, meta["filename"], meta["size"], meta["sha256"], meta["chunk_size"], meta["created"],
+                meta.get("uploader"),
+            )
+        except (OSError, ValueError, KeyError):
+            return None
+        self._sync(upload)
+        return upload
+
+    def _sync(self, upload: _Upload) -> bool:
+        """Catch up with the journal (other workers append to it too);
+        False when the upload no longer exists."""
+        if not self._path(upload.upload_id, ".json").exists():
+            return False
+        try:
+            with self._path(upload.upload_id, ".chunks").open("rb") as journal:
+                stat = os.fstat(journal.fileno())
+                inode = stat.st_ino
+                if inode != upload.journal_inode or stat.st_size < upload.journal_offset:
+                    # journal restarted after a failed finalize
+                    upload.received.clear()
+                    upload.journal_offset = 0
+                    upload.journal_inode = inode
+                journal.seek(upload.journal_offset)
+                data = journal.read()
+        except FileNotFoundError:
+            upload.received.clear()
+            upload.journal_offset = 0
+            upload.journal_inode = None
+            return True
+        # only complete lines: a worker may be in the middle of an append
+        data = data[:data.rfind(b"\n") + 1]
+        upload.journal_offset += len(data)
+        for line in data.split():
+            if line.isdigit() and int(line) < upload.chunks:
+                upload.received.add(int(line))
+        return True
+
+    def _journal(self, upload: _Upload, index: int) -> None:
+        # Appended only once the data is written: a chunk in the journal is on disk.
+        with self._path(upload.upload_id, ".chunks").open("a", encoding="ascii") as journal:
+            journal.write(f"{index}\n")
+
+    def _find_or_create(self, filename: str, size: int, sha256: str, chunk_size: int,
+                        uploader: Optional[str]) -> _Upload:
+        with self._locked():
+            key_path = self._path(self._key(filename, size, sha256), ".key")
+            try:
+                existing = self._read(key_path.read_text(encoding="ascii").strip())
+            except OSError:
+                existing = None
+            if existing is not None:
+                return existing
+            free = shutil.disk_usage(self.partial_directory).free
+            if size > free:
+                raise UploadError(507, f"Espace disque insuffisant: {size} octets demandés, {free} libres")
+            upload = _Upload(secrets.token_hex(16), filename, size, sha256, chunk_size, time.time(), uploader)
+            with self._path(upload.upload_id, ".part").open("wb") as part:
+                part.truncate(upload.size)
+            meta = {
+                "filename": upload.filename,
+                "size": upload.size,
+                "sha256": upload.sha256,
+                "chunk_size": upload.chunk_size,
+                "created": upload.created,
+                "uploader": upload.uploader,
+            }
+            self._path(upload.upload_id, ".json").write_text(json.dumps(meta), encoding="utf-8")
+            key_path.write_text(upload.upload_id, encoding="ascii")
+            return upload
+
+    # -- protocol -------------------------------------------------------------
+
+    async def _get(self, upload_id: str) -> _Upload:
+        """The upload, up to date with what every worker has written."""
+        if not UPLOAD_ID.match(upload_id):
+            raise UploadError(404, "Upload inconnu ou expiré")
+        upload = self._uploads.get(upload_id)
+        if upload is None:
+            upload = await asyncio.to_thread(self._read, upload_id)
+        elif not await asyncio.to_thread(self._sync, upload):
+            upload = None
+        if upload is None:
+            self._uploads.pop(upload_id, None)
+            raise UploadError(404, "Upload inconnu ou expiré")
+        self._uploads[upload_id] = upload
+        return upload
+
+    async def init(self, filename: str, size: int, sha256: str, chunk_size: Optional[int] = None,
+                   uploader: Optional[str] = None) -> dict:
+        try:
+            filename = sanitize_filename(filename)
+        except ValueError as e:
+            raise UploadError(400, str(e))
+        sha256 = sha256.lower()
+        if size < 0 or not SHA256_HEX.match(sha256):
+            raise UploadError(400, "Taille ou empreinte SHA-256 invalide")
+        if size > self.max_size:
+            raise UploadError(413, f"Fichier trop volumineux: {size} octets, {self.max_size} au plus")
+        # Content the server already has: record the name, nothing to send
+        stored = await asyncio.to_thread(self.storage.link, filename, sha256, size, uploader)
+        if stored is not None:
+            return {"filename": stored.name, "size": stored.size, "linked": True, "complete": True}
+        chunk_size = min(max(MIN_CHUNK_SIZE, chunk_size or self.chunk_size), self.max_chunk_size)
+        # bigger chunks rather than more of them
+        chunk_size = max(chunk_size, -(-size // MAX_CHUNKS))
+        if chunk_size > self.max_chunk_size:
+            raise UploadError(413, f"Fichier trop volumineux pour {MAX_CHUNKS} blocs de {self.max_chunk_size} octets")
+        upload = await asyncio.to_thread(self._find_or_create, filename, size, sha256, chunk_size, uploader)
+        self._uploads[upload.upload_id] = upload
+        return upload.describe()
+
+    async def status(self, upload_id: str) -> dict:
+        return (await self._get(upload_id)).describe()
+
+    async def put_chunk(self, upload_id: str, offset: int, body: AsyncIterator[bytes], sha256: str,
+                        encoding: Optional[str] = None) -> dict:
+        """Store the chunk streamed by ``body`` at ``offset``.
+
+        The data goes to disk as it arrives, ``storage.write_size`` bytes at a
+        time, and only counts as received once its hash has been checked:
+        a rejected or interrupted chunk leaves unjournaled bytes in the
+        ``.part`` file that the next attempt overwrites. A compressed body
+        (``encoding``) is decoded in a thread, never past the chunk length.
+        """
+        upload = await self._get(upload_id)
+        if upload_id in self._finalizing:
+            raise UploadError(409, "Upload en cours de finalisation")
+        if offset < 0 or offset % upload.chunk_size or offset >= max(upload.size, 1):
+            raise UploadError(416, f"Offset invalide: {offset}")
+        index = offset // upload.chunk_size
+        expected = upload.chunk_length(index)
+        decoder = None
+        if encoding and encoding.lower() != "identity":
+            try:
+                decoder = Decoder(encoding.lower(), expected)
+            except ValueError as e:
+                raise UploadError(415, str(e)) from e
+        if index in upload.received:
+            # already on disk: never overwrite verified data with a retry
+            return self._chunk_state(upload, offset)
+        if index in upload.writing:
+            raise UploadError(409, f"Bloc {offset} déjà en cours d'envoi")
+        upload.writing.add(index)
+        fd = None
+        try:
+            fd = await self._acquire(upload_id, False, "Upload en cours de finalisation")
+            digest = hashlib.sha256()
+            length = 0
+            buffer = bytearray()
+            pending = bytearray()
+            with self._path(upload_id, ".part").open("r+b") as part:
+                part.seek(offset)
+
+                async def take(data: bytes, last: bool) -> None:
+                    nonlocal length
+                    length += len(data)
+                    if length > expected:
+                        raise UploadError(400, f"Taille de bloc invalide: plus de {expected} octets")
+                    digest.update(data)
+                    buffer.extend(data)
+                    if len(buffer) >= self.storage.write_size or (last and buffer):
+                        await asyncio.to_thread(part.write, bytes(buffer))
+                        buffer.clear()
+
+                try:
+                    async for data in body:
+                        if decoder is None:
+                            await take(data, False)
+                            continue
+                        pending += data
+                        if len(pending) >= self.storage.write_size:
+                            await take(await asyncio.to_thread(decoder.decode, bytes(pending)), False)
+                            pending.clear()
+                    if decoder is not None:
+                        await take(await asyncio.to_thread(self._decode_last, decoder, bytes(pending)), True)
+                    else:
+                        await take(b"", True)
+                except ValueError as e:
+                    raise UploadError(400, str(e)) from e
+            if length != expected:
+                raise UploadError(400, f"Taille de bloc invalide: {length} octets, {expected} attendus")
+            if digest.hexdigest() != sha256.lower():
+                raise UploadError(422, "Empreinte SHA-256 du bloc incorrecte")
+            await asyncio.to_thread(self._journal, upload, index)
+            upload.received.add(index)
+        finally:
+            upload.writing.discard(index)
+            if fd is not None:
+                os.close(fd)
+        return self._chunk_state(upload, offset)
+
+    @staticmethod
+    def _chunk_state(upload: _Upload, offset: int) -> dict:
+        return {"offset": offset, "received": len(upload.received), "chunks": upload.chunks}
+
+    @staticmethod
+    def _decode_last(decoder: Decoder, data: bytes) -> bytes:
+        return decoder.decode(data) + decoder.finish()
+
+    async def finalize(self, upload_id: str) -> StoredFile:
+        upload = await self._get(upload_id)
+        missing = upload.first_missing()
+        if missing is not None:
+            count = upload.chunks - len(upload.received)
+            raise UploadError(409, f"{count} bloc(s) manquant(s), à partir de l'offset {missing * upload.chunk_size}")
+        if upload_id in self._finalizing:
+            raise UploadError(409, "Upload en cours de finalisation")
+        self._finalizing.add(upload_id)
+        fd = None
+        try:
+            fd = await self._acquire(upload_id, True, "Blocs en cours d'écriture, réessayer")
+            part = self._path(upload_id, ".part")
+            digest = await asyncio.to_thread(compute_sha256, part)
+            if digest != upload.sha256:
+                # Start over: the chunks matched their hashes but not the file's.
+                self._path(upload_id, ".chunks").unlink(missing_ok=True)
+                upload.received.clear()
+                raise UploadError(422, "Empreinte SHA-256 du fichier incorrecte, envoi à recommencer")
+            return await asyncio.to_thread(self._publish, upload, part)
+        finally:
+            if fd is not None:
+                os.close(fd)
+            self._finalizing.discard(upload_id)
+
+    def _publish(self, upload: _Upload, part: Path) -> StoredFile:
+        stored = self.storage.publish(part, upload.filename, upload.sha256, upload.uploader)
+        with self._locked():
+            self._remove_files(upload.upload_id, upload)
+        self._uploads.pop(upload.upload_id, None)
+        return stored
+
+    async def abort(self, upload_id: str) -> None:
+        upload = await self._get(upload_id)
+        self._uploads.pop(upload_id, None)
+        await asyncio.to_thread(self._remove, upload)
+
+    def _remove(self, upload: _Upload) -> None:
+        with self._locked():
+            self._remove_files(upload.upload_id, upload)
+
+    def stats(self) -> dict:
+        return {
+            "in_progress": len(self._uploads),
+            "bytes_pending": sum(upload.size for upload in self._uploads.values()),
+        }
+
+
+def create_chunked_uploads(storage: UploadStorage) -> ChunkedUploads:
+    """Build the upload manager configured by the ``CHAT_UPLOAD_*`` variables."""
+    return ChunkedUploads(
+        storage,
+        chunk_size=env_int("CHAT_UPLOAD_CHUNK_SIZE", 4 * 1024 * 1024),
+        max_chunk_size=env_int("CHAT_UPLOAD_MAX_CHUNK_SIZE", 16 * 1024 * 1024),
+        max_age=env_int("CHAT_UPLOAD_MAX_AGE_HOURS", 24) * 3600.0,
+        max_size=env_int("CHAT_UPLOAD_MAX_SIZE", 4 * 1024 * 1024 * 1024),
+    )
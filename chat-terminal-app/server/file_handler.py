@@ -1,32 +1,361 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
+import mimetypes
+import os
+import secrets
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List
+from typing import Iterator, List, Optional, Tuple
 
 from fastapi import UploadFile
 
+from shared.utils import compute_sha256, env_int
 
-UPLOADS_DIR = Path(__file__).parent / "uploads"
-UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
+# CHAT_UPLOAD_FSYNC: when uploaded data is forced to disk before it is published
+FSYNC_NONE = "none"  # leave it to the OS
+FSYNC_FILE = "file"  # the file's data, before the rename
+FSYNC_FULL = "full"  # the file, then the directory entry after the rename
 
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refs INTEGER NOT NULL,
+    created_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS blobs_unused ON blobs (refs) WHERE refs <= 0;
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    uploader TEXT,
+    mime TEXT,
+    seq INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS deleted (
+    name TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+) WITHOUT ROWID;
+INSERT OR IGNORE INTO meta (key, value) VALUES ('seq', 0), ('horizon', 0);
+"""
 
-async def save_upload_file(upload_file: UploadFile) -> Path:
-    """Save an incoming UploadFile to disk in a memory-efficient way."""
-    destination_path = UPLOADS_DIR / upload_file.filename
-    with destination_path.open("wb") as output_file:
-        while True:
-            chunk = await upload_file.read(1024 * 1024)  # 1 MiB chunks
-            if not chunk:
-                break
-            output_file.write(chunk)
-    await upload_file.close()
-    return destination_path
+# Created after the migration below: files tables from before the catalog have no seq
+_INDEXES = """
+CREATE INDEX IF NOT EXISTS files_seq ON files (seq);
+CREATE INDEX IF NOT EXISTS deleted_seq ON deleted (seq);
+"""
 
+_FILE_COLUMNS = "name, sha256, size, created_at, uploader, mime, seq"
 
-def list_uploaded_files() -> List[str]:
-    """Return a sorted list of filenames present in the uploads directory."""
-    return sorted(
-        [path.name for path in UPLOADS_DIR.iterdir() if path.is_file()]
-    )
+# Deletions remembered for "changed since" queries; older ones need a full listing
+TOMBSTONES = 10_000
+
+
+def sanitize_filename(name: str) -> str:
+    """The base name of ``name``; ValueError if nothing usable is left."""
+    name = Path(name or "").name
+    if not name or name.startswith("."):
+        raise ValueError(f"Nom de fichier invalide: {name!r}")
+    return name
+
+
+class StoredFile:
+    __slots__ = ("name", "sha256", "size", "created_at", "uploader", "mime", "seq")
+
+    def __init__(self, name: str, sha256: str, size: int, created_at: float,
+                 uploader: Optional[str] = None, mime: Optional[str] = None, seq: int = 0) -> None:
+        self.name = name
+        self.sha256 = sha256
+        self.size = size
+        self.created_at = created_at
+        self.uploader = uploader
+        self.mime = mime
+        self.seq = seq
+
+
+class UploadStorage:
+    """Uploaded files, stored once per content and listed by name.
+
+    Each distinct content is a blob named by its SHA-256 under
+    ``root/.store/blobs``; an index (``root/.store/index.db``, SQLite)
+    maps display names to blobs and counts the names pointing at each
+    blob. Uploading content that is already stored only adds a name,
+    re-using a name moves it to the new blob, and blobs left without a
+    name are deleted by ``collect``. Files put directly in ``root`` (the
+    layout before the blob store) are imported at ``open``.
+
+    Incoming files are written under ``partial_root`` (same file system)
+    and only moved into the store once complete, so a download never sees
+    a half-written file. All writes run in worker threads, ``write_size``
+    bytes at a time, and are fsynced according to ``fsync`` (``none``,
+    ``file`` or ``full``). The index is shared by the server workers:
+    changes run in ``BEGIN IMMEDIATE`` transactions, and each one stamps
+    the names it touches (or their tombstone) with a new sequence number,
+    which is what ``changes`` reads to keep a ``FileCatalog`` up to date.
+    """
+
+    def __init__(self, root: Path, partial_root: Path, write_size: int = 1024 * 1024, fsync: str = FSYNC_FILE) -> None:
+        self.root = Path(root)
+        self.partial_root = Path(partial_root)
+        self.store = self.root / ".store"
+        self.write_size = write_size
+        self.fsync = fsync if fsync in (FSYNC_NONE, FSYNC_FILE, FSYNC_FULL) else FSYNC_FILE
+        self._lock = threading.RLock()
+        self._db: Optional[sqlite3.Connection] = None
+        # Reads go through their own connection: in WAL mode they never wait
+        # for a write transaction, nor for the lock held around one
+        self._read_lock = threading.Lock()
+        self._reader: Optional[sqlite3.Connection] = None
+
+    # -- lifecycle ------------------------------------------------------------
+
+    def open(self) -> None:
+        """Create the directories and the index, import loose files (blocking)."""
+        (self.store / "blobs").mkdir(parents=True, exist_ok=True)
+        self.partial_root.mkdir(parents=True, exist_ok=True)
+        # left behind by a crash in the middle of an upload
+        for stale in (*self.partial_root.glob("*.tmp"), *(self.store / "blobs").glob("*/*.tmp")):
+            stale.unlink(missing_ok=True)
+        self._db = sqlite3.connect(str(self.store / "index.db"), timeout=10.0, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(files)")}
+        for column, definition in (("uploader", "TEXT"), ("mime", "TEXT"), ("seq", "INTEGER NOT NULL DEFAULT 0")):
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE files ADD COLUMN {column} {definition}")
+        self._db.executescript(_INDEXES)
+        self._reader = sqlite3.connect(
+            str(self.store / "index.db"), timeout=10.0, check_same_thread=False, isolation_level=None
+        )
+        for path in sorted(self.root.iterdir()):
+            if path.is_file() and not path.name.startswith("."):
+                self.publish(path, path.name)
+        self.collect()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+        with self._read_lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def _blob_path(self, sha256: str) -> Path:
+        return self.store / "blobs" / sha256[:2] / sha256
+
+    def _fsync_directory(self, directory: Path) -> None:
+        if self.fsync == FSYNC_FULL and hasattr(os, "O_DIRECTORY"):
+            fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    # -- writes (blocking, run them in a thread) -------------------------------
+
+    def temp_path(self) -> Path:
+        return self.partial_root / f"{secrets.token_hex(16)}.tmp"
+
+    def publish(self, source: Path, name: str, sha256: Optional[str] = None, uploader: Optional[str] = None) -> StoredFile:
+        """Store the complete file ``source`` under ``name``.
 
+        ``source`` is moved into the store, or deleted if its content is
+        already there. ``sha256`` may be passed when the caller has
+        already checked it.
 
+        The slow part (fsync, a move across file systems) happens before
+        the index is locked: ``source`` is first staged next to its blob
+        under a temporary name, so the transaction only has to rename it.
+        """
+        name = sanitize_filename(name)
+        sha256 = sha256 or compute_sha256(source)
+        size = source.stat().st_size
+        blob = self._blob_path(sha256)
+        staged = self._stage(source, blob)
+        try:
+            now = time.time()
+            with self._transaction() as db:
+                if db.execute("SELECT 1 FROM blobs WHERE sha256 = ?", (sha256,)).fetchone() is None:
+                    db.execute("INSERT INTO blobs (sha256, size, refs, created_at) VALUES (?, ?, 0, ?)", (sha256, size, now))
+                # checked under the lock: ``collect`` may have removed it since staging
+                if not blob.exists():
+                    os.replace(staged, blob)
+                stored, replaced = self._bind(db, name, sha256, size, now, uploader)
+        finally:
+            # already stored, or the transaction failed
+            staged.unlink(missing_ok=True)
+        self._fsync_directory(blob.parent)
+        if replaced:
+            self.collect()
+        return stored
+
+    def _stage(self, source: Path, blob: Path) -> Path:
+        """Move ``source`` next to ``blob`` under a temporary name (no lock held)."""
+        if self.fsync != FSYNC_NONE:
+            with open(source, "rb+") as f:
+                os.fsync(f.fileno())
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        staged = blob.parent / f"{blob.name}.{secrets.token_hex(4)}.tmp"
+        try:
+            os.replace(source, staged)
+        except OSError:
+            # partial directory configured on another file system
+            shutil.move(str(source), str(staged))
+        return staged
+
+    def link(self, name: str, sha256: str, size: int, uploader: Optional[str] = None) -> Optional[StoredFile]:
+        """Name already stored content without transferring it.
+
+        Returns None when no blob has this hash and size: the content
+        must be uploaded.
+        """
+        name = sanitize_filename(name)
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute("SELECT size FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+            if row is None or row[0] != size or not self._blob_path(sha256).exists():
+                return None
+            stored, replaced = self._bind(db, name, sha256, size, now, uploader)
+        if replaced:
+            self.collect()
+        return stored
+
+    @staticmethod
+    def _next_seq(db: sqlite3.Connection) -> int:
+        return db.execute("UPDATE meta SET value = value + 1 WHERE key = 'seq' RETURNING value").fetchone()[0]
+
+    def _bind(self, db: sqlite3.Connection, name: str, sha256: str, size: int, now: float,
+              uploader: Optional[str]) -> Tuple[StoredFile, bool]:
+        """Point ``name`` at a blob; also tells whether it left another blob."""
+        row = db.execute("SELECT sha256 FROM files WHERE name = ?", (name,)).fetchone()
+        if row is None or row[0] != sha256:
+            if row is not None:
+                db.execute("UPDATE blobs SET refs = refs - 1 WHERE sha256 = ?", (row[0],))
+            db.execute("UPDATE blobs SET refs = refs + 1 WHERE sha256 = ?", (sha256,))
+        stored = StoredFile(name, sha256, size, now, uploader, mimetypes.guess_type(name)[0], self._next_seq(db))
+        db.execute(
+            f"INSERT OR REPLACE INTO files ({_FILE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (stored.name, stored.sha256, stored.size, stored.created_at, stored.uploader, stored.mime, stored.seq),
+        )
+        db.execute("DELETE FROM deleted WHERE name = ?", (name,))
+        return stored, row is not None and row[0] != sha256
+
+    def delete(self, name: str) -> bool:
+        with self._transaction() as db:
+            row = db.execute("DELETE FROM files WHERE name = ? RETURNING sha256", (name,)).fetchone()
+            if row is not None:
+                db.execute("UPDATE blobs SET refs = refs - 1 WHERE sha256 = ?", (row[0],))
+                db.execute("INSERT OR REPLACE INTO deleted (name, seq) VALUES (?, ?)", (name, self._next_seq(db)))
+        if row is None:
+            return False
+        self.collect()
+        return True
+
+    def collect(self) -> int:
+        """Delete the blobs no name points to; returns how many were removed."""
+        with self._transaction() as db:
+            unused = [row[0] for row in db.execute("DELETE FROM blobs WHERE refs <= 0 RETURNING sha256").fetchall()]
+            # inside the transaction: a concurrent upload of the same content waits
+            for sha256 in unused:
+                self._blob_path(sha256).unlink(missing_ok=True)
+            oldest = db.execute("SELECT seq FROM deleted ORDER BY seq DESC LIMIT 1 OFFSET ?", (TOMBSTONES,)).fetchone()
+            if oldest is not None:
+                db.execute("DELETE FROM deleted WHERE seq <= ?", oldest)
+                db.execute("UPDATE meta SET value = MAX(value, ?) WHERE key = 'horizon'", oldest)
+        return len(unused)
+
+    def _copy(self, source, name: str, uploader: Optional[str]) -> StoredFile:
+        temp = self.temp_path()
+        digest = hashlib.sha256()
+        try:
+            with open(temp, "wb") as output_file:
+                for chunk in iter(lambda: source.read(self.write_size), b""):
+                    digest.update(chunk)
+                    output_file.write(chunk)
+            return self.publish(temp, name, digest.hexdigest(), uploader)
+        finally:
+            temp.unlink(missing_ok=True)
+
+    async def save(self, upload_file: UploadFile, uploader: Optional[str] = None) -> StoredFile:
+        """Save an incoming UploadFile without blocking the event loop."""
+        name = sanitize_filename(upload_file.filename)
+        try:
+            # Starlette spools the body to a temporary file: copy it in one go
+            return await asyncio.to_thread(self._copy, upload_file.file, name, uploader)
+        finally:
+            await upload_file.close()
+
+    # -- reads ----------------------------------------------------------------
+
+    def blob_path(self, entry: StoredFile) -> Path:
+        return self._blob_path(entry.sha256)
+
+    def version(self) -> int:
+        """Changes whenever the index was written, by this worker or another.
+
+        Read on the reader connection, for which this worker's own writes
+        come from another connection too.
+        """
+        with self._read_lock:
+            return self._reader.execute("PRAGMA data_version").fetchone()[0]
+
+    def changes(self, since: int) -> Tuple[List[StoredFile], List[Tuple[str, int]], int, int]:
+        """Names written and deleted after sequence ``since`` (blocking).
+
+        Returns ``(files, deleted, seq, horizon)``: ``deleted`` holds
+        ``(name, seq)`` pairs, ``seq`` is the latest sequence number and
+        deletions before ``horizon`` are no longer known.
+        """
+        with self._read_lock:
+            db = self._reader
+            db.execute("BEGIN")
+            try:
+                files = [StoredFile(*row) for row in db.execute(
+                    f"SELECT {_FILE_COLUMNS} FROM files WHERE seq > ? ORDER BY seq", (since,))]
+                deleted = db.execute("SELECT name, seq FROM deleted WHERE seq > ? ORDER BY seq", (since,)).fetchall()
+                meta = dict(db.execute("SELECT key, value FROM meta").fetchall())
+            finally:
+                db.execute("COMMIT")
+        return files, deleted, meta["seq"], meta["horizon"]
+
+    def stats(self) -> dict:
+        with self._read_lock:
+            files, logical = self._reader.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files").fetchone()
+            blobs, stored = self._reader.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        return {"files": files, "blobs": blobs, "bytes_listed": logical, "bytes_stored": stored}
+
+
+def create_upload_storage() -> UploadStorage:
+    """Build the storage configured by ``CHAT_UPLOADS_DIR`` and ``CHAT_UPLOAD_*``."""
+    root = Path(os.environ.get("CHAT_UPLOADS_DIR", "uploads"))
+    return UploadStorage(
+        root,
+        Path(os.environ.get("CHAT_UPLOAD_PARTIAL_DIR", str(root) + ".partial")),
+        write_size=env_int("CHAT_UPLOAD_WRITE_SIZE", 1024 * 1024),
+        fsync=os.environ.get("CHAT_UPLOAD_FSYNC", FSYNC_FILE),
+    )
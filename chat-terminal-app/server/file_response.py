@@ -0,0 +1,211 @@
+from __future__ import annotations
+
+import asyncio
+import mimetypes
+import re
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import Optional, Tuple
+
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from shared.compression import GZIP, ZSTD, negotiate
+from .file_handler import StoredFile
+from .variants import CompressedVariants
+
+# Reads from disk when the server cannot send the file itself
+READ_SIZE = 256 * 1024
+# Names can be bound to new content at any time: caches must revalidate
+CACHE_CONTROL = "no-cache"
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def etag(entry: StoredFile, encoding: Optional[str] = None) -> str:
+    """Strong validator: the content's SHA-256, plus the encoding of a
+    compressed representation."""
+    return f'"{entry.sha256}-{encoding}"' if encoding else f'"{entry.sha256}"'
+
+
+def _etag_matches(header: str, entry: StoredFile) -> bool:
+    # If-None-Match uses the weak comparison: W/"x" matches "x". Every
+    # representation of the same content is still valid for the client.
+    tags = {etag(entry), etag(entry, GZIP), etag(entry, ZSTD)}
+    candidates = [value.strip() for value in header.split(",")]
+    return "*" in candidates or any(value.removeprefix("W/") in tags for value in candidates)
+
+
+def _http_time(value: str) -> Optional[float]:
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def _not_modified(request: Request, entry: StoredFile) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # When both are sent, If-None-Match decides (RFC 9110, 13.2.2)
+        return _etag_matches(if_none_match, entry)
+    since = _http_time(request.headers.get("if-modified-since", ""))
+    return since is not None and int(entry.created_at) <= since
+
+
+def _byte_range(request: Request, entry: StoredFile) -> Optional[Tuple[int, int]]:
+    """The single range asked for, as (start, end) inclusive.
+
+    None means the whole file: no Range, a Range we do not serve (syntax
+    error, several ranges) or an If-Range that no longer matches. Raises
+    ValueError for a range outside the file.
+    """
+    header = request.headers.get("range")
+    if header is None:
+        return None
+    if_range = request.headers.get("if-range")
+    if if_range is not None:
+        # Only a strong ETag or the exact Last-Modified date validate the range
+        if if_range.startswith(("\"", "W/")):
+            if if_range != etag(entry):
+                return None
+        elif if_range != formatdate(entry.created_at, usegmt=True):
+            return None
+    match = _RANGE.match(header.strip())
+    if match is None or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    size = entry.size
+    if not first:
+        # suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError("Range Not Satisfiable")
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError("Range Not Satisfiable")
+    return start, end
+
+
+class StoredFileResponse(Response):
+    """Body of a stored file, or a part of it, from an open handle.
+
+    The handle is opened before the response is built, so a blob deleted
+    in the meantime (its name was re-bound) keeps being readable until
+    the body is sent. The body goes through the ASGI zero-copy extension
+    when the server offers it (``http.response.zerocopysend``, or
+    ``http.response.pathsend`` for a whole file); otherwise it is read in
+    ``READ_SIZE`` blocks off the event loop. Sending stops when the
+    client disconnects.
+    """
+
+    def __init__(self, fp, path: Path, start: int, length: int, status_code: int, headers: dict) -> None:
+        super().__init__(status_code=status_code, headers=headers)
+        self.fp = fp
+        self.path = path
+        self.start = start
+        self.length = length
+        self.whole = status_code == 200
+
+    def init_headers(self, headers=None) -> None:
+        # Content-Length is set by the caller, for the range being sent
+        self.raw_headers = [(key.lower().encode("latin-1"), value.encode("latin-1")) for key, value in headers.items()]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            extensions = scope.get("extensions") or {}
+            if self.length == 0:
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+            elif "http.response.zerocopysend" in extensions:
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": self.fp,
+                    "offset": self.start,
+                    "count": self.length,
+                    "more_body": False,
+                })
+            elif self.whole and "http.response.pathsend" in extensions:
+                await send({"type": "http.response.pathsend", "path": str(self.path)})
+            else:
+                await self._send_blocks(receive, send)
+        finally:
+            self.fp.close()
+
+    async def _send_blocks(self, receive: Receive, send: Send) -> None:
+        disconnected = asyncio.ensure_future(self._wait_disconnect(receive))
+        try:
+            await asyncio.to_thread(self.fp.seek, self.start)
+            remaining = self.length
+            while remaining > 0 and not disconnected.done():
+                data = await asyncio.to_thread(self.fp.read, min(READ_SIZE, remaining))
+                if not data:
+                    raise RuntimeError(f"{self.path} is shorter than indexed")
+                remaining -= len(data)
+                await send({"type": "http.response.body", "body": data, "more_body": remaining > 0})
+        finally:
+            disconnected.cancel()
+
+    @staticmethod
+    async def _wait_disconnect(receive: Receive) -> None:
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+
+async def stored_file_response(
+    request: Request, entry: StoredFile, path: Path, variants: Optional[CompressedVariants] = None
+) -> Response:
+    """``entry`` answered with validators, conditional GET and byte ranges.
+
+    A text-like file requested whole is sent compressed when the client
+    accepts an encoding we have (``variants`` keeps the compressed copies).
+    Raises FileNotFoundError when its blob is gone.
+    """
+    headers = {
+        "etag": etag(entry),
+        "last-modified": formatdate(entry.created_at, usegmt=True),
+        "cache-control": CACHE_CONTROL,
+        "accept-ranges": "bytes",
+    }
+    encoding = None
+    if variants is not None and variants.wanted(entry):
+        headers["vary"] = "Accept-Encoding"
+        # ranges are always served from the uncompressed content
+        if "range" not in request.headers:
+            encoding = negotiate(request.headers.get("accept-encoding", ""))
+            if encoding is not None:
+                headers["etag"] = etag(entry, encoding)
+    if _not_modified(request, entry):
+        return Response(status_code=304, headers=headers)
+    media_type = entry.mime or mimetypes.guess_type(entry.name)[0] or "application/octet-stream"
+    if encoding is not None:
+        variant = await variants.open_variant(entry, encoding)
+        if variant is not None:
+            fp, size, variant_path = variant
+            headers["content-type"] = media_type
+            headers["content-encoding"] = encoding
+            headers["content-length"] = str(size)
+            if request.method == "HEAD":
+                fp.close()
+                return Response(status_code=200, headers=headers)
+            return StoredFileResponse(fp, variant_path, 0, size, 200, headers)
+        headers["etag"] = etag(entry)
+    try:
+        byte_range = _byte_range(request, entry)
+    except ValueError:
+        headers["content-range"] = f"bytes */{entry.size}"
+        return Response(status_code=416, headers=headers)
+    headers["content-type"] = media_type
+    if byte_range is None:
+        start, end, status_code = 0, entry.size - 1, 200
+    else:
+        start, end = byte_range
+        status_code = 206
+        headers["content-range"] = f"bytes {start}-{end}/{entry.size}"
+    length = end - start + 1
+    headers["content-length"] = str(length)
+    if request.method == "HEAD":
+        return Response(status_code=status_code, headers=headers)
+    fp = await asyncio.to_thread(open, path, "rb")
+    return StoredFileResponse(fp, path, start, length, status_code, headers)
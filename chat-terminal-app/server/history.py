@@ -0,0 +1,511 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Deque, Dict, IO, List, Optional, Tuple
+
+from shared import protocol
+from shared.protocol import Event
+from shared.utils import env_float, env_int
+
+logger = logging.getLogger(__name__)
+
+
+class Record:
+    """One chat message kept in history."""
+
+    __slots__ = ("seq", "ts", "room", "name", "text")
+
+    def __init__(self, seq: int, ts: float, room: str, name: str, text: str) -> None:
+        self.seq = seq
+        self.ts = ts
+        # Few distinct users and rooms, many messages: share the strings.
+        self.room = sys.intern(room)
+        self.name = sys.intern(name)
+        self.text = text
+
+    @classmethod
+    def from_event(cls, event: Event) -> "Record":
+        return cls(event.seq, event.ts, event.room or protocol.DEFAULT_ROOM, event.name, event.text)
+
+    def to_event(self) -> Event:
+        return Event(protocol.CHAT, self.text, self.name, self.seq, self.ts, self.room)
+
+    def to_line(self) -> bytes:
+        data = {"seq": self.seq, "ts": self.ts, "room": self.room, "name": self.name, "text": self.text}
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+
+    @classmethod
+    def from_line(cls, line: bytes) -> "Record":
+        data = json.loads(line)
+        return cls(data["seq"], data["ts"], data["room"], data["name"], data["text"])
+
+
+class _Segment:
+    """One log file; named after the sequence number of its first record."""
+
+    __slots__ = ("path", "first_seq", "last_seq", "first_ts", "last_ts", "size")
+
+    def __init__(self, path: Path, first_seq: int) -> None:
+        self.path = path
+        self.first_seq = first_seq
+        self.last_seq = first_seq
+        self.first_ts = 0.0
+        self.last_ts = 0.0
+        self.size = 0
+
+    def add(self, record: Record, size: int) -> None:
+        if not self.size:
+            self.first_ts = record.ts
+        self.last_seq = record.seq
+        self.last_ts = record.ts
+        self.size += size
+
+
+def _by_seq(record: Record) -> int:
+    return record.seq
+
+
+def _by_ts(record: Record) -> float:
+    return record.ts
+
+
+class HistoryLog:
+    """Append-only, segmented chat log with the recent part kept in memory.
+
+    The newest ``memory_records`` messages live in a ring buffer indexed by
+    room and by sender, so ``/history`` and reconnect backfill are normally
+    answered without touching disk; older messages are read back from the
+    segment files in a thread. Only the worker that sequences the message
+    stream appends to disk (``persist=True``); the others keep the same
+    in-memory view from the messages they relay. The event loop only
+    updates memory and queues the message: a single writer thread appends
+    whatever has queued up meanwhile and flushes once per batch, and disk
+    queries run behind it so they see every message already recorded.
+    Segments are deleted once
+    the log exceeds ``max_bytes`` or once they only hold messages older than
+    ``max_age`` seconds.
+    """
+
+    def __init__(
+        self,
+        directory: str | Path,
+        memory_records: int = 5000,
+        segment_bytes: int = 4 * 1024 * 1024,
+        max_bytes: int = 256 * 1024 * 1024,
+        max_age: float = 30 * 24 * 3600,
+    ) -> None:
+        self.directory = Path(directory)
+        # at least one, so eviction always has a record to drop
+        self.memory_records = max(1, memory_records)
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.last_seq = 0
+        self._ring: Deque[Record] = deque()
+        self._by_room: Dict[str, Deque[Record]] = {}
+        self._by_name: Dict[str, Deque[Record]] = {}
+        # Newest (seq, ts) per room and per sender that is on disk only:
+        # memory holds all their messages after it.
+        self._evicted_room: Dict[str, Tuple[int, float]] = {}
+        self._evicted_name: Dict[str, Tuple[int, float]] = {}
+        # Same, for every room and sender: what was not loaded at startup
+        self._horizon: Tuple[int, float] = (0, 0.0)
+        self._writing = False  # this worker persists the stream
+        # Records waiting for the writer thread
+        self._pending: List[Record] = []
+        self._pending_lock = threading.Lock()
+        self._drain_queued = False
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # Owned by the writer thread
+        self._segments: List[_Segment] = []
+        self._file: Optional[IO[bytes]] = None
+        self._disk_ready = False  # segments scanned since it became the writer
+        self._disk_seq = 0  # last sequence number known to be on disk
+        # Called (on the event loop, from the writer) with the path of each
+        # segment that fills up.
+        self.on_seal: Optional[Callable[[Path], None]] = None
+        # Called (on the event loop, from the writer) with the first sequence
+        # number left on disk when retention deletes segments.
+        self.on_drop: Optional[Callable[[int], None]] = None
+
+    async def open(self) -> None:
+        """Scan the segments and load the newest messages into memory."""
+        records, self._horizon = await asyncio.to_thread(self._load)
+        for record in records:
+            self._remember(record)
+
+    def close(self) -> None:
+        """Write what is still queued and close the log file (blocking)."""
+        self._writing = False
+        if self._executor is not None:
+            self._executor.submit(self._close_file)
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def flush(self) -> None:
+        """Wait until every message recorded so far is on disk."""
+        if self._executor is not None:
+            await asyncio.get_running_loop().run_in_executor(self._executor, _nothing)
+
+    # -- writing ------------------------------------------------------------
+
+    def record(self, event: Event, persist: bool = False) -> Optional[Record]:
+        """Add a sequenced chat event; ``persist`` queues it for disk too."""
+        if event.seq <= self.last_seq:
+            return None  # replayed by the bus after a reconnect
+        record = Record.from_event(event)
+        if persist:
+            if not self._writing:
+                self._become_writer()
+            self._persist([record])
+        elif self._writing:
+            # another worker sequences the stream now
+            self._writing = False
+            self._executor.submit(self._close_file)
+        self._remember(record)
+        return record
+
+    def _become_writer(self) -> None:
+        self._writing = True
+        self._loop = asyncio.get_running_loop()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-writer")
+        # Messages relayed to us while another worker was writing; the
+        # writer skips the ones already on disk.
+        self._persist(list(self._ring))
+
+    def _persist(self, records: List[Record]) -> None:
+        if not records:
+            return
+        with self._pending_lock:
+            self._pending += records
+            if self._drain_queued:
+                return
+            self._drain_queued = True
+        self._executor.submit(self._drain)
+
+    def _drain(self) -> None:
+        """Append everything queued since the last batch (writer thread)."""
+        with self._pending_lock:
+            batch, self._pending = self._pending, []
+            self._drain_queued = False
+        try:
+            if not self._disk_ready:
+                self._segments = _scan_segments(self.directory)
+                self._disk_seq = max((segment.last_seq for segment in self._segments if segment.size), default=0)
+                self._disk_ready = True
+                self._apply_retention()
+            for record in batch:
+                if record.seq > self._disk_seq:
+                    self._append(record)
+            if self._file is not None:
+                self._file.flush()
+        except Exception:
+            logger.exception("Writing %d history records failed", len(batch))
+
+    def _close_file(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._disk_ready = False
+
+    def _notify(self, callback: Optional[Callable], argument) -> None:
+        if callback is not None and self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(callback, argument)
+            except RuntimeError:
+                pass  # loop already closed: server shutting down
+
+    def _append(self, record: Record) -> None:
+        segment = self._segments[-1] if self._segments else None
+        if segment is None or segment.size >= self.segment_bytes or self._file is None:
+            segment = self._roll(record.seq, segment)
+        line = record.to_line()
+        self._file.write(line)
+        segment.add(record, len(line))
+        self._disk_seq = record.seq
+
+    def _roll(self, seq: int, current: Optional[_Segment]) -> _Segment:
+        if self._file is not None:
+            self._file.close()
+        if current is not None and current.size < self.segment_bytes:
+            self._file = current.path.open("ab")
+            return current
+        if current is not None:
+            self._notify(self.on_seal, current.path)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        segment = _Segment(self.directory / f"{seq:012d}.log", seq)
+        self._segments.append(segment)
+        self._file = segment.path.open("ab")
+        self._apply_retention()
+        return segment
+
+    def _apply_retention(self) -> None:
+        cutoff = time.time() - self.max_age
+        total = sum(segment.size for segment in self._segments)
+        dropped = False
+        while len(self._segments) > 1:
+            oldest = self._segments[0]
+            if total <= self.max_bytes and oldest.last_ts >= cutoff:
+                break
+            self._segments.pop(0)
+            total -= oldest.size
+            dropped = True
+            for path in (oldest.path, oldest.path.with_suffix(".idx")):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+        if dropped:
+            self._notify(self.on_drop, self._segments[0].first_seq)
+
+    def _remember(self, record: Record) -> None:
+        if len(self._ring) >= self.memory_records:
+            evicted = self._ring.popleft()
+            for index, key in ((self._by_room, evicted.room), (self._by_name, evicted.name)):
+                bucket = index[key]
+                bucket.popleft()
+                if not bucket:
+                    del index[key]
+            self._evicted_room[evicted.room] = self._evicted_name[evicted.name] = (evicted.seq, evicted.ts)
+        self._ring.append(record)
+        self._by_room.setdefault(record.room, deque()).append(record)
+        self._by_name.setdefault(record.name, deque()).append(record)
+        self.last_seq = record.seq
+
+    # -- queries ------------------------------------------------------------
+
+    async def query(
+        self,
+        rooms: List[str],
+        limit: int,
+        since_ts: float = 0.0,
+        after_seq: int = 0,
+        upto_seq: int = 0,
+        name: str = "",
+    ) -> List[Record]:
+        """The newest ``limit`` messages of ``rooms``, oldest first.
+
+        Optional bounds: sent at or after ``since_ts``, sequence number in
+        ``(after_seq, upto_seq]``, from sender ``name``.
+        """
+        rooms_set = set(rooms)
+        found = self._query_memory(rooms_set, limit, since_ts, after_seq, upto_seq, name)
+        if len(found) >= limit or self._in_memory(rooms_set, since_ts, after_seq, name):
+            return found
+        oldest = self._ring[0].seq if self._ring else self.last_seq + 1
+        before_seq = min(oldest, upto_seq + 1) if upto_seq else oldest
+        older = await self._on_disk(
+            self._query_disk, rooms_set, limit - len(found), since_ts, after_seq, before_seq, name,
+        )
+        return older + found
+
+    def _in_memory(self, rooms: set, since_ts: float, after_seq: int, name: str) -> bool:
+        """Whether memory holds every message the query could match."""
+        if name:
+            dropped = [self._evicted_name.get(name, self._horizon)]
+        else:
+            dropped = [self._evicted_room.get(room, self._horizon) for room in rooms]
+        for seq, ts in dropped:
+            # the newest message left on disk only is outside the bounds
+            if seq > after_seq and not (since_ts and ts < since_ts):
+                return False
+        return True
+
+    def _query_memory(
+        self, rooms: set, limit: int, since_ts: float, after_seq: int, upto_seq: int, name: str,
+    ) -> List[Record]:
+        if name:
+            sources = [self._by_name.get(name, ())]
+        else:
+            sources = [self._by_room[room] for room in rooms if room in self._by_room]
+        found: List[Record] = []
+        for source in sources:
+            start = bisect.bisect_right(source, after_seq, key=_by_seq) if after_seq else 0
+            if since_ts:
+                start = max(start, bisect.bisect_left(source, since_ts, key=_by_ts))
+            end = bisect.bisect_right(source, upto_seq, key=_by_seq) if upto_seq else len(source)
+            # Walk back from the newest match; stop once we have enough.
+            taken = 0
+            for index in range(end - 1, start - 1, -1):
+                record = source[index]
+                if name and record.room not in rooms:
+                    continue
+                found.append(record)
+                taken += 1
+                if taken >= limit:
+                    break
+        found.sort(key=_by_seq)
+        return found[-limit:] if limit else []
+
+    def _query_disk(
+        self, rooms: set, limit: int, since_ts: float, after_seq: int, before_seq: int, name: str,
+    ) -> List[Record]:
+        # Another worker may have written since we last looked.
+        segments = self._segments if self._disk_ready else _scan_segments(self.directory)
+        found: List[Record] = []
+        for segment in reversed(segments):
+            if segment.first_seq >= before_seq or segment.last_seq <= after_seq:
+                continue
+            if since_ts and segment.last_ts < since_ts:
+                break
+            matches = []
+            for record in read_segment(segment.path):
+                if not after_seq < record.seq < before_seq or record.ts < since_ts:
+                    continue
+                if record.room in rooms and (not name or record.name == name):
+                    matches.append(record)
+            found[:0] = matches[-(limit - len(found)):]
+            if len(found) >= limit:
+                break
+        return found
+
+    async def fetch(self, seqs: List[int]) -> List[Record]:
+        """Records for the given sequence numbers, oldest first; missing ones are skipped."""
+        found: Dict[int, Record] = {}
+        wanted = sorted(set(seqs))
+        for seq in wanted:
+            index = bisect.bisect_left(self._ring, seq, key=_by_seq)
+            if index < len(self._ring) and self._ring[index].seq == seq:
+                found[seq] = self._ring[index]
+        missing = [seq for seq in wanted if seq not in found]
+        if missing:
+            for record in await self._on_disk(self._fetch_disk, missing):
+                found[record.seq] = record
+        return [found[seq] for seq in wanted if seq in found]
+
+    def _fetch_disk(self, seqs: List[int]) -> List[Record]:
+        segments = self._segments if self._disk_ready else _scan_segments(self.directory)
+        firsts = [segment.first_seq for segment in segments]
+        by_segment: Dict[int, set] = {}
+        for seq in seqs:
+            index = bisect.bisect_right(firsts, seq) - 1
+            if index >= 0:
+                by_segment.setdefault(index, set()).add(seq)
+        found: List[Record] = []
+        for index, wanted in by_segment.items():
+            found += [record for record in read_segment(segments[index].path) if record.seq in wanted]
+        return found
+
+    async def _on_disk(self, function, *args):
+        """Run a disk read in a thread; on the writer's when this worker writes the log."""
+        if self._writing:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+        return await asyncio.to_thread(function, *args)
+
+    def first_seq(self) -> int:
+        """Sequence number of the oldest message still on disk (blocking)."""
+        for path in sorted(self.directory.glob("*.log")):
+            try:
+                return int(path.stem)
+            except ValueError:
+                continue
+        return 0
+
+    def segment_paths(self) -> List[Path]:
+        """Log files currently on disk, oldest first (blocking)."""
+        return [segment.path for segment in _scan_segments(self.directory)]
+
+    def _load(self) -> Tuple[List[Record], Tuple[int, float]]:
+        """The newest records, and (seq, ts) of the newest one left on disk."""
+        records: List[Record] = []
+        for segment in reversed(_scan_segments(self.directory)):
+            records[:0] = read_segment(segment.path)
+            if len(records) >= self.memory_records:
+                break
+        if len(records) <= self.memory_records:
+            return records, (0, 0.0)
+        horizon = records[-self.memory_records - 1]
+        return records[-self.memory_records:], (horizon.seq, horizon.ts)
+
+
+def _nothing() -> None:
+    pass
+
+
+def _scan_segments(directory: Path) -> List[_Segment]:
+    """Segment metadata rebuilt from the files on disk, oldest first."""
+    segments: List[_Segment] = []
+    if not directory.is_dir():
+        return segments
+    for path in sorted(directory.glob("*.log")):
+        try:
+            segment = _Segment(path, int(path.stem))
+            segment.size = path.stat().st_size
+        except (ValueError, OSError):
+            continue
+        first = _first_record(path)
+        last = _last_record(path)
+        if first is not None and last is not None:
+            segment.first_ts = first.ts
+            segment.last_seq = last.seq
+            segment.last_ts = last.ts
+        segments.append(segment)
+    return segments
+
+
+def read_segment(path: Path) -> List[Record]:
+    """Every readable record of one log file."""
+    records: List[Record] = []
+    try:
+        with path.open("rb") as fp:
+            for line in fp:
+                try:
+                    records.append(Record.from_line(line))
+                except (ValueError, KeyError):
+                    continue  # torn write at the end of a crashed segment
+    except OSError:
+        pass
+    return records
+
+
+def _first_record(path: Path) -> Optional[Record]:
+    try:
+        with path.open("rb") as fp:
+            return Record.from_line(fp.readline())
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _last_record(path: Path) -> Optional[Record]:
+    try:
+        with path.open("rb") as fp:
+            fp.seek(0, os.SEEK_END)
+            end = fp.tell()
+            block = 4096
+            while True:
+                start = max(0, end - block)
+                fp.seek(start)
+                lines = fp.read(end - start).splitlines()
+                for line in reversed(lines if start == 0 else lines[1:]):
+                    try:
+                        return Record.from_line(line)
+                    except (ValueError, KeyError):
+                        continue
+                if start == 0:
+                    return None
+                block *= 4
+    except OSError:
+        return None
+
+
+def create_history() -> HistoryLog:
+    """Build the history log configured by the ``CHAT_HISTORY_*`` variables."""
+    return HistoryLog(
+        os.environ.get("CHAT_HISTORY_DIR", "history"),
+        memory_records=env_int("CHAT_HISTORY_MEMORY", 5000),
+        segment_bytes=env_int("CHAT_HISTORY_SEGMENT_BYTES", 4 * 1024 * 1024),
+        max_bytes=env_int("CHAT_HISTORY_MAX_BYTES", 256 * 1024 * 1024),
+        max_age=env_float("CHAT_HISTORY_MAX_DAYS", 30.0) * 24 * 3600,
+    )
@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import bisect
+from typing import Dict, List, Set
+
+from fastapi import WebSocket
+
+from shared import protocol
+
+from .websocket_handler import ConnectionManager
+
+
+def _insort(names: List[str], name: str) -> None:
+    index = bisect.bisect_left(names, name)
+    if index == len(names) or names[index] != name:
+        names.insert(index, name)
+
+
+def _discard(names: List[str], name: str) -> None:
+    index = bisect.bisect_left(names, name)
+    if index < len(names) and names[index] == name:
+        del names[index]
+
+
+class PresenceService:
+    """Who is online, and in which rooms, across every worker.
+
+    Fed by the bus with presence transitions (a user's first connection
+    anywhere, their last disconnection, a room gaining or losing its last
+    connection of that user), so queries never rebuild anything: names are
+    kept sorted as they change. Connections in ``subscribers`` (owned by
+    the session registry) get a snapshot once and then only
+    ``online``/``offline`` deltas.
+    """
+
+    def __init__(self, manager: ConnectionManager, subscribers: Set[WebSocket]) -> None:
+        self.manager = manager
+        self._users: List[str] = []
+        self._rooms: Dict[str, List[str]] = {}
+        self._subscribers = subscribers
+
+    async def update(self, user: str, room: str, present: bool) -> None:
+        if room:
+            members = self._rooms.setdefault(room, [])
+            if present:
+                _insort(members, user)
+            else:
+                _discard(members, user)
+                if not members:
+                    del self._rooms[room]
+            return
+        if present:
+            _insort(self._users, user)
+        else:
+            _discard(self._users, user)
+        if self._subscribers:
+            event = protocol.online(user) if present else protocol.offline(user)
+            await self.manager.send_many(self._subscribers, event)
+
+    async def subscribe(self, websocket: WebSocket) -> None:
+        self._subscribers.add(websocket)
+        await self.manager.send_event(websocket, protocol.users(self._users))
+
+    def unsubscribe(self, websocket: WebSocket) -> None:
+        self._subscribers.discard(websocket)
+
+    # -- queries --------------------------------------------------------------
+
+    def is_online(self, user: str) -> bool:
+        index = bisect.bisect_left(self._users, user)
+        return index < len(self._users) and self._users[index] == user
+
+    def online_users(self) -> List[str]:
+        return self._users
+
+    def room_users(self, room: str) -> List[str]:
+        return self._rooms.get(room, [])
+
+    def rooms(self) -> Dict[str, int]:
+        """Open rooms with the number of distinct users in each."""
+        return {room: len(members) for room, members in self._rooms.items()}
@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import time
+from enum import Enum
+from typing import Dict, Hashable, Optional, Tuple
+
+from shared.utils import env_float, env_int
+
+Limit = Tuple[float, float]  # (tokens per second, burst)
+
+
+class Traffic(str, Enum):
+    """Kinds of client input, each with its own buckets."""
+
+    CHAT = "chat"
+    COMMAND = "command"
+    PM = "pm"
+
+    @classmethod
+    def of(cls, text: str) -> "Traffic":
+        stripped = text.lstrip()
+        if not stripped.startswith("/"):
+            return cls.CHAT
+        if stripped[:5].lower() in ("/msg", "/msg "):
+            return cls.PM
+        return cls.COMMAND
+
+
+class TokenBucket:
+    """Classic token bucket: ``rate`` tokens per second, at most ``burst``."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until one token is available (0 if one is available now)."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class RateLimitMode(str, Enum):
+    DELAY = "delay"      # hold the connection's input until tokens are back
+    REJECT = "reject"    # drop the input and answer with an error
+
+
+class RateLimiter:
+    """Token buckets per connection and per user for each kind of traffic.
+
+    An input must find a token in both its connection's bucket and its
+    user's bucket (shared by all of the user's connections on this worker).
+    In ``delay`` mode the receive loop of the offending connection simply
+    sleeps, which pushes back on that client only; waits longer than
+    ``max_delay`` are rejected as in ``reject`` mode. A connection that
+    keeps sending while rejected ``flood_strikes`` times in a row is
+    flagged so the caller can disconnect it.
+    """
+
+    def __init__(
+        self,
+        connection_limits: Dict[Traffic, Limit],
+        user_limits: Dict[Traffic, Limit],
+        mode: RateLimitMode = RateLimitMode.DELAY,
+        max_delay: float = 2.0,
+        flood_strikes: int = 200,
+    ) -> None:
+        self.connection_limits = connection_limits
+        self.user_limits = user_limits
+        self.mode = mode
+        self.max_delay = max_delay
+        self.flood_strikes = flood_strikes
+        self._connections: Dict[Hashable, Dict[Traffic, TokenBucket]] = {}
+        self._users: Dict[str, Dict[Traffic, TokenBucket]] = {}
+        self._strikes: Dict[Hashable, int] = {}
+        self.counters: Dict[str, Dict[str, int]] = {
+            kind.value: {"allowed": 0, "delayed": 0, "rejected": 0} for kind in Traffic
+        }
+        self.counters["flood"] = {"disconnects": 0}
+
+    def _bucket(self, table: dict, key: Hashable, kind: Traffic, limits: Dict[Traffic, Limit]) -> Optional[TokenBucket]:
+        limit = limits.get(kind)
+        if limit is None:
+            return None
+        buckets = table.setdefault(key, {})
+        bucket = buckets.get(kind)
+        if bucket is None:
+            bucket = buckets[kind] = TokenBucket(*limit)
+        return bucket
+
+    async def admit(self, connection: Hashable, user: Optional[str], kind: Traffic) -> bool:
+        """Wait for (``delay``) or check (``reject``) a token; False means reject."""
+        buckets = [self._bucket(self._connections, connection, kind, self.connection_limits)]
+        if user is not None:
+            buckets.append(self._bucket(self._users, user, kind, self.user_limits))
+        buckets = [bucket for bucket in buckets if bucket is not None]
+        counters = self.counters[kind.value]
+        started = time.monotonic()
+        delayed = False
+        while True:
+            # Checked again after every sleep: the user's other connections
+            # may have taken the tokens we were waiting for.
+            now = time.monotonic()
+            wait = max((bucket.wait_time(now) for bucket in buckets), default=0.0)
+            if wait <= 0:
+                break
+            if self.mode is RateLimitMode.REJECT or now + wait - started > self.max_delay:
+                counters["rejected"] += 1
+                self._strikes[connection] = self._strikes.get(connection, 0) + 1
+                return False
+            if not delayed:
+                counters["delayed"] += 1
+                delayed = True
+            await asyncio.sleep(wait)
+        for bucket in buckets:
+            bucket.take()
+        counters["allowed"] += 1
+        self._strikes.pop(connection, None)
+        return True
+
+    def strikes(self, connection: Hashable) -> int:
+        """Rejections in a row for this connection."""
+        return self._strikes.get(connection, 0)
+
+    def is_flooding(self, connection: Hashable) -> bool:
+        if self._strikes.get(connection, 0) < self.flood_strikes:
+            return False
+        self.counters["flood"]["disconnects"] += 1
+        return True
+
+    def forget(self, connection: Hashable) -> None:
+        self._connections.pop(connection, None)
+        self._strikes.pop(connection, None)
+
+    def forget_user(self, user: str) -> None:
+        self._users.pop(user, None)
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode.value,
+            "connection_limits": {kind.value: list(limit) for kind, limit in self.connection_limits.items()},
+            "user_limits": {kind.value: list(limit) for kind, limit in self.user_limits.items()},
+            **self.counters,
+        }
+
+
+def parse_limits(spec: str, defaults: Dict[Traffic, Limit]) -> Dict[Traffic, Limit]:
+    """``"chat=5/20,pm=1/5"`` -> per-kind (rate, burst); ``0`` disables a kind."""
+    limits = dict(defaults)
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, value = item.partition("=")
+        try:
+            kind = Traffic(name.strip().lower())
+            rate, _, burst = value.partition("/")
+            rate_value = float(rate)
+            burst_value = float(burst) if burst else max(1.0, rate_value)
+        except ValueError:
+            continue
+        if rate_value <= 0:
+            limits.pop(kind, None)
+        else:
+            limits[kind] = (rate_value, burst_value)
+    return limits
+
+
+DEFAULT_CONNECTION_LIMITS: Dict[Traffic, Limit] = {
+    Traffic.CHAT: (5.0, 20.0),
+    Traffic.COMMAND: (10.0, 30.0),
+    Traffic.PM: (2.0, 10.0),
+}
+DEFAULT_USER_LIMITS: Dict[Traffic, Limit] = {
+    Traffic.CHAT: (10.0, 40.0),
+    Traffic.COMMAND: (20.0, 60.0),
+    Traffic.PM: (4.0, 20.0),
+}
+
+
+def create_rate_limiter() -> RateLimiter:
+    """Build the limiter configured by the ``CHAT_RATE_*`` variables."""
+    return RateLimiter(
+        parse_limits(os.environ.get("CHAT_RATE_LIMITS", ""), DEFAULT_CONNECTION_LIMITS),
+        parse_limits(os.environ.get("CHAT_USER_RATE_LIMITS", ""), DEFAULT_USER_LIMITS),
+        mode=RateLimitMode(os.environ.get("CHAT_RATE_LIMIT_MODE", "delay")),
+        max_delay=env_float("CHAT_RATE_MAX_DELAY", 2.0),
+        flood_strikes=env_int("CHAT_FLOOD_STRIKES", 200),
+    )
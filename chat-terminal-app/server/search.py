@@ -0,0 +1,271 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import json
+import logging
+import os
+import re
+import unicodedata
+from array import array
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+
+from .history import HistoryLog, Record, read_segment
+
+_WORD = re.compile(r"\w+")
+
+logger = logging.getLogger(__name__)
+
+
+def tokenize(text: str) -> Set[str]:
+    """Distinct search terms of a message: case- and accent-insensitive words."""
+    text = text.casefold()
+    if not text.isascii():
+        text = "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+    return {word for word in _WORD.findall(text) if len(word) > 1}
+
+
+class _Index:
+    """Documents in sequence order plus one sorted posting list per term.
+
+    Postings hold document numbers (``array('I')``), not records, so the
+    index stays small; the message text itself is read back from history.
+    Document ``doc`` is at position ``doc - base`` of the per-document
+    arrays: pruning old documents moves ``base`` instead of renumbering.
+    """
+
+    def __init__(self) -> None:
+        self.base = 0
+        self.seqs = array("Q")
+        self.ts = array("d")
+        self.names = array("I")
+        self.rooms = array("I")
+        self.postings: Dict[str, array] = {}
+        self.symbols: Dict[str, int] = {}
+
+    @property
+    def last_seq(self) -> int:
+        return self.seqs[-1] if self.seqs else 0
+
+    def symbol(self, value: str) -> int:
+        return self.symbols.setdefault(value, len(self.symbols))
+
+    def add(self, seq: int, ts: float, name: str, room: str, terms: Iterable[str]) -> None:
+        doc = self.base + len(self.seqs)
+        self.seqs.append(seq)
+        self.ts.append(ts)
+        self.names.append(self.symbol(name))
+        self.rooms.append(self.symbol(room))
+        for term in terms:
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = array("I")
+            posting.append(doc)
+
+    def add_record(self, record: Record) -> None:
+        self.add(record.seq, record.ts, record.name, record.room, tokenize(record.text))
+
+    def merge(self, data: dict) -> None:
+        """Append a segment index as written by ``_segment_data``."""
+        base = self.base + len(self.seqs)
+        for seq, ts, name, room in data["docs"]:
+            self.seqs.append(seq)
+            self.ts.append(ts)
+            self.names.append(self.symbol(name))
+            self.rooms.append(self.symbol(room))
+        for term, docs in data["terms"].items():
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = array("I")
+            posting.extend(base + doc for doc in docs)
+
+    def prune(self, seq: int) -> int:
+        """Forget the documents before sequence number ``seq``; returns how many."""
+        count = bisect.bisect_left(self.seqs, seq)
+        if not count:
+            return 0
+        for values in (self.seqs, self.ts, self.names, self.rooms):
+            del values[:count]
+        self.base += count
+        for term in list(self.postings):
+            posting = self.postings[term]
+            del posting[:bisect.bisect_left(posting, self.base)]
+            if not posting:
+                del self.postings[term]
+        return count
+
+    def search(
+        self,
+        terms: List[str],
+        rooms: Iterable[str],
+        name: str,
+        after_ts: float,
+        before_ts: float,
+        limit: int,
+    ) -> List[int]:
+        """Sequence numbers of the newest ``limit`` matches, newest first."""
+        postings = [self.postings.get(term) for term in terms]
+        if not postings or any(posting is None for posting in postings):
+            return []
+        room_ids = {self.symbols[room] for room in rooms if room in self.symbols}
+        name_id = self.symbols.get(name, -1) if name else None
+        if not room_ids or name_id == -1:
+            return []
+        # Documents are in sequence order, hence (nearly) in time order.
+        base = self.base
+        lo = base + (bisect.bisect_left(self.ts, after_ts) if after_ts else 0)
+        hi = base + (bisect.bisect_left(self.ts, before_ts) if before_ts else len(self.seqs))
+        postings.sort(key=len)
+        rarest, others = postings[0], postings[1:]
+        found: List[int] = []
+        for index in range(bisect.bisect_left(rarest, hi) - 1, -1, -1):
+            doc = rarest[index]
+            if doc < lo:
+                break
+            position = doc - base
+            if self.rooms[position] not in room_ids or (name_id is not None and self.names[position] != name_id):
+                continue
+            if all(_contains(posting, doc) for posting in others):
+                found.append(self.seqs[position])
+                if len(found) >= limit:
+                    break
+        return found
+
+
+def _contains(posting: array, doc: int) -> bool:
+    index = bisect.bisect_left(posting, doc)
+    return index < len(posting) and posting[index] == doc
+
+
+def _segment_data(records: List[Record]) -> dict:
+    docs = []
+    terms: Dict[str, List[int]] = {}
+    for doc, record in enumerate(records):
+        docs.append([record.seq, record.ts, record.name, record.room])
+        for term in tokenize(record.text):
+            terms.setdefault(term, []).append(doc)
+    return {"docs": docs, "terms": terms}
+
+
+def _write_segment_index(path: Path) -> dict:
+    """Index one sealed log file into ``<segment>.idx`` (written atomically)."""
+    data = _segment_data(read_segment(path))
+    target = path.with_suffix(".idx")
+    tmp = target.with_suffix(".idx.tmp")
+    with tmp.open("w", encoding="utf-8") as fp:
+        json.dump(data, fp, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, target)
+    return data
+
+
+def _read_segment_index(path: Path) -> Optional[dict]:
+    target = path.with_suffix(".idx")
+    try:
+        if target.stat().st_mtime < path.stat().st_mtime:
+            return None  # the segment grew after it was indexed
+        with target.open("r", encoding="utf-8") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+class SearchIndex:
+    """Incremental inverted index over the chat history.
+
+    New messages are indexed as they are recorded. Every sealed log segment
+    gets a ``.idx`` file next to it; on startup the index is rebuilt in the
+    background from those files (and from the active segment's log) while
+    new messages are queued, so boot is not delayed by the size of the log.
+    Messages whose segment is dropped by retention are pruned from the
+    index: right away on the worker that writes the log, at the next search
+    that misses them on the others.
+    """
+
+    def __init__(self, history: HistoryLog) -> None:
+        self.history = history
+        self._index = _Index()
+        self._pending: List[Record] = []
+        self._loading: Optional[asyncio.Task] = None
+        self._sealing: Set[asyncio.Future] = set()
+        self._horizon = 0
+        history.on_seal = self._seal
+        history.on_drop = self.prune
+
+    def start(self) -> None:
+        self._loading = asyncio.create_task(self._load())
+
+    async def stop(self) -> None:
+        if self._loading is not None and not self._loading.done():
+            self._loading.cancel()
+        if self._sealing:
+            # let the segment indexes being written finish
+            await asyncio.gather(*self._sealing, return_exceptions=True)
+
+    def prune(self, seq: int) -> None:
+        """Drop the messages before sequence number ``seq``, gone from history."""
+        if seq > self._horizon:
+            self._horizon = seq
+            self._index.prune(seq)
+
+    def add(self, record: Record) -> None:
+        if self._loading is not None and not self._loading.done():
+            self._pending.append(record)
+        else:
+            self._index.add_record(record)
+
+    async def search(
+        self,
+        text: str,
+        rooms: Iterable[str],
+        name: str = "",
+        after_ts: float = 0.0,
+        before_ts: float = 0.0,
+        limit: int = 20,
+    ) -> List[Record]:
+        """Newest messages containing every word of ``text``, oldest first."""
+        if self._loading is not None and not self._loading.done():
+            await asyncio.shield(self._loading)
+        terms = sorted(tokenize(text))
+        seqs = self._index.search(terms, rooms, name, after_ts, before_ts, limit)
+        records = await self.history.fetch(seqs)
+        if len(records) < len(seqs):
+            # their segment was dropped by retention, on another worker
+            self.prune(await asyncio.to_thread(self.history.first_seq))
+        return records
+
+    async def _load(self) -> None:
+        try:
+            index = await asyncio.to_thread(self._build)
+        except (OSError, ValueError):
+            logger.exception("Search index rebuild failed")
+            index = _Index()
+        pending, self._pending = self._pending, []
+        for record in pending:
+            if record.seq > index.last_seq:
+                index.add_record(record)
+        # segments dropped while the index was being built
+        index.prune(self._horizon)
+        self._index = index
+
+    def _build(self) -> _Index:
+        index = _Index()
+        paths = self.history.segment_paths()
+        for position, path in enumerate(paths):
+            sealed = position < len(paths) - 1
+            data = _read_segment_index(path) if sealed else None
+            if data is None:
+                data = _write_segment_index(path) if sealed else _segment_data(read_segment(path))
+            index.merge(data)
+        return index
+
+    def _seal(self, path: Path) -> None:
+        future = asyncio.get_running_loop().run_in_executor(None, _write_segment_index, path)
+        self._sealing.add(future)
+        future.add_done_callback(self._sealed)
+
+    def _sealed(self, future: asyncio.Future) -> None:
+        self._sealing.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            # rebuilt from the log at the next startup
+            logger.error("Indexing a sealed history segment failed", exc_info=future.exception())
@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import sys
+import time
+from typing import Dict, List, Optional, Set
+
+from fastapi import WebSocket
+
+
+def _discard(index: Dict[str, Set[WebSocket]], key: str, websocket: WebSocket) -> None:
+    connections = index.get(key)
+    if connections is not None:
+        connections.discard(websocket)
+        if not connections:
+            del index[key]
+
+
+class Session:
+    """Everything the server knows about one WebSocket connection."""
+
+    __slots__ = ("websocket", "username", "token", "connected_at", "joined_at_seq")
+
+    def __init__(self, websocket: WebSocket) -> None:
+        self.websocket = websocket
+        self.username: Optional[str] = None
+        # Token this connection signed in with (/login or /resume)
+        self.token: Optional[str] = None
+        self.connected_at = time.time()
+        # Last history seq of each room when this connection joined it:
+        # anything newer was delivered live, anything older is for /backfill.
+        self.joined_at_seq: Dict[str, int] = {}
+
+
+class SessionRegistry:
+    """Single owner of the connection, user and per-connection mappings.
+
+    Sessions are found by connection, by user and by token in O(1), so
+    signing a connection in or out only touches that connection's entries.
+    Every mutation is synchronous, so a sign-out or a disconnect updates all
+    the indexes in one step of the event loop: no other task can observe a
+    socket that is gone from one map but still present in another.
+    """
+
+    def __init__(self) -> None:
+        self._sessions: Dict[WebSocket, Session] = {}
+        self._by_user: Dict[str, Set[WebSocket]] = {}
+        # A token may be resumed on several connections at once
+        self._by_token: Dict[str, Set[WebSocket]] = {}
+        # Connections that asked for live presence deltas
+        self.presence_subscribers: Set[WebSocket] = set()
+
+    def open(self, websocket: WebSocket) -> Session:
+        session = Session(websocket)
+        self._sessions[websocket] = session
+        return session
+
+    def close(self, session: Session) -> Optional[str]:
+        """Forget a connection entirely; returns the user it was signed in as."""
+        username = self.sign_out(session)
+        self._sessions.pop(session.websocket, None)
+        return username
+
+    def sign_in(self, session: Session, username: str, token: Optional[str] = None) -> None:
+        session.username = username
+        session.token = token
+        self._by_user.setdefault(username, set()).add(session.websocket)
+        if token is not None:
+            self._by_token.setdefault(token, set()).add(session.websocket)
+
+    def sign_out(self, session: Session) -> Optional[str]:
+        """Detach the user from this connection only; returns that user."""
+        username, session.username = session.username, None
+        token, session.token = session.token, None
+        session.joined_at_seq.clear()
+        self.presence_subscribers.discard(session.websocket)
+        if username is not None:
+            _discard(self._by_user, username, session.websocket)
+        if token is not None:
+            _discard(self._by_token, token, session.websocket)
+        return username
+
+    # -- lookups --------------------------------------------------------------
+
+    def get(self, websocket: WebSocket) -> Optional[Session]:
+        return self._sessions.get(websocket)
+
+    def connections(self, username: str) -> List[WebSocket]:
+        return list(self._by_user.get(username, ()))
+
+    def has_connections(self, username: str) -> bool:
+        return username in self._by_user
+
+    def with_token(self, token: str) -> List[Session]:
+        """Sessions currently signed in with ``token``."""
+        return [self._sessions[websocket] for websocket in self._by_token.get(token, ())]
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    # -- accounting -----------------------------------------------------------
+
+    def memory_footprint(self) -> int:
+        """Approximate bytes held by the registry (containers and sessions).
+
+        The WebSocket objects themselves belong to the ASGI server and are
+        not counted; usernames and room names are shared strings.
+        """
+        size = sys.getsizeof(self._sessions) + sys.getsizeof(self._by_user) + sys.getsizeof(self._by_token)
+        size += sys.getsizeof(self.presence_subscribers)
+        size += sum(sys.getsizeof(connections) for connections in self._by_user.values())
+        size += sum(sys.getsizeof(connections) for connections in self._by_token.values())
+        for session in self._sessions.values():
+            size += sys.getsizeof(session) + sys.getsizeof(session.joined_at_seq)
+        return size
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._sessions),
+            "signed_in": sum(1 for session in self._sessions.values() if session.username is not None),
+            "users": len(self._by_user),
+            "tokens": len(self._by_token),
+            "presence_subscribers": len(self.presence_subscribers),
+            "memory_bytes": self.memory_footprint(),
+        }
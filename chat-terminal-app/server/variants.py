@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import secrets
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Dict, Optional, Tuple
+
+from shared.compression import MAX_RATIO, MIN_SIZE, compress_file, is_compressible
+from shared.utils import env_int
+from .file_handler import StoredFile, UploadStorage
+
+
+class CompressedVariants:
+    """Compressed copies of stored files, made once and served many times.
+
+    The first download of a text-like file in a given encoding compresses
+    its blob into ``root/.store/variants/<sha256>.<encoding>`` on a small
+    thread pool (zlib and zstd release the GIL, so the event loop keeps
+    running); concurrent requests for the same variant wait for that one
+    job. Variants are keyed by content, so every name pointing at the same
+    blob shares them. The least recently served ones are deleted beyond
+    ``max_bytes``; content that does not compress well is remembered (the
+    ``max_incompressible`` most recently asked for) and sent as is.
+    """
+
+    def __init__(
+        self,
+        storage: UploadStorage,
+        max_bytes: int = 256 * 1024 * 1024,
+        max_file_size: int = 64 * 1024 * 1024,
+        workers: int = 2,
+        max_incompressible: int = 10_000,
+    ) -> None:
+        self.storage = storage
+        self.directory = storage.store / "variants"
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.workers = max(1, workers)
+        self.max_incompressible = max_incompressible
+        self._sizes: "OrderedDict[str, int]" = OrderedDict()
+        self._total = 0
+        self._jobs: Dict[str, asyncio.Future] = {}
+        self._incompressible: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._compressed = 0
+        self._hits = 0
+
+    def open(self) -> None:
+        """Pick up the variants left by a previous run, oldest first."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        variants = []
+        for path in self.directory.iterdir():
+            if path.suffix == ".tmp":
+                path.unlink(missing_ok=True)
+                continue
+            stat = path.stat()
+            variants.append((stat.st_mtime, path.name, stat.st_size))
+        with self._lock:
+            for _, name, size in sorted(variants):
+                self._sizes[name] = size
+                self._total += size
+            self._evict()
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def wanted(self, entry: StoredFile) -> bool:
+        """Whether ``entry`` should be sent compressed when the client allows it."""
+        return (
+            self.max_bytes > 0
+            and MIN_SIZE <= entry.size <= self.max_file_size
+            and is_compressible(entry.name, entry.mime)
+        )
+
+    async def open_variant(self, entry: StoredFile, encoding: str) -> Optional[Tuple[BinaryIO, int, Path]]:
+        """An open handle on ``entry`` compressed with ``encoding``, its size
+        and path; None when the file is better sent uncompressed."""
+        key = f"{entry.sha256}.{encoding}"
+        if key in self._incompressible:
+            self._incompressible.move_to_end(key)
+            return None
+        for _ in range(2):
+            opened = await asyncio.to_thread(self._open, key)
+            if opened is not None:
+                self._hits += 1
+                return opened
+            # not there yet, or evicted by another worker: (re)build it
+            job = self._jobs.get(key)
+            if job is None:
+                loop = asyncio.get_running_loop()
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="compress")
+                job = loop.run_in_executor(self._executor, self._build, entry, encoding, key)
+                self._jobs[key] = job
+                job.add_done_callback(lambda _, key=key: self._jobs.pop(key, None))
+            if not await asyncio.shield(job):
+                self._incompressible[key] = None
+                while len(self._incompressible) > self.max_incompressible:
+                    self._incompressible.popitem(last=False)
+                return None
+        return None
+
+    def _open(self, key: str) -> Optional[Tuple[BinaryIO, int, Path]]:
+        path = self.directory / key
+        try:
+            fp = open(path, "rb")
+        except FileNotFoundError:
+            with self._lock:
+                size = self._sizes.pop(key, None)
+                if size is not None:
+                    self._total -= size
+            return None
+        size = os.fstat(fp.fileno()).st_size
+        with self._lock:
+            if key in self._sizes:
+                self._sizes.move_to_end(key)
+        return fp, size, path
+
+    def _build(self, entry: StoredFile, encoding: str, key: str) -> bool:
+        """Compress the blob; False when the result is not worth keeping."""
+        target = self.directory / key
+        temporary = self.directory / f"{key}.{secrets.token_hex(4)}.tmp"
+        try:
+            size = compress_file(self.storage.blob_path(entry), temporary, encoding)
+            if size > entry.size * MAX_RATIO:
+                return False
+            os.replace(temporary, target)
+        finally:
+            temporary.unlink(missing_ok=True)
+        with self._lock:
+            self._compressed += 1
+            previous = self._sizes.pop(key, None)
+            if previous is not None:
+                self._total -= previous
+            self._sizes[key] = size
+            self._total += size
+            self._evict()
+        return True
+
+    def _evict(self) -> None:
+        # Keep the newest variant even when it alone exceeds the budget
+        while self._total > self.max_bytes and len(self._sizes) > 1:
+            key, size = self._sizes.popitem(last=False)
+            self._total -= size
+            (self.directory / key).unlink(missing_ok=True)
+
+    def stats(self) -> dict:
+        return {
+            "variants": len(self._sizes),
+            "bytes": self._total,
+            "max_bytes": self.max_bytes,
+            "compressed": self._compressed,
+            "hits": self._hits,
+            "pending": len(self._jobs),
+            "incompressible": len(self._incompressible),
+        }
+
+
+def create_compressed_variants(storage: UploadStorage) -> CompressedVariants:
+    return CompressedVariants(
+        storage,
+        max_bytes=env_int("CHAT_COMPRESS_CACHE_SIZE", 256 * 1024 * 1024),
+        max_file_size=env_int("CHAT_COMPRESS_MAX_SIZE", 64 * 1024 * 1024),
+        workers=env_int("CHAT_COMPRESS_WORKERS", 2),
+    )
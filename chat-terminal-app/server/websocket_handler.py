@@ -1,54 +1,421 @@
 from __future__ import annotations
 
-from typing import Set
+import asyncio
+import os
+from collections import deque
+from enum import Enum
+from typing import Deque, Dict, Iterable, List, Optional, Set
+
 from fastapi import WebSocket
 
+from shared import protocol
+from shared.protocol import Codec, Event, Frame
+from shared.utils import env_float, env_int
+
+
+class SlowConsumerPolicy(str, Enum):
+    """What to do with a connection whose outbound queue is full."""
+
+    DROP_OLDEST = "drop_oldest"
+    DISCONNECT = "disconnect"
+    BACKPRESSURE = "backpressure"
+
+
+class BroadcastFrame:
+    """A server event encoded once per wire codec and shared by every recipient.
+
+    The payload for a codec is built the first time a connection using it
+    needs it, then reused for every other such connection and for queue
+    accounting.
+    """
+
+    __slots__ = ("event", "_encoded")
+
+    def __init__(self, event: Event) -> None:
+        self.event = event
+        self._encoded: Dict[Codec, Frame] = {}
+
+    def encoded(self, codec: Codec) -> Frame:
+        payload = self._encoded.get(codec)
+        if payload is None:
+            payload = self._encoded[codec] = codec.encode(self.event)
+        return payload
+
+
+class _Outbox:
+    """Bounded outbound queue of one connection, drained by its writer task."""
+
+    __slots__ = (
+        "websocket", "codec", "messages", "queued_bytes", "wakeup", "writer", "closed",
+        "sending_since", "rooms", "room",
+    )
+
+    def __init__(self, websocket: WebSocket, codec: Codec = protocol.LEGACY_TEXT) -> None:
+        self.websocket = websocket
+        self.codec = codec
+        self.messages: Deque[BroadcastFrame] = deque()
+        self.queued_bytes = 0
+        self.wakeup = asyncio.Event()
+        self.writer: Optional[asyncio.Task] = None
+        self.closed = False
+        self.sending_since: Optional[float] = None
+        self.rooms: Set[str] = set()
+        self.room: Optional[str] = None  # room receiving this connection's messages
+
 
 class ConnectionManager:
     """Manages active WebSocket connections and broadcasting.
 
-    Keeps a set of active connections and provides broadcast helpers.
+    Every connection owns a bounded outbound queue drained by its own writer
+    task, so broadcasting only enqueues and a slow peer never delays the
+    others. When a queue (or the global budget shared by all queues) is full,
+    ``policy`` decides whether to drop the oldest pending messages, disconnect
+    the slow consumer, or make the sender wait for room.
+
+    Each connection speaks the wire codec agreed at connect time. When a
+    writer finds several events waiting it sends them as one batch frame if
+    its codec allows it.
+
+    Rooms are indexed as room -> member connections, so a room broadcast
+    only touches members; who is in a room is PresenceService's business.
     """
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        max_queue_messages: int = 256,
+        max_queue_bytes: int = 1024 * 1024,
+        max_total_bytes: int = 64 * 1024 * 1024,
+        policy: SlowConsumerPolicy = SlowConsumerPolicy.DROP_OLDEST,
+        send_timeout: float = 10.0,
+        backpressure_timeout: float = 5.0,
+        close_timeout: float = 1.0,
+        max_batch: int = 64,
+    ) -> None:
         self.active_connections: Set[WebSocket] = set()
+        self.rooms: Dict[str, Set[WebSocket]] = {}
+        self.max_queue_messages = max_queue_messages
+        self.max_queue_bytes = max_queue_bytes
+        self.max_total_bytes = max_total_bytes
+        self.policy = SlowConsumerPolicy(policy)
+        self.send_timeout = send_timeout
+        self.backpressure_timeout = backpressure_timeout
+        self.close_timeout = close_timeout
+        self.max_batch = max_batch
+        self.total_queued_bytes = 0
+        self.counters: Dict[str, int] = {
+            "enqueued": 0,
+            "sent": 0,
+            "dropped": 0,
+            "slow_disconnects": 0,
+            "send_failures": 0,
+            "batches": 0,
+            "batched_events": 0,
+        }
+        self._outboxes: Dict[WebSocket, _Outbox] = {}
+        self._space_released = asyncio.Event()
+        self._background: Set[asyncio.Task] = set()
+        self._watchdog: Optional[asyncio.Task] = None
+        self._by_id: Dict[int, WebSocket] = {}
 
     async def connect(self, websocket: WebSocket) -> None:
-        await websocket.accept()
+        codec = protocol.negotiate(websocket.scope.get("subprotocols") or [])
+        await websocket.accept(subprotocol=codec.subprotocol)
         self.active_connections.add(websocket)
+        outbox = _Outbox(websocket, codec)
+        outbox.writer = asyncio.create_task(self._writer(outbox))
+        self._outboxes[websocket] = outbox
+        self._by_id[id(websocket)] = websocket
+        if self._watchdog is None or self._watchdog.done():
+            self._watchdog = asyncio.create_task(self._watch_stalled_sends())
 
     def disconnect(self, websocket: WebSocket) -> None:
+        """Forget a connection immediately, discarding its pending messages."""
         self.active_connections.discard(websocket)
+        outbox = self._outboxes.pop(websocket, None)
+        if outbox is None:
+            return
+        self._by_id.pop(id(websocket), None)
+        self.leave_all_rooms(websocket, outbox)
+        outbox.closed = True
+        self._release(outbox, outbox.queued_bytes)
+        outbox.messages.clear()
+        if outbox.writer is not None and outbox.writer is not asyncio.current_task():
+            outbox.writer.cancel()
+
+    async def close(self, websocket: WebSocket, code: Optional[int] = None) -> None:
+        """Forget a connection after giving its writer a chance to flush.
 
-    async def broadcast_text(self, message: str) -> None:
-        stale_connections: list[WebSocket] = []
-        for connection in list(self.active_connections):
+        With ``code`` the WebSocket itself is closed too, e.g. 1008 for a
+        client dropped by policy.
+        """
+        self.active_connections.discard(websocket)
+        outbox = self._outboxes.get(websocket)
+        if outbox is None:
+            return
+        outbox.closed = True
+        outbox.wakeup.set()
+        if outbox.writer is not None:
             try:
-                await connection.send_text(message)
+                await asyncio.wait_for(asyncio.shield(outbox.writer), self.close_timeout)
             except Exception:
-                stale_connections.append(connection)
-        for connection in stale_connections:
-            self.disconnect(connection)
-
-    async def broadcast_text_excluding(self, excluded: WebSocket, message: str) -> None:
-        stale_connections: list[WebSocket] = []
-        for connection in list(self.active_connections):
-            if connection is excluded:
+                pass
+        self.disconnect(websocket)
+        if code is not None:
+            await self._close_quietly(websocket, code)
+
+    def connection(self, conn_id: Optional[int]) -> Optional[WebSocket]:
+        """Look up a local connection by the id used in bus messages."""
+        return self._by_id.get(conn_id) if conn_id is not None else None
+
+    def frame(self, event: Event) -> BroadcastFrame:
+        """Timestamp an event and wrap it for sending."""
+        event.stamp()
+        return BroadcastFrame(event)
+
+    async def broadcast_event(
+        self,
+        event: Event | BroadcastFrame,
+        excluded: Optional[WebSocket] = None,
+        room: Optional[str] = None,
+    ) -> None:
+        """Queue an event for every connection, or only the members of ``room``."""
+        if room is None:
+            targets: Iterable[_Outbox] = list(self._outboxes.values())
+        else:
+            outboxes = self._outboxes
+            targets = [outboxes[ws] for ws in self.rooms.get(room, ()) if ws in outboxes]
+        await self._fan_out(targets, event, excluded)
+
+    async def send_many(self, websockets: Iterable[WebSocket], event: Event | BroadcastFrame) -> None:
+        """Queue one event, encoded once, for each of the given connections."""
+        outboxes = self._outboxes
+        await self._fan_out([outboxes[ws] for ws in websockets if ws in outboxes], event)
+
+    async def _fan_out(
+        self,
+        targets: Iterable[_Outbox],
+        event: Event | BroadcastFrame,
+        excluded: Optional[WebSocket] = None,
+    ) -> None:
+        frame = event if isinstance(event, BroadcastFrame) else self.frame(event)
+        blocked: list[_Outbox] = []
+        for outbox in targets:
+            if outbox.websocket is excluded:
                 continue
+            if not self._offer(outbox, frame):
+                blocked.append(outbox)
+        if blocked:
+            # Fast peers already have the message queued; only now wait for
+            # the ones applying backpressure, all at once.
+            await asyncio.gather(*(self._put_waiting(outbox, frame) for outbox in blocked))
+
+    async def send_event(self, websocket: WebSocket, event: Event | BroadcastFrame) -> None:
+        outbox = self._outboxes.get(websocket)
+        if outbox is None:
+            return
+        frame = event if isinstance(event, BroadcastFrame) else self.frame(event)
+        if not self._offer(outbox, frame):
+            await self._put_waiting(outbox, frame)
+
+    # -- rooms -------------------------------------------------------------
+
+    def join_room(self, websocket: WebSocket, room: str) -> bool:
+        """Add a connection to a room and make it its current room.
+
+        Returns False if the connection was already a member.
+        """
+        outbox = self._outboxes.get(websocket)
+        if outbox is None:
+            return False
+        outbox.room = room
+        members = self.rooms.setdefault(room, set())
+        if websocket in members:
+            return False
+        members.add(websocket)
+        outbox.rooms.add(room)
+        return True
+
+    def leave_room(self, websocket: WebSocket, room: str) -> bool:
+        outbox = self._outboxes.get(websocket)
+        if outbox is None or room not in outbox.rooms:
+            return False
+        self._remove_member(outbox, room)
+        if outbox.room == room:
+            outbox.room = next(iter(outbox.rooms), None)
+        return True
+
+    def leave_all_rooms(self, websocket: WebSocket, outbox: Optional[_Outbox] = None) -> List[str]:
+        outbox = outbox or self._outboxes.get(websocket)
+        if outbox is None:
+            return []
+        left = sorted(outbox.rooms)
+        for room in left:
+            self._remove_member(outbox, room)
+        outbox.room = None
+        return left
+
+    def current_room(self, websocket: WebSocket) -> Optional[str]:
+        outbox = self._outboxes.get(websocket)
+        return outbox.room if outbox else None
+
+    def joined_rooms(self, websocket: WebSocket) -> Set[str]:
+        outbox = self._outboxes.get(websocket)
+        return set(outbox.rooms) if outbox else set()
+
+    def _remove_member(self, outbox: _Outbox, room: str) -> None:
+        outbox.rooms.discard(room)
+        members = self.rooms.get(room)
+        if members is not None:
+            members.discard(outbox.websocket)
+            if not members:
+                del self.rooms[room]
+
+    def stats(self) -> Dict[str, int]:
+        """Return queue counters, useful to tune the limits."""
+        return {
+            **self.counters,
+            "connections": len(self._outboxes),
+            "rooms": len(self.rooms),
+            "queued_messages": sum(len(o.messages) for o in self._outboxes.values()),
+            "queued_bytes": self.total_queued_bytes,
+        }
+
+    # -- queueing ---------------------------------------------------------
+
+    def _is_full(self, outbox: _Outbox, size: int) -> bool:
+        return (
+            len(outbox.messages) >= self.max_queue_messages
+            or outbox.queued_bytes + size > self.max_queue_bytes
+            or self.total_queued_bytes + size > self.max_total_bytes
+        )
+
+    def _push(self, outbox: _Outbox, frame: BroadcastFrame, size: int) -> None:
+        outbox.messages.append(frame)
+        outbox.queued_bytes += size
+        self.total_queued_bytes += size
+        self.counters["enqueued"] += 1
+        outbox.wakeup.set()
+
+    def _release(self, outbox: _Outbox, size: int) -> None:
+        outbox.queued_bytes -= size
+        self.total_queued_bytes -= size
+        self._space_released.set()
+
+    def _offer(self, outbox: _Outbox, frame: BroadcastFrame) -> bool:
+        """Enqueue without waiting; False means the caller must wait for room."""
+        if outbox.closed:
+            return True
+        size = len(frame.encoded(outbox.codec))
+        if not self._is_full(outbox, size):
+            self._push(outbox, frame, size)
+            return True
+        if self.policy is SlowConsumerPolicy.DROP_OLDEST:
+            while outbox.messages and self._is_full(outbox, size):
+                dropped = outbox.messages.popleft()
+                self._release(outbox, len(dropped.encoded(outbox.codec)))
+                self.counters["dropped"] += 1
+            if self._is_full(outbox, size):
+                self.counters["dropped"] += 1
+            else:
+                self._push(outbox, frame, size)
+            return True
+        if self.policy is SlowConsumerPolicy.DISCONNECT:
+            self._drop_slow_consumer(outbox)
+            return True
+        return False
+
+    async def _put_waiting(self, outbox: _Outbox, frame: BroadcastFrame) -> None:
+        size = len(frame.encoded(outbox.codec))
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.backpressure_timeout
+        while not outbox.closed and self._is_full(outbox, size):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                self._drop_slow_consumer(outbox)
+                return
+            self._space_released.clear()
             try:
-                await connection.send_text(message)
-            except Exception:
-                stale_connections.append(connection)
-        for connection in stale_connections:
-            self.disconnect(connection)
+                await asyncio.wait_for(self._space_released.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        if not outbox.closed:
+            self._push(outbox, frame, size)
+
+    def _drop_slow_consumer(self, outbox: _Outbox) -> None:
+        self.counters["slow_disconnects"] += 1
+        websocket = outbox.websocket
+        self.disconnect(websocket)
+        task = asyncio.create_task(self._close_quietly(websocket))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
 
-    async def send_personal_text(self, websocket: WebSocket, message: str) -> None:
+    async def _close_quietly(self, websocket: WebSocket, code: int = 1008) -> None:
         try:
-            await websocket.send_text(message)
+            await asyncio.wait_for(websocket.close(code=code), self.close_timeout)
         except Exception:
-            self.disconnect(websocket)
+            pass
+
+    def _pop(self, outbox: _Outbox) -> Frame:
+        payload = outbox.messages.popleft().encoded(outbox.codec)
+        self._release(outbox, len(payload))
+        return payload
+
+    async def _watch_stalled_sends(self) -> None:
+        """Drop connections whose current send has been stuck too long.
 
+        One periodic scan replaces a timeout around every single send, which
+        would cost a task per message and recipient.
+        """
+        loop = asyncio.get_running_loop()
+        while self._outboxes:
+            await asyncio.sleep(self.send_timeout / 2)
+            now = loop.time()
+            for outbox in list(self._outboxes.values()):
+                started = outbox.sending_since
+                if started is not None and now - started > self.send_timeout:
+                    self.counters["send_failures"] += 1
+                    self._drop_slow_consumer(outbox)
 
-manager = ConnectionManager()
+    async def _writer(self, outbox: _Outbox) -> None:
+        websocket = outbox.websocket
+        codec = outbox.codec
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                while not outbox.messages:
+                    if outbox.closed:
+                        return
+                    outbox.wakeup.clear()
+                    await outbox.wakeup.wait()
+                frames = [self._pop(outbox)]
+                if codec.batching and outbox.messages:
+                    # Backlog: ship what is waiting as one frame.
+                    while outbox.messages and len(frames) < self.max_batch:
+                        frames.append(self._pop(outbox))
+                    self.counters["batches"] += 1
+                    self.counters["batched_events"] += len(frames)
+                    frames = codec.encode_batch(frames)
+                for payload in frames:
+                    outbox.sending_since = loop.time()
+                    if codec.binary:
+                        await websocket.send_bytes(payload)
+                    else:
+                        await websocket.send_text(payload)
+                    outbox.sending_since = None
+                    self.counters["sent"] += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Dead or stalled peer: stop writing to it.
+            self.counters["send_failures"] += 1
+            self.disconnect(websocket)
 
 
+manager = ConnectionManager(
+    max_queue_messages=env_int("CHAT_SEND_QUEUE_MESSAGES", 256),
+    max_queue_bytes=env_int("CHAT_SEND_QUEUE_BYTES", 1024 * 1024),
+    max_total_bytes=env_int("CHAT_SEND_QUEUE_TOTAL_BYTES", 64 * 1024 * 1024),
+    policy=SlowConsumerPolicy(os.environ.get("CHAT_SLOW_CONSUMER_POLICY", "drop_oldest")),
+    send_timeout=env_float("CHAT_SEND_TIMEOUT", 10.0),
+    backpressure_timeout=env_float("CHAT_BACKPRESSURE_TIMEOUT", 5.0),
+)
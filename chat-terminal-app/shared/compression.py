@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import mimetypes
+import zlib
+from pathlib import Path
+from typing import List, Optional
+
+try:
+    import zstandard
+except ImportError:  # optional: without it, transfers use gzip only
+    zstandard = None
+
+GZIP = "gzip"
+ZSTD = "zstd"
+# Content-codings this process can write and read, preferred first
+ENCODINGS = (ZSTD, GZIP) if zstandard is not None else (GZIP,)
+
+# Below this, the codec header and the extra round of work cost more than they save
+MIN_SIZE = 1024
+# A result bigger than this fraction of the original is not worth sending
+MAX_RATIO = 0.9
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+READ_SIZE = 1024 * 1024
+_ZSTD_BLOCK_SIZE = 128 * 1024
+_ZSTD_BLOCK_HEADER = 4
+_ZSTD_MIN_STEP = 64
+
+_TEXT_TYPES = {
+    "application/json", "application/xml", "application/javascript", "application/x-javascript",
+    "application/x-sh", "application/x-python", "application/sql", "application/x-yaml",
+    "application/yaml", "application/toml", "application/x-tex", "image/svg+xml",
+}
+# Source and log files that mimetypes does not know, or calls octet-stream
+_TEXT_SUFFIXES = {
+    ".log", ".md", ".rst", ".ini", ".cfg", ".conf", ".toml", ".yaml", ".yml", ".env",
+    ".c", ".h", ".cpp", ".hpp", ".cc", ".rs", ".go", ".java", ".kt", ".ts", ".tsx", ".jsx",
+    ".rb", ".php", ".lua", ".sql", ".sh", ".bat", ".ps1", ".cs", ".swift", ".scala",
+}
+
+
+def is_compressible(name: str, mime: Optional[str] = None) -> bool:
+    """Whether ``name`` is text-like enough that compressing it pays off."""
+    mime = mime or mimetypes.guess_type(name)[0]
+    if mime and (mime.startswith("text/") or mime in _TEXT_TYPES or mime.endswith(("+json", "+xml"))):
+        return True
+    return Path(name).suffix.lower() in _TEXT_SUFFIXES
+
+
+def negotiate(accept_encoding: str, offered=ENCODINGS) -> Optional[str]:
+    """The first of ``offered`` that an ``Accept-Encoding`` header allows."""
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if coding:
+            accepted[coding.strip().lower()] = quality
+    for encoding in offered:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == ZSTD and zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    if encoding == GZIP:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+    raise ValueError(f"Encodage non pris en charge: {encoding}")
+
+
+def compress_file(source: Path, target: Path, encoding: str) -> int:
+    """Write ``source`` compressed to ``target``, streaming; returns its size."""
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        if encoding == ZSTD and zstandard is not None:
+            zstandard.ZstdCompressor(level=ZSTD_LEVEL).copy_stream(src, dst, read_size=READ_SIZE)
+        elif encoding == GZIP:
+            compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+            while True:
+                data = src.read(READ_SIZE)
+                if not data:
+                    break
+                dst.write(compressor.compress(data))
+            dst.write(compressor.flush())
+        else:
+            raise ValueError(f"Encodage non pris en charge: {encoding}")
+        return dst.tell()
+
+
+class Decoder:
+    """Incremental decoding of a compressed body, fed as it arrives.
+
+    Never produces more than ``limit`` bytes: past it, ``decode`` raises
+    ValueError instead of inflating a small body into a huge one. Corrupt
+    data also raises ValueError.
+    """
+
+    def __init__(self, encoding: str, limit: int) -> None:
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Encodage non pris en charge: {encoding}")
+        self.encoding = encoding
+        self.limit = limit
+        self.size = 0
+        if encoding == ZSTD:
+            self._zstd = zstandard.ZstdDecompressor().decompressobj()
+        else:
+            self._inflater = zlib.decompressobj(31)
+
+    def decode(self, data: bytes) -> bytes:
+        if self.encoding == ZSTD:
+            return self._decode_zstd(data)
+        try:
+            # one byte over the limit is enough to know the body is too long
+            out = self._inflater.decompress(data, self.limit - self.size + 1)
+        except zlib.error as e:
+            raise ValueError(f"Données gzip invalides: {e}") from e
+        self.size += len(out)
+        if self.size > self.limit or self._inflater.unconsumed_tail:
+            raise ValueError(f"Données décompressées trop longues: plus de {self.limit} octets")
+        return out
+
+    def _decode_zstd(self, data: bytes) -> bytes:
+        # zstd has no output bound: feed it slices small enough that one
+        # cannot inflate much past what is left of the limit (a block is
+        # at most 128 KiB and takes at least 4 bytes); never less than
+        # _ZSTD_MIN_STEP bytes, so going past it costs at most 2 MiB
+        # before the check
+        parts: List[bytes] = []
+        view = memoryview(data)
+        position = 0
+        while position < len(view) and not self._zstd.eof:
+            step = max(_ZSTD_MIN_STEP, (self.limit - self.size) * _ZSTD_BLOCK_HEADER // _ZSTD_BLOCK_SIZE)
+            try:
+                out = self._zstd.decompress(view[position:position + step])
+            except zstandard.ZstdError as e:
+                raise ValueError(f"Données zstd invalides: {e}") from e
+            position += step
+            self.size += len(out)
+            if self.size > self.limit:
+                raise ValueError(f"Données décompressées trop longues: plus de {self.limit} octets")
+            parts.append(out)
+        return b"".join(parts)
+
+    def finish(self) -> bytes:
+        """What is left once the body has ended; ValueError if it was cut short."""
+        if self.encoding == ZSTD:
+            if not self._zstd.eof:
+                raise ValueError("Données zstd tronquées")
+            return b""
+        out = self._inflater.flush()
+        self.size += len(out)
+        if self.size > self.limit:
+            raise ValueError(f"Données décompressées trop longues: plus de {self.limit} octets")
+        if not self._inflater.eof:
+            raise ValueError("Données gzip tronquées")
+        return out
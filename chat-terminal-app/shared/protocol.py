@@ -0,0 +1,314 @@
+from __future__ import annotations
+
+import json
+import re
+import struct
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, List, Optional, Union
+
+Frame = Union[str, bytes]
+
+PROTOCOL_VERSION = 1
+
+# WebSocket subprotocols, agreed at connect time. The client lists the ones
+# it understands in order of preference and the server accepts the first it
+# knows; with no agreement both sides fall back to legacy text frames.
+JSON_SUBPROTOCOL = "chat.v1.json"
+BIN_SUBPROTOCOL = "chat.v1.bin"
+# Legacy "[tag:name] text" lines carried as UTF-8 binary frames.
+BINARY_SUBPROTOCOL = "chat.utf8-binary"
+
+# Event types
+CHAT = "chat"          # message from a peer
+ECHO = "echo"          # own message, echoed back
+PM = "pm"              # private message received
+PM_SENT = "pm_sent"    # private message delivered
+INFO = "info"
+ERROR = "error"
+SERVER = "server"      # free-form server text
+ONLINE = "online"      # presence delta: user came online
+OFFLINE = "offline"    # presence delta: user went offline
+USERS = "users"        # presence snapshot: space-separated usernames
+SESSION = "session"    # signed in as ``name``; text is the token for /resume
+BATCH = "batch"
+
+# Room every authenticated connection joins first
+DEFAULT_ROOM = "general"
+
+_LEGACY_TAGS = {CHAT: "peer", ECHO: "you", PM: "pm", PM_SENT: "pm-sent"}
+_TAG_TYPES = {tag: event_type for event_type, tag in _LEGACY_TAGS.items()}
+_LEGACY_LINE = re.compile(r"^\[(?P<tag>[^:\]]+):(?P<name>[^\]]+)\]\s?(?P<text>.*)$", re.DOTALL)
+
+
+class Event:
+    """One typed server-to-client message."""
+
+    __slots__ = ("type", "seq", "ts", "name", "text", "room")
+
+    def __init__(
+        self, type: str, text: str = "", name: str = "", seq: int = 0, ts: float = 0.0,
+        room: str = "",
+    ) -> None:
+        self.type = type
+        self.text = text
+        self.name = name
+        self.seq = seq
+        self.ts = ts
+        self.room = room
+
+    def stamp(self, seq: int = 0) -> None:
+        """Set the timestamp, and the stream sequence number if given, once."""
+        if not self.ts:
+            self.ts = time.time()
+        if seq and not self.seq:
+            self.seq = seq
+
+    def to_dict(self) -> dict:
+        data = {"v": PROTOCOL_VERSION, "t": self.type, "seq": self.seq, "ts": self.ts}
+        if self.name:
+            data["name"] = self.name
+        if self.room:
+            data["room"] = self.room
+        if self.text:
+            data["text"] = self.text
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Event":
+        return cls(
+            data["t"], data.get("text", ""), data.get("name", ""),
+            data.get("seq", 0), data.get("ts", 0.0), data.get("room", ""),
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f"Event({self.type!r}, seq={self.seq}, name={self.name!r}, "
+            f"room={self.room!r}, text={self.text!r})"
+        )
+
+
+def chat(name: str, text: str, room: str = "") -> Event:
+    return Event(CHAT, text, name, room=room)
+
+
+def echo(name: str, text: str, room: str = "") -> Event:
+    return Event(ECHO, text, name, room=room)
+
+
+def pm(sender: str, text: str) -> Event:
+    return Event(PM, text, sender)
+
+
+def pm_sent(recipient: str, text: str) -> Event:
+    return Event(PM_SENT, text, recipient)
+
+
+def info(text: str) -> Event:
+    return Event(INFO, text)
+
+
+def error(text: str) -> Event:
+    return Event(ERROR, text)
+
+
+def server_text(text: str) -> Event:
+    return Event(SERVER, text)
+
+
+def online(user: str) -> Event:
+    return Event(ONLINE, name=user)
+
+
+def offline(user: str) -> Event:
+    return Event(OFFLINE, name=user)
+
+
+def users(names: Iterable[str]) -> Event:
+    return Event(USERS, " ".join(names))
+
+
+def session(user: str, token: str) -> Event:
+    return Event(SESSION, token, user)
+
+
+def to_legacy(event: Event) -> str:
+    """Render an event in the original ``[tag:name] text`` line format."""
+    if event.type == INFO:
+        return f"[INFO] {event.text}"
+    if event.type == ERROR:
+        return f"[ERROR] {event.text}"
+    if event.type == ONLINE:
+        return f"[INFO] {event.name} est en ligne"
+    if event.type == OFFLINE:
+        return f"[INFO] {event.name} est hors ligne"
+    if event.type == USERS:
+        return f"[INFO] Utilisateurs connectés: {', '.join(event.text.split())}"
+    if event.type == SESSION:
+        # legacy clients cannot resume: no token
+        return f"[INFO] Connecté en tant que {event.name}"
+    tag = _LEGACY_TAGS.get(event.type)
+    if tag is None:
+        return event.text
+    if event.room and event.room != DEFAULT_ROOM:
+        return f"[{tag}:{event.name}#{event.room}] {event.text}"
+    return f"[{tag}:{event.name}] {event.text}"
+
+
+def from_legacy(message: str) -> Event:
+    """Parse a legacy text line into an event."""
+    if message.startswith("[ERROR]"):
+        return error(message[8:])
+    if message.startswith("[INFO]"):
+        return info(message[7:])
+    match = _LEGACY_LINE.match(message)
+    if match:
+        event_type = _TAG_TYPES.get(match.group("tag"))
+        if event_type is not None:
+            return Event(event_type, match.group("text"), match.group("name"))
+    return server_text(message)
+
+
+class Codec(ABC):
+    """Wire encoding of events for one negotiated subprotocol."""
+
+    subprotocol: Optional[str] = None
+    binary = False            # sent as binary frames
+    batching = False          # several events may share one frame
+
+    @abstractmethod
+    def encode(self, event: Event) -> Frame:
+        """One event as a frame payload."""
+
+    @abstractmethod
+    def encode_batch(self, payloads: List[Frame]) -> List[Frame]:
+        """Frames carrying already encoded events, in order."""
+
+    @abstractmethod
+    def decode(self, frame: Frame) -> List[Event]:
+        """Events carried by one received frame."""
+
+
+class LegacyTextCodec(Codec):
+    def encode(self, event: Event) -> Frame:
+        return to_legacy(event)
+
+    def encode_batch(self, payloads: List[Frame]) -> List[Frame]:
+        # Legacy peers read one line per frame: no batch frame.
+        return list(payloads)
+
+    def decode(self, frame: Frame) -> List[Event]:
+        if isinstance(frame, bytes):
+            frame = frame.decode("utf-8")
+        return [from_legacy(frame)]
+
+
+class LegacyBinaryCodec(LegacyTextCodec):
+    subprotocol = BINARY_SUBPROTOCOL
+    binary = True
+
+    def encode(self, event: Event) -> Frame:
+        return to_legacy(event).encode("utf-8")
+
+
+class JsonCodec(Codec):
+    """Compact JSON objects; a batch is ``{"v":1,"t":"batch","events":[...]}``."""
+
+    subprotocol = JSON_SUBPROTOCOL
+    binary = True
+    batching = True
+
+    _BATCH_HEAD = b'{"v":%d,"t":"batch","events":[' % PROTOCOL_VERSION
+
+    def encode(self, event: Event) -> Frame:
+        return json.dumps(event.to_dict(), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def encode_batch(self, payloads: List[Frame]) -> List[Frame]:
+        # Payloads are already encoded objects: splice them, no re-encoding.
+        return [self._BATCH_HEAD + b",".join(payloads) + b"]}"]
+
+    def decode(self, frame: Frame) -> List[Event]:
+        data = json.loads(frame)
+        if data.get("t") == BATCH:
+            return [Event.from_dict(item) for item in data.get("events", [])]
+        return [Event.from_dict(data)]
+
+
+class BinaryCodec(Codec):
+    """Fixed header followed by length-prefixed UTF-8 fields.
+
+    Event: ``version:u8 type:u8 seq:u64 ts:f64 name_len:u16 room_len:u16
+    text_len:u32`` then the name, room and text bytes. Batch: ``version:u8
+    0:u8 count:u16`` then ``count`` events back to back.
+    """
+
+    subprotocol = BIN_SUBPROTOCOL
+    binary = True
+    batching = True
+
+    _HEADER = struct.Struct("!BBQdHHI")
+    _BATCH = struct.Struct("!BBH")
+    _TYPE_CODES: Dict[str, int] = {
+        BATCH: 0, CHAT: 1, ECHO: 2, PM: 3, PM_SENT: 4, INFO: 5, ERROR: 6, SERVER: 7,
+        ONLINE: 8, OFFLINE: 9, USERS: 10, SESSION: 11,
+    }
+    _CODE_TYPES = {code: event_type for event_type, code in _TYPE_CODES.items()}
+
+    def encode(self, event: Event) -> Frame:
+        name = event.name.encode("utf-8")
+        room = event.room.encode("utf-8")
+        text = event.text.encode("utf-8")
+        header = self._HEADER.pack(
+            PROTOCOL_VERSION, self._TYPE_CODES[event.type], event.seq, event.ts,
+            len(name), len(room), len(text),
+        )
+        return header + name + room + text
+
+    def encode_batch(self, payloads: List[Frame]) -> List[Frame]:
+        return [self._BATCH.pack(PROTOCOL_VERSION, 0, len(payloads)) + b"".join(payloads)]
+
+    def decode(self, frame: Frame) -> List[Event]:
+        view = memoryview(frame)
+        if len(view) >= self._BATCH.size and view[1] == 0:
+            _, _, count = self._BATCH.unpack_from(view)
+            offset = self._BATCH.size
+        else:
+            count, offset = 1, 0
+        events: List[Event] = []
+        for _ in range(count):
+            _, code, seq, ts, name_len, room_len, text_len = self._HEADER.unpack_from(view, offset)
+            offset += self._HEADER.size
+            name = bytes(view[offset:offset + name_len]).decode("utf-8")
+            offset += name_len
+            room = bytes(view[offset:offset + room_len]).decode("utf-8")
+            offset += room_len
+            text = bytes(view[offset:offset + text_len]).decode("utf-8")
+            offset += text_len
+            events.append(Event(self._CODE_TYPES.get(code, SERVER), text, name, seq, ts, room))
+        return events
+
+
+LEGACY_TEXT = LegacyTextCodec()
+CODECS: Dict[str, Codec] = {
+    codec.subprotocol: codec for codec in (JsonCodec(), BinaryCodec(), LegacyBinaryCodec())
+}
+# What a client offers for each ``--protocol`` choice, best first.
+CLIENT_OFFERS: Dict[str, List[str]] = {
+    "json": [JSON_SUBPROTOCOL, BINARY_SUBPROTOCOL],
+    "bin": [BIN_SUBPROTOCOL, JSON_SUBPROTOCOL, BINARY_SUBPROTOCOL],
+    "text": [],
+}
+
+
+def negotiate(offered: Iterable[str]) -> Codec:
+    """Pick the first offered subprotocol we support, else legacy text."""
+    for subprotocol in offered:
+        codec = CODECS.get(subprotocol)
+        if codec is not None:
+            return codec
+    return LEGACY_TEXT
+
+
+def codec_for(subprotocol: Optional[str]) -> Codec:
+    """Codec matching the subprotocol the server accepted."""
+    return CODECS.get(subprotocol or "", LEGACY_TEXT)
@@ -1,16 +1,31 @@
 from __future__ import annotations
 
 import hashlib
+import os
 from pathlib import Path
 from datetime import datetime
 
 
-def compute_sha256(file_path: str | Path) -> str:
+def compute_sha256(file_path: str | Path, offset: int = 0, length: int | None = None) -> str:
+    """Hex SHA-256 of a file, or of ``length`` bytes from ``offset``.
+
+    Streams the file through one reused 1 MiB buffer (``readinto``), so
+    hashing a large file allocates nothing per read and memory stays flat.
+    """
     path = Path(file_path)
     digest = hashlib.sha256()
-    with path.open("rb") as fp:
-        for chunk in iter(lambda: fp.read(1024 * 1024), b""):
-            digest.update(chunk)
+    buffer = bytearray(1024 * 1024)
+    view = memoryview(buffer)
+    remaining = length
+    with path.open("rb", buffering=0) as fp:
+        fp.seek(offset)
+        while remaining is None or remaining > 0:
+            size = fp.readinto(view if remaining is None or remaining >= len(buffer) else view[:remaining])
+            if not size:
+                break
+            digest.update(view[:size])
+            if remaining is not None:
+                remaining -= size
     return digest.hexdigest()
 
 
@@ -18,3 +33,15 @@ def iso_timestamp() -> str:
     return datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
 
 
+def env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
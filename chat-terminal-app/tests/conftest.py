@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import asyncio
+import os
+
+import httpx
+import pytest
+from fastapi import WebSocketDisconnect
+
+from server.file_handler import FSYNC_NONE, UploadStorage
+from shared import protocol
+
+
+class FakeSocket:
+    """WebSocket stand-in: text frames in through ``incoming``, decoded events out in ``events``.
+
+    ``stalled`` makes every send hang, like a peer that stopped reading,
+    until ``reading.set()``.
+    """
+
+    def __init__(self, subprotocols=(protocol.JSON_SUBPROTOCOL,), token=None, stalled=False):
+        self.scope = {"subprotocols": list(subprotocols)}
+        self.headers = {"authorization": f"Bearer {token}"} if token else {}
+        self.query_params = {}
+        self.codec = protocol.LEGACY_TEXT
+        self.reading = asyncio.Event()
+        if not stalled:
+            self.reading.set()
+        self.incoming: asyncio.Queue = asyncio.Queue()
+        self.events = []
+        self.closed_with = None
+        self._arrived = asyncio.Event()
+
+    async def accept(self, subprotocol=None):
+        self.codec = protocol.codec_for(subprotocol)
+
+    async def receive_text(self):
+        text = await self.incoming.get()
+        if text is None:
+            raise WebSocketDisconnect(1000)
+        return text
+
+    async def send_text(self, frame):
+        await self._send(frame)
+
+    async def send_bytes(self, frame):
+        await self._send(frame)
+
+    async def _send(self, frame):
+        await self.reading.wait()
+        self.events += self.codec.decode(frame)
+        self._arrived.set()
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+    async def expect(self, event_type, text="", timeout=2.0):
+        """First event of ``event_type`` whose text contains ``text``, consumed."""
+        async def find():
+            while True:
+                for index, event in enumerate(self.events):
+                    if event.type == event_type and text in event.text:
+                        return self.events.pop(index)
+                self._arrived.clear()
+                await self._arrived.wait()
+        return await asyncio.wait_for(find(), timeout)
+
+    async def command(self, text, event_type=None, expected="", timeout=2.0):
+        """Send ``text``; with ``event_type``, wait for the matching reply."""
+        self.incoming.put_nowait(text)
+        if event_type is not None:
+            return await self.expect(event_type, expected, timeout)
+
+
+class AppTransport(httpx.ASGITransport):
+    """ASGI transport to the app that records the requests it carries.
+
+    ``fail``, when set, is awaited with each request before it is sent and
+    may raise (network error) or hang (slow server).
+    """
+
+    def __init__(self, app):
+        super().__init__(app=app)
+        self.requests = []
+        self.fail = None
+
+    async def handle_async_request(self, request):
+        self.requests.append(request)
+        if self.fail is not None:
+            await self.fail(request)
+        return await super().handle_async_request(request)
+
+
+@pytest.fixture(scope="session")
+def anyio_backend() -> str:
+    return "asyncio"
+
+
+@pytest.fixture
+def storage(tmp_path):
+    store = UploadStorage(tmp_path / "uploads", tmp_path / "uploads.partial", fsync=FSYNC_NONE)
+    store.open()
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def write_temp(storage):
+    """Write ``data`` to a fresh file in the partial directory, ready to publish."""
+    def write(data: bytes):
+        path = storage.temp_path()
+        path.write_bytes(data)
+        return path
+    return write
+
+
+@pytest.fixture
+def fake_socket():
+    """The ``FakeSocket`` class, for tests driving a ConnectionManager directly."""
+    return FakeSocket
+
+
+@pytest.fixture(scope="session")
+def server_app(tmp_path_factory):
+    """``server.app`` configured to keep all its files in a scratch directory.
+
+    The module builds its singletons from the environment at import time,
+    so it is imported once, from there, for the whole session.
+    """
+    root = tmp_path_factory.mktemp("server")
+    previous = os.getcwd()
+    os.chdir(root)
+    os.environ.update({
+        "CHAT_UPLOADS_DIR": str(root / "uploads"),
+        "CHAT_UPLOAD_FSYNC": "none",
+        "CHAT_FILES_REFRESH_SECONDS": "0",
+    })
+    from server import app as module
+    yield module
+    os.chdir(previous)
+
+
+@pytest.fixture(scope="session")
+async def client(server_app):
+    app = server_app.app
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as http:
+            yield http
+
+
+@pytest.fixture
+async def connect(client, server_app):
+    """Open ``FakeSocket`` connections on ``/ws``; they are all closed afterwards."""
+    opened = []
+
+    async def open_socket(**options) -> FakeSocket:
+        websocket = FakeSocket(**options)
+        opened.append((websocket, asyncio.create_task(server_app.websocket_endpoint(websocket))))
+        await asyncio.sleep(0)
+        return websocket
+
+    yield open_socket
+    for websocket, _ in opened:
+        websocket.incoming.put_nowait(None)
+    await asyncio.wait_for(asyncio.gather(*(task for _, task in opened), return_exceptions=True), 5)
+
+
+@pytest.fixture
+async def sign_up(client, server_app):
+    """Create an account and return a session token for it."""
+    auth = server_app.auth
+
+    async def create(username: str, password: str = "secret") -> str:
+        assert await auth.register_async(username, password)
+        return await auth.login_async(username, password)
+
+    return create
+
+
+@pytest.fixture
+def app_transport(client, server_app, monkeypatch):
+    """Route the HTTP clients built by ``client.file_sender`` and
+    ``client.file_receiver`` to the app; returns the ``AppTransport``."""
+    transport = AppTransport(server_app.app)
+    async_client = httpx.AsyncClient
+
+    def routed(*args, **kwargs):
+        return async_client(*args, **{**kwargs, "transport": transport})
+
+    monkeypatch.setattr(httpx, "AsyncClient", routed)
+    return transport
@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+import threading
+
+import pytest
+
+from client.auth_manager import AuthManager
+from client.user_store import User, UserStore
+
+pytestmark = pytest.mark.anyio
+
+
+def test_user_cache_is_bounded(tmp_path):
+    store = UserStore(tmp_path / "users.db", cache_size=2)
+    for name in ("ann", "bob", "cid"):
+        store.add(User(name, "hash"))
+    store.get("ann")
+    assert list(store._cache) == ["cid", "ann"]
+    store.close()
+
+
+def test_user_cache_sees_other_connections(tmp_path):
+    server = UserStore(tmp_path / "users.db")
+    other = UserStore(tmp_path / "users.db")
+    server.add(User("ann", "old"))
+    assert server.get("ann").password_hash == "old"
+
+    user = other.get("ann")
+    user.password_hash = "new"
+    other.save(user)
+    assert server.get("ann").password_hash == "new"
+    other.delete("ann")
+    assert server.get("ann") is None
+    server.close()
+    other.close()
+
+
+async def test_auth_database_is_used_off_the_loop(tmp_path, monkeypatch):
+    auth = AuthManager(str(tmp_path / "config"))
+    auth.open()
+    threads = set()
+    get = UserStore.get
+
+    def tracking_get(self, username):
+        threads.add(threading.current_thread().name)
+        return get(self, username)
+
+    monkeypatch.setattr(UserStore, "get", tracking_get)
+    assert await auth.register_async("ann", "secret")
+    token = await auth.login_async("ann", "secret")
+    assert token is not None
+    assert (await auth.verify_token_async(token)).username == "ann"
+    assert await auth.revoke_token_async(token)
+    assert await auth.verify_token_async(token) is None
+    assert threads and all(name.startswith("auth-db") for name in threads)
+    auth.users.close()
+    auth.active_tokens.stop()
@@ -0,0 +1,57 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import socket
+
+import pytest
+
+from server.bus import MessageBus, _Broker, _encode
+
+pytestmark = pytest.mark.anyio
+
+
+async def _connect(path: str, worker: str):
+    reader, writer = await asyncio.open_unix_connection(path, limit=16 * 1024 * 1024)
+    writer.write(_encode({"op": "hello", "worker": worker, "last_seq": 0, "presence": []}))
+    await writer.drain()
+    return reader, writer
+
+
+async def test_worker_that_stops_reading_is_disconnected(tmp_path):
+    path = str(tmp_path / "bus.sock")
+    broker = _Broker(path, drain_timeout=0.2)
+    await broker.start()
+    # outside the event loop: nothing reads what the broker sends it
+    slow = socket.socket(socket.AF_UNIX)
+    slow.connect(path)
+    slow.sendall(_encode({"op": "hello", "worker": "slow", "last_seq": 0, "presence": []}))
+    fast_reader, fast = await _connect(path, "fast")
+
+    async def read_all(count: int) -> list:
+        seqs = []
+        while len(seqs) < count:
+            message = json.loads(await fast_reader.readline())
+            if message["op"] == "room":
+                seqs.append(message["event"]["seq"])
+        return seqs
+
+    count = 64
+    reading = asyncio.create_task(read_all(count))
+    text = "x" * (256 * 1024)
+    for _ in range(count):
+        fast.write(_encode({"op": "room", "room": "general", "event": {"type": "chat", "text": text}}))
+        await fast.drain()
+    # the fast worker keeps getting every message, in order
+    assert await asyncio.wait_for(reading, 10) == list(range(1, count + 1))
+    assert broker.disconnected_slow == 1
+    assert sorted(broker._clients.values()) == ["fast"]
+
+    slow.close()
+    fast.close()
+    await broker.stop()
+
+
+def test_message_bus_is_abstract():
+    with pytest.raises(TypeError):
+        MessageBus()
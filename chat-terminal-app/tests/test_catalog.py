@@ -0,0 +1,23 @@
+from __future__ import annotations
+
+import pytest
+
+from server.catalog import FileCatalog
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_refresh_waits_for_ttl_unless_forced(storage, write_temp):
+    catalog = FileCatalog(storage, ttl=3600)
+    await catalog.refresh()
+    storage.publish(write_temp(b"late"), "late.txt")
+    await catalog.refresh()
+    assert catalog.get("late.txt") is None
+    await catalog.refresh(force=True)
+    assert catalog.get("late.txt").size == 4
+
+
+async def test_version_is_readable_while_a_write_holds_the_lock(storage):
+    # a publish in progress holds the write lock; the version comes from the reader
+    with storage._transaction():
+        assert isinstance(storage.version(), int)
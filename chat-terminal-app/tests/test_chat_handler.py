@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import pytest
+
+from client import chat_handler
+from client.auth_manager import auth_manager
+from shared import protocol
+
+pytestmark = pytest.mark.anyio
+
+
+class _ServerSocket:
+    """Client side of the WebSocket: ``frames`` come from the server, ``sent`` records what the client sends."""
+
+    def __init__(self, subprotocol=protocol.JSON_SUBPROTOCOL):
+        self.subprotocol = subprotocol
+        self.frames = []
+        self.sent = []
+
+    async def send(self, text):
+        self.sent.append(text)
+
+    def receive(self, *events):
+        codec = protocol.codec_for(self.subprotocol)
+        self.frames = [codec.encode(event) for event in events]
+
+    async def __aiter__(self):
+        for frame in self.frames:
+            yield frame
+
+
+@pytest.fixture(autouse=True)
+def ui_state(monkeypatch):
+    state = chat_handler.UIState()
+    monkeypatch.setattr(chat_handler, "ui_state", state)
+    # the session tokens stay out of the user's files
+    monkeypatch.setattr(auth_manager, "remember_server_token", lambda *args: None)
+    monkeypatch.setattr(auth_manager, "forget_server_token", lambda *args: None)
+    return state
+
+
+def _type(monkeypatch, *lines):
+    """Feed ``lines`` to the prompt, then end of input."""
+    typed = iter(lines)
+
+    def read():
+        try:
+            return next(typed)
+        except StopIteration:
+            raise EOFError from None
+
+    monkeypatch.setattr("builtins.input", read)
+
+
+async def test_login_follow_ups_wait_for_the_session(monkeypatch, ui_state):
+    websocket = _ServerSocket()
+    ui_state.last_seq = 42
+    _type(monkeypatch, "/login alice wrong")
+    await chat_handler.chat_send_loop(websocket, "http://test")
+    assert websocket.sent == ["/login alice wrong"]
+
+    # a refused login does not bring extra errors
+    websocket.receive(protocol.error("Identifiants invalides"))
+    await chat_handler.chat_receive_loop(websocket)
+    assert websocket.sent == ["/login alice wrong"]
+
+    websocket.sent.clear()
+    _type(monkeypatch, "/login alice secret")
+    await chat_handler.chat_send_loop(websocket, "http://test")
+    websocket.receive(protocol.session("alice", "token"))
+    await chat_handler.chat_receive_loop(websocket)
+    assert websocket.sent == ["/login alice secret", "/backfill 42", "/presence on"]
+    assert ui_state.username == "alice" and not ui_state.awaiting_session
+
+
+async def test_legacy_login_sends_follow_ups_at_once(monkeypatch):
+    # text servers never send SESSION
+    websocket = _ServerSocket(subprotocol=None)
+    _type(monkeypatch, "/login alice secret")
+    await chat_handler.chat_send_loop(websocket, "http://test")
+    assert websocket.sent == ["/login alice secret", "/backfill 0", "/presence on"]
+
+
+async def test_resume_follow_ups_wait_for_the_session(monkeypatch, ui_state):
+    websocket = _ServerSocket()
+    monkeypatch.setattr(auth_manager, "server_token", lambda server: ("alice", "token"))
+    await chat_handler._resume_session(websocket)
+    assert websocket.sent == ["/resume token"]
+
+    websocket.receive(protocol.session("alice", "token"))
+    await chat_handler.chat_receive_loop(websocket)
+    assert websocket.sent == ["/resume token", "/backfill 0", "/presence on"]
+    assert not ui_state.resuming
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import hashlib
+import time
+
+import pytest
+
+from server.chunked_upload import MAX_CHUNKS, MIN_CHUNK_SIZE, ChunkedUploads, UploadError
+
+pytestmark = pytest.mark.anyio
+
+CHUNK = MIN_CHUNK_SIZE
+DATA = bytes(range(256)) * (CHUNK * 3 // 256) + b"tail"
+
+
+def _sha(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _chunk(index: int) -> bytes:
+    return DATA[index * CHUNK:(index + 1) * CHUNK]
+
+
+async def _body(data: bytes):
+    yield data
+
+
+async def _init(client, name: str, data: bytes = DATA) -> dict:
+    response = await client.post(
+        "/upload/init", json={"filename": name, "size": len(data), "sha256": _sha(data), "chunk_size": CHUNK}
+    )
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+async def _put(client, upload_id: str, index: int, sha256: str = None):
+    data = _chunk(index)
+    return await client.put(
+        f"/upload/{upload_id}", params={"offset": index * CHUNK}, content=data,
+        headers={"x-chunk-sha256": sha256 or _sha(data)},
+    )
+
+
+async def test_bad_chunk_hash_is_rejected_then_resumed(client):
+    state = await _init(client, "chunked-resume.bin")
+    assert state["chunks"] == 4 and state["received_ranges"] == []
+
+    response = await _put(client, state["upload_id"], 0, sha256="0" * 64)
+    assert response.status_code == 422
+    assert (await _put(client, state["upload_id"], 0)).status_code == 200
+    assert (await _put(client, state["upload_id"], 2)).status_code == 200
+    assert (await client.post(f"/upload/{state['upload_id']}/finalize")).status_code == 409
+
+    # the same file announced again resumes the same transfer
+    resumed = await _init(client, "chunked-resume.bin")
+    assert resumed["upload_id"] == state["upload_id"]
+    assert resumed["received_ranges"] == [[0, 0], [2, 2]]
+    assert resumed["next_offset"] == CHUNK
+
+    for index in (1, 3):
+        assert (await _put(client, state["upload_id"], index)).status_code == 200
+    assert (await client.get(f"/upload/{state['upload_id']}")).json()["received_ranges"] == [[0, 3]]
+    response = await client.post(f"/upload/{state['upload_id']}/finalize")
+    assert response.status_code == 200, response.text
+    assert (await client.get("/uploads/chunked-resume.bin")).content == DATA
+    assert (await client.get(f"/upload/{state['upload_id']}")).status_code == 404
+
+
+async def test_oversized_upload_is_refused(client):
+    response = await client.post(
+        "/upload/init", json={"filename": "huge.bin", "size": 1 << 50, "sha256": "a" * 64}
+    )
+    assert response.status_code == 413
+
+
+async def test_chunk_count_is_capped(storage):
+    uploads = ChunkedUploads(storage, max_chunk_size=CHUNK * 2)
+    state = await uploads.init("many.bin", (MAX_CHUNKS + 1) * CHUNK, "b" * 64, CHUNK)
+    assert state["chunks"] <= MAX_CHUNKS
+    assert state["chunk_size"] > CHUNK
+    with pytest.raises(UploadError) as raised:
+        await uploads.init("too-many.bin", MAX_CHUNKS * CHUNK * 2 + 1, "c" * 64, CHUNK)
+    assert raised.value.status == 413
+
+
+async def test_state_is_shared_between_workers(storage):
+    first = ChunkedUploads(storage)
+    second = ChunkedUploads(storage)
+    state = await first.init("shared.bin", len(DATA), _sha(DATA), CHUNK)
+
+    # another worker receives the chunks and announces the same file
+    assert (await second.init("shared.bin", len(DATA), _sha(DATA), CHUNK))["upload_id"] == state["upload_id"]
+    for index in range(state["chunks"]):
+        await second.put_chunk(state["upload_id"], index * CHUNK, _body(_chunk(index)), _sha(_chunk(index)))
+
+    assert (await first.status(state["upload_id"]))["complete"]
+    stored = await first.finalize(state["upload_id"])
+    assert stored.sha256 == _sha(DATA)
+    with pytest.raises(UploadError) as raised:
+        await second.status(state["upload_id"])
+    assert raised.value.status == 404
+
+
+async def test_old_uploads_are_expired(storage):
+    uploads = ChunkedUploads(storage, max_age=60)
+    state = await uploads.init("old.bin", len(DATA), _sha(DATA), CHUNK)
+    assert uploads.expire() == 0
+    assert uploads.expire(now=time.time() + 120) == 1
+    assert list(storage.partial_root.glob(f"{state['upload_id']}.*")) == []
+    assert list(storage.partial_root.glob("*.key")) == []
+    with pytest.raises(UploadError):
+        await uploads.status(state["upload_id"])
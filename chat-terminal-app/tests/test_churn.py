@@ -0,0 +1,115 @@
+"""Connection churn: connect/disconnect cycles must not grow memory.
+
+Every cycle drives the real ``websocket_endpoint`` with a scripted socket:
+half of the connections stay anonymous, the other half are signed in
+(through the ``_sign_in`` helper ``/login`` uses, to keep password hashing
+out of the measurement), join and leave a room, send a private message to
+themselves and subscribe to presence. Some connections close cleanly,
+others drop without a closing handshake. After a warm-up, traced memory,
+the session registry footprint and every registry must be back where they
+started.
+
+The 100k-cycle run is opt-in: ``python -m pytest --slow tests/test_churn.py``.
+"""
+from __future__ import annotations
+
+import gc
+import tracemalloc
+
+import pytest
+from fastapi import WebSocketDisconnect
+
+pytestmark = pytest.mark.anyio
+
+WARMUP = 500
+
+
+class _ScriptedSocket:
+    """Plays a fixed script of incoming lines, then disconnects."""
+
+    def __init__(self, script: list, abrupt: bool) -> None:
+        self.scope = {"subprotocols": ["chat.v1.json"]}
+        self.headers: dict = {}
+        self.query_params: dict = {}
+        self.script = script
+        self.abrupt = abrupt
+        self.position = 0
+
+    async def accept(self, subprotocol: str | None = None) -> None:
+        pass
+
+    async def receive_text(self) -> str:
+        while self.position < len(self.script):
+            step = self.script[self.position]
+            self.position += 1
+            if callable(step):
+                await step(self)
+                continue
+            return step
+        # 1006: the peer went away without a closing handshake
+        raise WebSocketDisconnect(1006 if self.abrupt else 1000)
+
+    async def send_text(self, text: str) -> None:
+        pass
+
+    async def send_bytes(self, data: bytes) -> None:
+        pass
+
+    async def close(self, code: int = 1000) -> None:
+        pass
+
+
+def _script(server_app, cycle: int) -> list:
+    if cycle % 2:
+        return ["/users", "/rooms", "hello?"]
+    name = f"churner{cycle % 50}"
+
+    async def sign_in(websocket: _ScriptedSocket) -> None:
+        await server_app._sign_in(server_app.sessions.get(websocket), name)
+
+    return [sign_in, "/presence on", "/join churn", f"/msg {name} ping", "/users", "/leave churn"]
+
+
+def _state(server_app) -> dict:
+    manager = server_app.manager
+    return {
+        "sessions": len(server_app.sessions),
+        "session_users": server_app.sessions.stats()["users"],
+        "session_tokens": server_app.sessions.stats()["tokens"],
+        "subscribers": len(server_app.sessions.presence_subscribers),
+        "outboxes": len(manager._outboxes),
+        "rooms": len(manager.rooms),
+        "online": len(server_app.presence.online_users()),
+        "limiter_connections": len(server_app.limiter._connections),
+        "limiter_users": len(server_app.limiter._users),
+    }
+
+
+async def _cycles(server_app, start: int, count: int) -> None:
+    for cycle in range(start, start + count):
+        await server_app.websocket_endpoint(_ScriptedSocket(_script(server_app, cycle), abrupt=cycle % 7 == 0))
+
+
+def _traced() -> int:
+    gc.collect()
+    return tracemalloc.get_traced_memory()[0]
+
+
+@pytest.mark.parametrize("cycles, tolerance", [
+    (2_000, 128 * 1024),
+    pytest.param(100_000, 512 * 1024, marks=pytest.mark.slow),
+])
+async def test_churn_keeps_memory_flat(client, server_app, cycles, tolerance):
+    before = _state(server_app)
+    tracemalloc.start()
+    try:
+        await _cycles(server_app, 0, WARMUP)
+        baseline = _traced()
+        footprint = server_app.sessions.memory_footprint()
+        await _cycles(server_app, WARMUP, cycles)
+        growth = _traced() - baseline
+    finally:
+        tracemalloc.stop()
+    assert _state(server_app) == before
+    assert server_app.sessions.memory_footprint() == footprint
+    assert growth < tolerance, f"traced memory grew by {growth / 1024:.0f} KiB over {cycles} cycles"
@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import hashlib
+
+import pytest
+
+from shared.compression import ENCODINGS, GZIP, ZSTD, Decoder, compress
+
+pytestmark = pytest.mark.anyio
+
+CODECS = [GZIP, pytest.param(ZSTD, marks=pytest.mark.skipif(ZSTD not in ENCODINGS, reason="zstandard absent"))]
+LIMIT = 64 * 1024
+BOMB = b"\0" * (32 * 1024 * 1024)
+
+
+@pytest.mark.parametrize("encoding", CODECS)
+def test_round_trip_in_pieces(encoding):
+    data = b"line of a log file\n" * 5000
+    body = compress(data, encoding)
+    decoder = Decoder(encoding, len(data))
+    out = b"".join(decoder.decode(body[index:index + 100]) for index in range(0, len(body), 100))
+    assert out + decoder.finish() == data
+
+
+@pytest.mark.parametrize("encoding", CODECS)
+def test_bomb_stops_at_the_limit(encoding):
+    body = compress(BOMB, encoding)
+    decoder = Decoder(encoding, LIMIT)
+    with pytest.raises(ValueError, match="trop longues"):
+        decoder.decode(body)
+    assert decoder.size <= LIMIT + 2 * 1024 * 1024
+
+
+@pytest.mark.parametrize("encoding", CODECS)
+def test_truncated_body_is_rejected(encoding):
+    body = compress(b"x" * 10000, encoding)
+    decoder = Decoder(encoding, LIMIT)
+    decoder.decode(body[:-4])
+    with pytest.raises(ValueError, match="tronquées"):
+        decoder.finish()
+
+
+@pytest.mark.parametrize("encoding", CODECS)
+async def test_compressed_bomb_chunk_is_refused(client, encoding):
+    data = encoding.encode() * (100 * 1024)
+    response = await client.post("/upload/init", json={
+        "filename": f"bomb-{encoding}.log", "size": len(data), "sha256": hashlib.sha256(data).hexdigest(),
+    })
+    state = response.json()
+    assert encoding in state["encodings"]
+
+    response = await client.put(
+        f"/upload/{state['upload_id']}", params={"offset": 0}, content=compress(BOMB, encoding),
+        headers={"content-encoding": encoding, "x-chunk-sha256": hashlib.sha256(data).hexdigest()},
+    )
+    assert response.status_code == 400
+    assert (await client.get(f"/upload/{state['upload_id']}")).json()["received_ranges"] == []
+
+    response = await client.put(
+        f"/upload/{state['upload_id']}", params={"offset": 0}, content=compress(data, encoding),
+        headers={"content-encoding": encoding, "x-chunk-sha256": hashlib.sha256(data).hexdigest()},
+    )
+    assert response.status_code == 200, response.text
+    assert (await client.post(f"/upload/{state['upload_id']}/finalize")).status_code == 200
@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from server.websocket_handler import ConnectionManager, SlowConsumerPolicy
+from shared import protocol
+
+pytestmark = pytest.mark.anyio
+
+
+async def _connected(manager, fake_socket, count=1, **options):
+    sockets = [fake_socket(**options) for _ in range(count)]
+    for websocket in sockets:
+        await manager.connect(websocket)
+    return sockets
+
+
+async def _close_all(manager, *sockets):
+    for websocket in sockets:
+        websocket.reading.set()
+        await manager.close(websocket)
+
+
+def _texts(websocket):
+    return [event.text for event in websocket.events]
+
+
+async def test_drop_oldest_keeps_the_newest(fake_socket):
+    manager = ConnectionManager(max_queue_messages=3, close_timeout=0.05)
+    (slow,) = await _connected(manager, fake_socket, stalled=True)
+    for index in range(10):
+        await manager.send_event(slow, protocol.info(f"m{index}"))
+    assert manager.counters["dropped"] == 7
+    assert manager.stats()["queued_messages"] == 3
+
+    slow.reading.set()
+    await slow.expect(protocol.INFO, "m9")
+    assert _texts(slow) == ["m7", "m8"]
+    assert manager.total_queued_bytes == 0
+    await _close_all(manager, slow)
+
+
+async def test_disconnect_policy_drops_the_slow_consumer(fake_socket):
+    manager = ConnectionManager(max_queue_messages=2, policy=SlowConsumerPolicy.DISCONNECT, close_timeout=0.05)
+    slow, fast = await _connected(manager, fake_socket, 2)
+    slow.reading.clear()
+    for index in range(4):
+        await manager.broadcast_event(protocol.info(f"m{index}"))
+        await asyncio.sleep(0)  # the writers run: the fast one keeps up
+    assert manager.counters["slow_disconnects"] == 1
+    assert slow not in manager.active_connections and fast in manager.active_connections
+    await asyncio.sleep(0.01)
+    assert slow.closed_with == 1008
+    assert manager.total_queued_bytes == sum(
+        len(frame.encoded(outbox.codec)) for outbox in manager._outboxes.values() for frame in outbox.messages
+    )
+    await fast.expect(protocol.INFO, "m3")
+    await _close_all(manager, fast)
+
+
+async def test_backpressure_waits_for_room_without_holding_fast_peers(fake_socket):
+    manager = ConnectionManager(
+        max_queue_messages=1, policy=SlowConsumerPolicy.BACKPRESSURE, backpressure_timeout=2.0, close_timeout=0.05,
+    )
+    slow, fast = await _connected(manager, fake_socket, 2)
+    slow.reading.clear()
+    await manager.broadcast_event(protocol.info("m0"))
+    await asyncio.sleep(0)  # the writers take m0; the slow one hangs in send
+    await manager.broadcast_event(protocol.info("m1"))
+    sending = asyncio.create_task(manager.broadcast_event(protocol.info("m2")))
+    await fast.expect(protocol.INFO, "m2")
+    assert not sending.done()
+
+    slow.reading.set()
+    await asyncio.wait_for(sending, 1)
+    await slow.expect(protocol.INFO, "m2")
+    assert _texts(slow) == ["m0", "m1"]
+    assert manager.counters["dropped"] == manager.counters["slow_disconnects"] == 0
+    await _close_all(manager, slow, fast)
+
+
+async def test_backpressure_gives_up_after_the_timeout(fake_socket):
+    manager = ConnectionManager(
+        max_queue_messages=1, policy=SlowConsumerPolicy.BACKPRESSURE, backpressure_timeout=0.1, close_timeout=0.05,
+    )
+    (slow,) = await _connected(manager, fake_socket, stalled=True)
+    await manager.send_event(slow, protocol.info("m0"))
+    await asyncio.sleep(0)
+    await manager.send_event(slow, protocol.info("m1"))
+    await asyncio.wait_for(manager.send_event(slow, protocol.info("m2")), 1)
+    assert manager.counters["slow_disconnects"] == 1
+    assert slow not in manager.active_connections
+    assert manager.total_queued_bytes == 0
+
+
+async def test_global_budget_is_shared_by_all_queues(fake_socket):
+    size = len(ConnectionManager().frame(protocol.info("x" * 100)).encoded(protocol.codec_for(protocol.JSON_SUBPROTOCOL)))
+    manager = ConnectionManager(max_total_bytes=size * 5 // 2, close_timeout=0.05)
+    first, second = await _connected(manager, fake_socket, 2, stalled=True)
+    for index in range(3):
+        await manager.send_event(first, protocol.info(f"{index}" + "x" * 99))
+        assert manager.total_queued_bytes <= manager.max_total_bytes
+    # the first queue holds the budget: the second cannot queue anything
+    await manager.send_event(second, protocol.info("y" * 100))
+    assert manager.total_queued_bytes <= manager.max_total_bytes
+    assert manager.counters["dropped"] >= 2
+
+    manager.disconnect(first)
+    await manager.send_event(second, protocol.info("z" * 100))
+    second.reading.set()
+    await second.expect(protocol.INFO, "z" * 100)
+    await _close_all(manager, second)
+
+
+async def test_watchdog_drops_a_stalled_send(fake_socket):
+    manager = ConnectionManager(send_timeout=0.1, close_timeout=0.05)
+    (slow,) = await _connected(manager, fake_socket, stalled=True)
+    await manager.send_event(slow, protocol.info("never read"))
+    for _ in range(50):
+        if slow not in manager.active_connections:
+            break
+        await asyncio.sleep(0.02)
+    assert slow not in manager.active_connections
+    assert manager.counters["send_failures"] == 1 and manager.counters["slow_disconnects"] == 1
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import hashlib
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+DATA = bytes(range(256)) * 40
+
+
+@pytest.fixture
+async def stored(client):
+    response = await client.post("/upload", files={"file": ("ranges.bin", DATA)})
+    assert response.status_code == 200, response.text
+    return f'"{hashlib.sha256(DATA).hexdigest()}"'
+
+
+async def test_etag_and_if_none_match(client, stored):
+    response = await client.get("/uploads/ranges.bin")
+    assert response.status_code == 200
+    assert response.headers["etag"] == stored
+    assert response.headers["accept-ranges"] == "bytes"
+
+    for header in (stored, f"W/{stored}", f'"other", {stored}', "*"):
+        response = await client.get("/uploads/ranges.bin", headers={"if-none-match": header})
+        assert response.status_code == 304, header
+        assert response.content == b""
+        assert response.headers["etag"] == stored
+    response = await client.get("/uploads/ranges.bin", headers={"if-none-match": '"other"'})
+    assert response.status_code == 200 and response.content == DATA
+
+
+async def test_if_none_match_wins_over_if_modified_since(client, stored):
+    last_modified = (await client.head("/uploads/ranges.bin")).headers["last-modified"]
+    response = await client.get("/uploads/ranges.bin", headers={"if-modified-since": last_modified})
+    assert response.status_code == 304
+    response = await client.get(
+        "/uploads/ranges.bin", headers={"if-modified-since": last_modified, "if-none-match": '"other"'}
+    )
+    assert response.status_code == 200
+
+
+async def test_ranges(client, stored):
+    response = await client.get("/uploads/ranges.bin", headers={"range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert response.content == DATA[10:20]
+    assert response.headers["content-range"] == f"bytes 10-19/{len(DATA)}"
+
+    # suffix range: the last 100 bytes, and more than the file is the whole file
+    response = await client.get("/uploads/ranges.bin", headers={"range": "bytes=-100"})
+    assert response.status_code == 206 and response.content == DATA[-100:]
+    response = await client.get("/uploads/ranges.bin", headers={"range": f"bytes=-{len(DATA) * 2}"})
+    assert response.status_code == 206 and response.content == DATA
+    response = await client.get("/uploads/ranges.bin", headers={"range": f"bytes={len(DATA) - 5}-"})
+    assert response.content == DATA[-5:]
+
+    for header in (f"bytes={len(DATA)}-", "bytes=-0"):
+        response = await client.get("/uploads/ranges.bin", headers={"range": header})
+        assert response.status_code == 416, header
+        assert response.headers["content-range"] == f"bytes */{len(DATA)}"
+
+    # several ranges are not served: the whole file instead
+    response = await client.get("/uploads/ranges.bin", headers={"range": "bytes=0-1,5-6"})
+    assert response.status_code == 200 and response.content == DATA
+
+
+async def test_if_range(client, stored):
+    response = await client.get("/uploads/ranges.bin", headers={"range": "bytes=0-9", "if-range": stored})
+    assert response.status_code == 206 and response.content == DATA[:10]
+    last_modified = response.headers["last-modified"]
+    response = await client.get("/uploads/ranges.bin", headers={"range": "bytes=0-9", "if-range": last_modified})
+    assert response.status_code == 206
+
+    # a stale or weak validator gets the whole, current file
+    for validator in ('"stale"', f"W/{stored}", "Thu, 01 Jan 1970 00:00:00 GMT"):
+        response = await client.get("/uploads/ranges.bin", headers={"range": "bytes=0-9", "if-range": validator})
+        assert response.status_code == 200, validator
+        assert response.content == DATA
+
+
+async def test_head_and_missing(client, stored):
+    response = await client.head("/uploads/ranges.bin", headers={"range": "bytes=0-9"})
+    assert response.status_code == 206
+    assert response.headers["content-length"] == "10"
+    assert response.content == b""
+    assert (await client.get("/uploads/missing.bin")).status_code == 404
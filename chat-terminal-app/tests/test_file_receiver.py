@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import asyncio
+import os
+
+import httpx
+import pytest
+
+from client import file_receiver
+from client.download_cache import DownloadCache
+from client.file_receiver import READ_SIZE, download_file
+
+pytestmark = pytest.mark.anyio
+
+# Three segments of ``READ_SIZE``, the last one short
+DATA = os.urandom(2 * READ_SIZE + 12345)
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = DownloadCache(tmp_path / "cache", 64 * 1024 * 1024)
+    monkeypatch.setattr(file_receiver, "download_cache", cache)
+    monkeypatch.setenv("CHAT_DOWNLOAD_PARALLEL", "4")
+    monkeypatch.setenv("CHAT_DOWNLOAD_SEGMENT_SIZE", str(READ_SIZE))
+    return cache
+
+
+async def _upload(client, name: str) -> None:
+    response = await client.post("/upload", files={"file": (name, DATA)})
+    assert response.status_code == 200, response.text
+
+
+def _gets(transport):
+    return [request for request in transport.requests if request.method == "GET"]
+
+
+async def test_parallel_ranges_are_renamed_into_place(client, app_transport, cache, tmp_path):
+    await _upload(client, "receive-ranges.bin")
+    destination = tmp_path / "downloads"
+    path = await download_file("http://test", "receive-ranges.bin", destination)
+
+    assert path == destination / "receive-ranges.bin"
+    assert path.read_bytes() == DATA
+    assert sorted(request.headers["range"] for request in _gets(app_transport)) == [
+        f"bytes=0-{READ_SIZE - 1}",
+        f"bytes={READ_SIZE}-{2 * READ_SIZE - 1}",
+        f"bytes={2 * READ_SIZE}-{2 * READ_SIZE + 12344}",
+    ]
+    # the segments after the first only apply to the same version of the file
+    assert all("if-range" in request.headers for request in _gets(app_transport)[1:])
+    assert os.listdir(destination) == ["receive-ranges.bin"]
+    umask = os.umask(0)
+    os.umask(umask)
+    assert path.stat().st_mode & 0o777 == 0o666 & ~umask
+
+
+async def test_failed_segment_leaves_nothing(client, app_transport, cache, tmp_path):
+    await _upload(client, "receive-failed.bin")
+
+    async def fail(request):
+        if not request.headers.get("range", "").startswith("bytes=0-"):
+            raise httpx.ReadError("connexion perdue", request=request)
+
+    app_transport.fail = fail
+    destination = tmp_path / "downloads"
+    with pytest.raises(httpx.ReadError):
+        await download_file("http://test", "receive-failed.bin", destination)
+    assert os.listdir(destination) == []
+    assert cache.lookup("http://test/uploads/receive-failed.bin") is None
+
+
+async def test_cancelled_download_leaves_nothing(client, app_transport, cache, tmp_path):
+    await _upload(client, "receive-cancelled.bin")
+    waiting = asyncio.Event()
+
+    async def hang(request):
+        if not request.headers.get("range", "").startswith("bytes=0-"):
+            waiting.set()
+            await asyncio.Event().wait()
+
+    app_transport.fail = hang
+    destination = tmp_path / "downloads"
+    task = asyncio.create_task(download_file("http://test", "receive-cancelled.bin", destination))
+    await asyncio.wait_for(waiting.wait(), 2)
+    assert len(os.listdir(destination)) == 1  # the .part file being written
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert os.listdir(destination) == []
+
+
+async def test_unchanged_file_is_restored_from_the_cache(client, app_transport, cache, tmp_path):
+    await _upload(client, "receive-cached.bin")
+    await download_file("http://test", "receive-cached.bin", tmp_path / "first")
+    app_transport.requests.clear()
+
+    path = await download_file("http://test", "receive-cached.bin", tmp_path / "second")
+    assert path.read_bytes() == DATA
+    [request] = _gets(app_transport)
+    assert request.headers["if-none-match"] == cache.lookup("http://test/uploads/receive-cached.bin")[0]
+    assert os.listdir(tmp_path / "second") == ["receive-cached.bin"]
+
+
+async def test_evicted_cache_entry_falls_back_to_a_full_download(client, app_transport, cache, tmp_path, monkeypatch):
+    await _upload(client, "receive-evicted.bin")
+    await download_file("http://test", "receive-evicted.bin", tmp_path / "first")
+    app_transport.requests.clear()
+    lookup = cache.lookup
+
+    def evicted_after_lookup(url):
+        # another client evicts the copy right after this one found it
+        entry = lookup(url)
+        cache._content_path(entry[0]).unlink()
+        return entry
+
+    monkeypatch.setattr(cache, "lookup", evicted_after_lookup)
+    path = await download_file("http://test", "receive-evicted.bin", tmp_path / "second")
+    assert path.read_bytes() == DATA
+    revalidation, *full = _gets(app_transport)
+    assert "if-none-match" in revalidation.headers
+    assert len(full) == 3 and not any("if-none-match" in request.headers for request in full)
+    assert os.listdir(tmp_path / "second") == ["receive-evicted.bin"]
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import asyncio
+import os
+
+import httpx
+import pytest
+
+from client.file_sender import READ_SIZE, _send, _send_multipart
+
+pytestmark = pytest.mark.anyio
+
+SIZE = 4 * READ_SIZE + 1000
+
+
+class _Progress:
+    """Records what the sender reports instead of drawing a bar."""
+
+    def __init__(self):
+        self.updates = []
+
+    async def update(self, amount=1):
+        self.updates.append(amount)
+
+    async def set_progress(self, current):
+        self.updates.append(("set", current))
+
+
+def _file(tmp_path, name):
+    # fresh content: the server links files it already has instead of receiving them
+    path = tmp_path / name
+    path.write_bytes(os.urandom(SIZE))
+    return path
+
+
+async def test_progress_follows_the_streamed_chunks(client, app_transport, tmp_path):
+    progress = _Progress()
+    path = _file(tmp_path, "send-progress.bin")
+    assert await _send("http://test", path, progress) == "send-progress.bin"
+    assert (await client.get("/uploads/send-progress.bin")).content == path.read_bytes()
+    # nothing was on the server yet, then one update per read
+    assert progress.updates == [("set", 0)] + [READ_SIZE] * 4 + [1000]
+
+
+async def test_failed_chunk_is_sent_again(client, app_transport, tmp_path, monkeypatch):
+    monkeypatch.setattr(asyncio, "sleep", _no_wait(asyncio.sleep))
+    failures = []
+
+    async def fail_once(request):
+        if request.method == "PUT" and not failures:
+            failures.append(request)
+            await request.aread()  # the chunk went out, the answer is lost
+            raise httpx.ReadError("connexion perdue", request=request)
+
+    app_transport.fail = fail_once
+    progress = _Progress()
+    path = _file(tmp_path, "send-retried.bin")
+    assert await _send("http://test", path, progress) == "send-retried.bin"
+    assert (await client.get("/uploads/send-retried.bin")).content == path.read_bytes()
+    assert len([request for request in app_transport.requests if request.method == "PUT"]) == 2
+    # the bytes of the failed attempt were taken back before being sent again
+    assert sum(amount for amount in progress.updates if not isinstance(amount, tuple)) == SIZE
+
+
+async def test_cancelled_upload_is_deleted_on_the_server(client, server_app, app_transport, tmp_path):
+    sending = asyncio.Event()
+
+    async def hang(request):
+        if request.method == "PUT":
+            sending.set()
+            await asyncio.Event().wait()
+
+    app_transport.fail = hang
+    task = asyncio.create_task(_send("http://test", _file(tmp_path, "send-cancelled.bin")))
+    await asyncio.wait_for(sending.wait(), 2)
+    [put] = [request for request in app_transport.requests if request.method == "PUT"]
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    [delete] = [request for request in app_transport.requests if request.method == "DELETE"]
+    assert delete.url.path == put.url.path
+    assert (await client.get(put.url.path)).status_code == 404
+
+
+async def test_single_post_fallback_reports_progress(client, tmp_path):
+    progress = _Progress()
+    path = _file(tmp_path, "send-multipart.bin")
+    assert await _send_multipart(client, "http://test", path, progress) == "send-multipart.bin"
+    assert sum(progress.updates) == SIZE
+
+
+def _no_wait(sleep):
+    """``asyncio.sleep`` without the retry back-off."""
+    async def no_wait(delay, *args, **kwargs):
+        return await sleep(0, *args, **kwargs)
+    return no_wait
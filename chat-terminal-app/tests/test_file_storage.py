@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+import hashlib
+import threading
+
+from server.file_handler import UploadStorage
+
+
+def _refs(storage: UploadStorage) -> dict:
+    with storage._lock:
+        return dict(storage._db.execute("SELECT sha256, refs FROM blobs").fetchall())
+
+
+def test_same_content_is_stored_once(storage, write_temp):
+    first = storage.publish(write_temp(b"same"), "a.txt")
+    second = storage.publish(write_temp(b"same"), "b.txt")
+    assert first.sha256 == second.sha256
+    assert _refs(storage) == {first.sha256: 2}
+    assert storage.blob_path(first).read_bytes() == b"same"
+
+
+def test_refcount_after_rename_and_delete(storage, write_temp):
+    old = storage.publish(write_temp(b"old"), "doc.txt")
+    storage.publish(write_temp(b"old"), "copy.txt")
+    new = storage.publish(write_temp(b"new"), "doc.txt")
+    # doc.txt moved to the new content, copy.txt still holds the old one
+    assert _refs(storage) == {old.sha256: 1, new.sha256: 1}
+    assert storage.delete("copy.txt")
+    assert _refs(storage) == {new.sha256: 1}
+    assert not storage.blob_path(old).exists()
+    assert not storage.delete("copy.txt")
+    assert storage.delete("doc.txt")
+    assert _refs(storage) == {}
+    assert not storage.blob_path(new).exists()
+
+
+def test_concurrent_publish_and_list(storage, write_temp):
+    writers, per_writer = 4, 25
+    errors = []
+    done = threading.Event()
+
+    def publish(worker: int) -> None:
+        try:
+            for index in range(per_writer):
+                # half the files share their content with another writer
+                payload = f"content {index if index % 2 else f'{worker}-{index}'}".encode()
+                storage.publish(write_temp(payload), f"w{worker}-{index}.txt")
+        except Exception as e:  # noqa: BLE001 - reported by the assertion below
+            errors.append(e)
+
+    def list_files() -> None:
+        seen = 0
+        try:
+            while not done.is_set():
+                files, _, _, _ = storage.changes(-1)
+                assert len(files) >= seen
+                seen = len(files)
+                storage.stats()
+        except Exception as e:  # noqa: BLE001
+            errors.append(e)
+
+    threads = [threading.Thread(target=publish, args=(worker,)) for worker in range(writers)]
+    readers = [threading.Thread(target=list_files) for _ in range(2)]
+    for thread in readers + threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    done.set()
+    for thread in readers:
+        thread.join()
+
+    assert errors == []
+    files, _, _, _ = storage.changes(-1)
+    assert len(files) == writers * per_writer
+    for entry in files:
+        assert hashlib.sha256(storage.blob_path(entry).read_bytes()).hexdigest() == entry.sha256
+    refs = _refs(storage)
+    assert sum(refs.values()) == writers * per_writer
+    assert not list((storage.store / "blobs").glob("*/*.tmp"))
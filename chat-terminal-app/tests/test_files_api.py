@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import pytest
+
+from server.catalog import encode_cursor
+
+pytestmark = pytest.mark.anyio
+
+
+async def _upload(client, name: str, data: bytes, token: str = None) -> None:
+    headers = {"authorization": f"Bearer {token}"} if token else {}
+    response = await client.post("/upload", files={"file": (name, data)}, headers=headers)
+    assert response.status_code == 200, response.text
+
+
+def _bearer(token: str) -> dict:
+    return {"authorization": f"Bearer {token}"}
+
+
+async def test_cursor_pagination_across_deletes(client, sign_up):
+    token = await sign_up("pager")
+    names = [f"page-{index:02d}.txt" for index in range(10)]
+    before = (await client.get("/files", params={"limit": 1})).json()["total"]
+    for index, name in enumerate(names):
+        await _upload(client, name, f"page {index}".encode(), token)
+
+    first = (await client.get("/files", params={"prefix": "page-", "limit": 4})).json()
+    assert first["files"] == names[:4]
+    assert first["total"] == before + 10
+    # one name already seen and one not yet reached disappear between pages
+    assert (await client.delete(f"/files/{names[1]}", headers=_bearer(token))).status_code == 200
+    assert (await client.delete(f"/files/{names[5]}", headers=_bearer(token))).status_code == 200
+
+    seen = list(first["files"])
+    cursor = first["next_cursor"]
+    while cursor:
+        page = (await client.get("/files", params={"prefix": "page-", "limit": 4, "cursor": cursor})).json()
+        seen.extend(page["files"])
+        cursor = page["next_cursor"]
+    assert seen == names[:5] + names[6:]
+
+
+async def test_descending_size_order_and_since(client, sign_up):
+    token = await sign_up("sizer")
+    for name, size in (("sized-a.txt", 10), ("sized-b.txt", 30), ("sized-c.txt", 20)):
+        await _upload(client, name, b"s" * size, token)
+    page = (await client.get("/files", params={"prefix": "sized-", "sort": "size", "order": "desc"})).json()
+    assert page["files"] == ["sized-b.txt", "sized-c.txt", "sized-a.txt"]
+
+    since = page["seq"]
+    await _upload(client, "sized-d.txt", b"d")
+    assert (await client.delete("/files/sized-a.txt", headers=_bearer(token))).status_code == 200
+    changes = (await client.get("/files", params={"since": since})).json()
+    assert [entry["name"] for entry in changes["changed"]] == ["sized-d.txt"]
+    assert changes["deleted"] == ["sized-a.txt"]
+    assert not changes["reset"]
+
+
+async def test_bad_cursor_and_sort_are_rejected(client):
+    assert (await client.get("/files", params={"cursor": "not-base64!"})).status_code == 400
+    assert (await client.get("/files", params={"sort": "color"})).status_code == 400
+    for key in (["x", "a"], [True, "a"], [None, "a"], "a"):
+        response = await client.get("/files", params={"sort": "size", "cursor": encode_cursor(key)})
+        assert response.status_code == 400
+        assert response.json()["error"] == "Curseur invalide"
+    response = await client.get("/files", params={"sort": "size", "cursor": encode_cursor([3, "a"])})
+    assert response.status_code == 200
+
+
+async def test_only_the_uploader_or_an_admin_deletes(client, sign_up, server_app):
+    owner = await sign_up("owner")
+    intruder = await sign_up("intruder")
+    await _upload(client, "owned.txt", b"mine", owner)
+    await _upload(client, "anonymous.txt", b"nobody's")
+
+    assert (await client.delete("/files/owned.txt")).status_code == 401
+    assert (await client.delete("/files/owned.txt", headers=_bearer("forged"))).status_code == 401
+    assert (await client.delete("/files/owned.txt", headers=_bearer(intruder))).status_code == 403
+    assert (await client.delete("/files/anonymous.txt", headers=_bearer(owner))).status_code == 403
+    assert (await client.delete("/files/missing.txt", headers=_bearer(owner))).status_code == 404
+    assert (await client.get("/uploads/owned.txt")).status_code == 200
+
+    assert (await client.delete("/files/owned.txt", headers=_bearer(owner))).status_code == 200
+    admin = await server_app.auth.login_async("admin", "admin")
+    assert (await client.delete("/files/anonymous.txt", headers=_bearer(admin))).status_code == 200
+
+
+async def test_stats_reports_storage(client):
+    await _upload(client, "counted.txt", b"count me")
+    stats = (await client.get("/stats")).json()["storage"]
+    assert stats["files"] >= 1 and stats["bytes_stored"] >= len(b"count me")
@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import threading
+import time
+
+import pytest
+
+from server.history import HistoryLog, read_segment
+from shared import protocol
+from shared.protocol import Event
+
+pytestmark = pytest.mark.anyio
+
+
+class _Counting(HistoryLog):
+    disk_reads = 0
+
+    def _query_disk(self, *args):
+        self.disk_reads += 1
+        return super()._query_disk(*args)
+
+
+def _say(history: HistoryLog, seq: int, room: str, name: str = "alice") -> None:
+    history.record(Event(protocol.CHAT, f"message {seq}", name, seq, time.time(), room), persist=True)
+
+
+async def test_quiet_room_is_answered_from_memory(tmp_path):
+    history = _Counting(tmp_path, memory_records=5)
+    await history.open()
+    _say(history, 1, "quiet")
+    for seq in range(2, 5):
+        _say(history, seq, "busy")
+
+    assert [record.seq for record in await history.query(["quiet"], 10)] == [1]
+    assert [record.seq for record in await history.query(["busy"], 10, name="alice")] == [2, 3, 4]
+    assert history.disk_reads == 0
+
+    # once its message has left memory, the room has to be read from disk
+    for seq in range(5, 10):
+        _say(history, seq, "busy")
+    assert [record.seq for record in await history.query(["quiet"], 10)] == [1]
+    assert history.disk_reads == 1
+    assert [record.seq for record in await history.query(["quiet"], 10, after_seq=1)] == []
+    assert history.disk_reads == 1
+    history.close()
+
+
+async def test_reopened_log_reads_what_was_not_loaded(tmp_path):
+    history = HistoryLog(tmp_path, memory_records=5)
+    await history.open()
+    _say(history, 1, "quiet")
+    for seq in range(2, 10):
+        _say(history, seq, "busy")
+    history.close()
+
+    reopened = _Counting(tmp_path, memory_records=5)
+    await reopened.open()
+    assert [record.seq for record in await reopened.query(["quiet"], 10)] == [1]
+    assert reopened.disk_reads == 1
+    assert len(await reopened.query(["busy"], 3)) == 3
+    assert reopened.disk_reads == 1
+
+
+async def test_memory_records_zero_keeps_one(tmp_path):
+    history = HistoryLog(tmp_path, memory_records=0)
+    await history.open()
+    for seq in range(1, 4):
+        _say(history, seq, "room")
+    assert [record.seq for record in await history.query(["room"], 10)] == [1, 2, 3]
+    history.close()
+
+
+async def test_writes_are_batched_on_the_writer_thread(tmp_path, monkeypatch):
+    history = HistoryLog(tmp_path)
+    await history.open()
+    batches = []
+    drain = HistoryLog._drain
+
+    def tracking_drain(self):
+        batches.append((threading.current_thread().name, len(self._pending)))
+        drain(self)
+
+    monkeypatch.setattr(HistoryLog, "_drain", tracking_drain)
+    _say(history, 1, "room")
+    await history.flush()
+    # while the writer is busy, the loop only queues
+    busy = threading.Event()
+    history._executor.submit(busy.wait)
+    for seq in range(2, 102):
+        _say(history, seq, "room")
+    busy.set()
+    await history.flush()
+    assert batches == [("history-writer_0", 1), ("history-writer_0", 100)]
+    assert [record.seq for record in read_segment(history.segment_paths()[0])] == list(range(1, 102))
+    history.close()
+
+
+async def test_new_writer_catches_up_from_memory(tmp_path):
+    first = HistoryLog(tmp_path)
+    second = HistoryLog(tmp_path)
+    await first.open()
+    await second.open()
+    for seq in range(1, 6):
+        event = Event(protocol.CHAT, f"message {seq}", "alice", seq, time.time(), "room")
+        first.record(event, persist=seq <= 3)
+        second.record(event)
+    first.close()
+
+    # the sequencer moved: messages 4 and 5 only exist in memory
+    _say(second, 6, "room")
+    await second.flush()
+    assert [record.seq for record in read_segment(second.segment_paths()[0])] == list(range(1, 7))
+    second.close()
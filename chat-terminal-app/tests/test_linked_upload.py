@@ -0,0 +1,36 @@
+from __future__ import annotations
+
+import hashlib
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_init_links_content_already_stored(client):
+    data = b"already on the server\n" * 100
+    response = await client.post("/upload", files={"file": ("linked-original.txt", data)})
+    assert response.status_code == 200, response.text
+
+    response = await client.post(
+        "/upload/init",
+        json={"filename": "linked-copy.txt", "size": len(data), "sha256": hashlib.sha256(data).hexdigest()},
+    )
+    assert response.status_code == 200
+    state = response.json()
+    assert state == {"filename": "linked-copy.txt", "size": len(data), "linked": True, "complete": True}
+    assert (await client.get("/uploads/linked-copy.txt")).content == data
+    assert "linked-copy.txt" in (await client.get("/files", params={"prefix": "linked-"})).json()["files"]
+
+
+async def test_init_with_other_size_is_not_linked(client):
+    data = b"same hash, other size"
+    await client.post("/upload", files={"file": ("linked-size.txt", data)})
+    response = await client.post(
+        "/upload/init",
+        json={"filename": "linked-size-copy.txt", "size": len(data) + 1, "sha256": hashlib.sha256(data).hexdigest()},
+    )
+    assert response.status_code == 200
+    state = response.json()
+    assert "linked" not in state and state["upload_id"]
+    assert (await client.delete(f"/upload/{state['upload_id']}")).status_code == 200
@@ -0,0 +1,31 @@
+from __future__ import annotations
+
+import pytest
+
+from shared import protocol
+from shared.protocol import Codec, Event
+
+
+def _events():
+    return [Event(protocol.CHAT, f"message {index}", "alice", index + 1, 1.5) for index in range(3)]
+
+
+def test_codec_is_abstract():
+    with pytest.raises(TypeError):
+        Codec()
+
+
+@pytest.mark.parametrize("subprotocol", [protocol.JSON_SUBPROTOCOL, protocol.BIN_SUBPROTOCOL])
+def test_batch_round_trip(subprotocol):
+    codec = protocol.codec_for(subprotocol)
+    frames = codec.encode_batch([codec.encode(event) for event in _events()])
+    assert len(frames) == 1
+    assert [event.text for event in codec.decode(frames[0])] == ["message 0", "message 1", "message 2"]
+
+
+@pytest.mark.parametrize("codec", [protocol.LEGACY_TEXT, protocol.codec_for(protocol.BINARY_SUBPROTOCOL)])
+def test_legacy_batch_is_one_frame_per_event(codec):
+    assert not codec.batching
+    frames = codec.encode_batch([codec.encode(event) for event in _events()])
+    assert len(frames) == 3
+    assert [codec.decode(frame)[0].text for frame in frames] == ["message 0", "message 1", "message 2"]
@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import asyncio
+import time
+
+import pytest
+
+from server.rate_limit import (
+    DEFAULT_CONNECTION_LIMITS,
+    RateLimiter,
+    RateLimitMode,
+    TokenBucket,
+    Traffic,
+    parse_limits,
+)
+
+pytestmark = pytest.mark.anyio
+
+
+def test_token_bucket_refills_up_to_burst():
+    bucket = TokenBucket(rate=2.0, burst=3.0)
+    start = bucket.updated
+    for _ in range(3):
+        assert bucket.wait_time(start) == 0.0
+        bucket.take()
+    assert bucket.wait_time(start) == pytest.approx(0.5)
+    assert bucket.wait_time(start + 0.5) == 0.0
+    assert bucket.wait_time(start + 100) == 0.0 and bucket.tokens == 3.0
+    assert TokenBucket(rate=0.0, burst=0.0).wait_time(start) == float("inf")
+
+
+def test_parse_limits():
+    limits = parse_limits(" chat=1/4, pm=0, command=3, bogus=1, chat=x ", DEFAULT_CONNECTION_LIMITS)
+    assert limits == {Traffic.CHAT: (1.0, 4.0), Traffic.COMMAND: (3.0, 3.0)}
+    assert parse_limits("", DEFAULT_CONNECTION_LIMITS) == DEFAULT_CONNECTION_LIMITS
+    assert Traffic.of("  /MSG bob hi") is Traffic.PM
+    assert Traffic.of("/msgs") is Traffic.COMMAND
+    assert Traffic.of("hello") is Traffic.CHAT
+
+
+async def test_reject_mode_strikes_and_flood():
+    limiter = RateLimiter({Traffic.CHAT: (0.001, 2.0)}, {}, mode=RateLimitMode.REJECT, flood_strikes=3)
+    assert await limiter.admit("conn", "ann", Traffic.CHAT)
+    assert await limiter.admit("conn", "ann", Traffic.CHAT)
+    for strikes in (1, 2, 3):
+        assert not await limiter.admit("conn", "ann", Traffic.CHAT)
+        assert limiter.strikes("conn") == strikes
+    assert limiter.is_flooding("conn")
+    assert limiter.stats()["flood"] == {"disconnects": 1}
+    assert limiter.stats()["chat"] == {"allowed": 2, "delayed": 0, "rejected": 3}
+    # other kinds are not limited, and an admitted input clears the strikes
+    assert await limiter.admit("conn", "ann", Traffic.COMMAND)
+    assert limiter.strikes("conn") == 0
+    limiter.forget("conn")
+    assert await limiter.admit("conn", "ann", Traffic.CHAT)
+
+
+async def test_delay_mode_waits_then_rejects_long_waits():
+    limiter = RateLimiter({Traffic.CHAT: (20.0, 1.0)}, {}, max_delay=0.2)
+    assert await limiter.admit("conn", None, Traffic.CHAT)
+    started = time.monotonic()
+    assert await limiter.admit("conn", None, Traffic.CHAT)
+    assert time.monotonic() - started >= 0.04
+    slow = RateLimiter({Traffic.CHAT: (1.0, 1.0)}, {}, max_delay=0.2)
+    assert await slow.admit("conn", None, Traffic.CHAT)
+    assert not await slow.admit("conn", None, Traffic.CHAT)
+    assert slow.stats()["chat"]["rejected"] == 1
+
+
+async def test_connections_of_one_user_share_its_bucket():
+    limiter = RateLimiter({Traffic.CHAT: (100.0, 100.0)}, {Traffic.CHAT: (20.0, 1.0)}, max_delay=2.0)
+    started = time.monotonic()
+    admitted = await asyncio.gather(*(limiter.admit(f"conn-{index}", "ann", Traffic.CHAT) for index in range(5)))
+    assert all(admitted)
+    # one token at once, then one every 50 ms: waking together must not overdraw
+    assert time.monotonic() - started >= 4 / 20.0 - 0.01
+    assert limiter._users["ann"][Traffic.CHAT].tokens >= -1e-9
@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+import pytest
+
+from shared import protocol
+
+pytestmark = pytest.mark.anyio
+
+
+async def _signed_in(connect, sign_up, name):
+    websocket = await connect(token=await sign_up(name))
+    await websocket.expect(protocol.SESSION)
+    return websocket
+
+
+def _chats(websocket):
+    return [event.text for event in websocket.events if event.type == protocol.CHAT]
+
+
+async def test_room_messages_only_reach_members(server_app, connect, sign_up):
+    ann = await _signed_in(connect, sign_up, "room-ann")
+    bob = await _signed_in(connect, sign_up, "room-bob")
+    cid = await _signed_in(connect, sign_up, "room-cid")
+    await ann.command("/join #dev", protocol.INFO, "Salon actuel: #dev")
+    await bob.command("/join dev", protocol.INFO, "Salon actuel: #dev")
+    await ann.expect(protocol.INFO, "room-bob a rejoint #dev")
+    assert server_app.manager.rooms["dev"] == {ann, bob}
+
+    await ann.command("hello dev", protocol.ECHO, "hello dev")
+    message = await bob.expect(protocol.CHAT, "hello dev")
+    assert message.name == "room-ann" and message.room == "dev"
+    # everyone stays in general: a message there reaches all three
+    await cid.command("hello general", protocol.ECHO)
+    await ann.expect(protocol.CHAT, "hello general")
+    await bob.expect(protocol.CHAT, "hello general")
+    assert "hello dev" not in _chats(cid)
+
+    rooms = await ann.command("/rooms", protocol.INFO, "Salons:")
+    assert "* #dev (2): room-ann, room-bob" in rooms.text
+    assert "+ #general" in rooms.text
+
+    left = await ann.command("/leave", protocol.INFO, "Vous avez quitté #dev")
+    assert "Salon actuel: #general" in left.text
+    await bob.expect(protocol.INFO, "room-ann a quitté #dev")
+    assert server_app.manager.rooms["dev"] == {bob}
+    await bob.command("still here", protocol.ECHO)
+    await cid.command("sync", protocol.ECHO)
+    await ann.expect(protocol.CHAT, "sync")
+    assert "still here" not in _chats(ann)
+
+
+async def test_room_commands_check_their_input(connect, sign_up):
+    anonymous = await connect()
+    await anonymous.command("/join dev", protocol.ERROR, "Vous devez être connecté")
+    dan = await _signed_in(connect, sign_up, "room-dan")
+    await dan.command("/join bad!name", protocol.ERROR, "Usage: /join")
+    await dan.command("/leave nowhere", protocol.ERROR, "pas dans le salon #nowhere")
+    await dan.command("/leave general", protocol.INFO, "Utilisez /join <salon> pour écrire")
+    await dan.command("lost", protocol.ERROR, "dans aucun salon")
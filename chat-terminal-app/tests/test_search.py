@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import logging
+import time
+
+import pytest
+
+from server.history import HistoryLog
+from server.search import SearchIndex, _Index
+from shared import protocol
+from shared.protocol import Event
+
+pytestmark = pytest.mark.anyio
+
+
+async def _open(tmp_path, **options):
+    history = HistoryLog(tmp_path, memory_records=1, **options)
+    await history.open()
+    index = SearchIndex(history)
+    index.start()
+    await index.search("warmup", ["general"])
+    return history, index
+
+
+def _say(history: HistoryLog, index: SearchIndex, seq: int, text: str) -> None:
+    record = history.record(Event(protocol.CHAT, text, "alice", seq, time.time(), "general"), persist=True)
+    index.add(record)
+
+
+async def test_retention_prunes_postings(tmp_path):
+    history, index = await _open(tmp_path, segment_bytes=200, max_bytes=600)
+    for seq in range(1, 41):
+        _say(history, index, seq, f"needle number {seq}")
+    await history.flush()
+    await index.stop()
+
+    first = history.first_seq()
+    assert first > 1
+    assert index._index.seqs[0] == first
+    assert min(index._index.postings["needle"]) == index._index.base
+    found = await index.search("needle", ["general"], limit=100)
+    assert [record.seq for record in found] == list(range(first, 41))
+    history.close()
+
+
+async def test_other_worker_prunes_on_search(tmp_path):
+    history, index = await _open(tmp_path, segment_bytes=200, max_bytes=600)
+    reader = SearchIndex(HistoryLog(tmp_path, memory_records=1))
+    for seq in range(1, 41):
+        _say(history, index, seq, f"needle number {seq}")
+        # relayed to the other worker, which does not write the log
+        reader.add(reader.history.record(Event(protocol.CHAT, f"needle number {seq}", "alice", seq, 0.0, "general")))
+    assert reader._index.seqs[0] == 1
+
+    await history.flush()
+    found = await reader.search("needle", ["general"], limit=100)
+    assert found and found[0].seq == history.first_seq()
+    assert reader._index.seqs[0] == history.first_seq()
+    history.close()
+
+
+def test_prune_keeps_document_numbers():
+    index = _Index()
+    for seq in range(1, 11):
+        index.add(seq, float(seq), "alice", "general", {"even" if seq % 2 == 0 else "odd", "all"})
+    assert index.prune(6) == 5
+    assert index.search(["even"], ["general"], "", 0.0, 0.0, 10) == [10, 8, 6]
+    assert index.search(["all", "odd"], ["general"], "alice", 0.0, 0.0, 10) == [9, 7]
+    index.add(11, 11.0, "alice", "general", {"odd"})
+    assert index.search(["odd"], ["general"], "", 8.5, 0.0, 10) == [11, 9]
+    assert index.prune(100) == 6 and index.postings == {}
+
+
+async def test_failed_seal_is_logged_and_awaited(tmp_path, monkeypatch, caplog):
+    history, index = await _open(tmp_path, segment_bytes=50)
+
+    def fail(path):
+        raise OSError("disk full")
+
+    monkeypatch.setattr("server.search._write_segment_index", fail)
+    with caplog.at_level(logging.ERROR, logger="server.search"):
+        for seq in range(1, 4):
+            _say(history, index, seq, "long enough to fill a segment")
+        await history.flush()
+        await index.stop()
+    assert not index._sealing
+    assert "sealed history segment" in caplog.text
+    history.close()
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import pytest
+
+from client.token_store import TokenStore, VerifiedTokenCache
+from shared import protocol
+
+pytestmark = pytest.mark.anyio
+
+
+def test_verified_tokens_are_rechecked_and_expire():
+    cache = VerifiedTokenCache(capacity=2, recheck=5.0)
+    cache.put("t1", "ann", expires_at=100.0, now=0.0)
+    assert cache.get("t1", now=1.0) == "ann"
+    # checked too long ago: verify again, but keep the entry
+    assert cache.get("t1", now=6.0) is None
+    assert cache.stats()["size"] == 1
+    cache.put("t1", "ann", expires_at=100.0, now=99.0)
+    assert cache.get("t1", now=100.0) is None
+    assert cache.stats()["size"] == 0
+
+    for token in ("a", "b", "c"):
+        cache.put(token, "bob", expires_at=100.0, now=0.0)
+    assert cache.get("a", now=1.0) is None
+    assert cache.get("c", now=1.0) == "bob"
+
+
+async def test_resume_with_handshake_token_and_command(connect, sign_up):
+    token = await sign_up("resumer")
+    websocket = await connect(token=token)
+    session = await websocket.expect(protocol.SESSION)
+    assert session.name == "resumer" and session.text == token
+
+    other = await connect()
+    await other.command(f"/resume {token}", protocol.SESSION)
+    await other.command("/resume not-a-token", protocol.ERROR, "Session expirée")
+
+
+async def test_logout_signs_out_resumed_connections(connect, sign_up):
+    token = await sign_up("leaver")
+    first = await connect(token=token)
+    second = await connect(token=token)
+    await first.expect(protocol.SESSION)
+    await second.expect(protocol.SESSION)
+
+    await first.command("/logout", protocol.INFO, "Déconnecté")
+    await second.expect(protocol.ERROR, "Session révoquée")
+    await second.command("/users", protocol.ERROR, "Vous devez être connecté")
+    await second.command(f"/resume {token}", protocol.ERROR, "Session expirée")
+
+
+async def test_revocation_from_another_worker_clears_the_cache(server_app, connect, sign_up):
+    auth = server_app.auth
+    token = await sign_up("revoked")
+    websocket = await connect(token=token)
+    await websocket.expect(protocol.SESSION)
+    assert (await auth.verify_token_async(token)).username == "revoked"
+
+    # another worker logs the token out: the database forgets it at once...
+    other_worker = TokenStore(auth.tokens_db)
+    assert other_worker.revoke(token)
+    other_worker.stop()
+    # ...but this worker's cache would still accept it until the recheck
+    assert await auth.verify_token_async(token) is not None
+
+    # the bus message from that worker
+    await server_app._deliver({"op": "revoke", "token": token})
+    await websocket.expect(protocol.ERROR, "Session révoquée")
+    assert server_app.sessions.with_token(token) == []
+    assert await auth.verify_token_async(token) is None
+    resumed = await connect(token=token)
+    await resumed.expect(protocol.ERROR, "Session expirée")
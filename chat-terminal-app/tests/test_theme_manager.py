@@ -0,0 +1,25 @@
+from __future__ import annotations
+
+import json
+
+from client.theme_manager import ThemeManager
+
+
+def _config(tmp_path, theme: str):
+    (tmp_path / "theme_config.json").write_text(json.dumps({"current_theme": theme, "custom_themes": {}}))
+
+
+def test_config_is_loaded_lazily(tmp_path):
+    _config(tmp_path, "neon")
+    manager = ThemeManager(str(tmp_path))
+    assert manager._themes is None
+    assert manager.current_theme == "neon"
+    assert "neon" in manager._themes
+
+
+def test_theme_set_before_loading_wins(tmp_path):
+    _config(tmp_path, "neon")
+    manager = ThemeManager(str(tmp_path))
+    manager.current_theme = "dark"
+    assert manager.current_theme == "dark"
+    assert manager.get_current_theme() is manager.themes["dark"]
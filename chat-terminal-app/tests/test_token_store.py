@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import time
+
+from client.token_store import TokenStore
+
+
+def test_per_user_cap_evicts_the_oldest(tmp_path):
+    store = TokenStore(tmp_path / "tokens.db", per_user=2)
+    later = time.time() + 3600
+    evicted = []
+    for token, username in (("a1", "ann"), ("b1", "bob"), ("a2", "ann"), ("a3", "ann")):
+        evicted += store.issue(token, username, later)
+        time.sleep(0.01)  # created_at orders the tokens
+    assert evicted == ["a1"]
+    assert store.get("a1") is None
+    assert [store.get(token).username for token in ("a2", "a3", "b1")] == ["ann", "ann", "bob"]
+    assert store.revoke_user("ann") == 2
+    assert len(store) == 1
+    store.stop()
+
+
+def test_expired_tokens_are_hidden_then_swept_in_batches(tmp_path):
+    store = TokenStore(tmp_path / "tokens.db", per_user=100)
+    now = time.time()
+    for index in range(25):
+        store.issue(f"old{index}", "ann", now - 1 - index)
+    store.issue("soon", "ann", now + 60)
+    store.issue("late", "ann", now + 3600)
+    assert store.get("old0") is None
+    assert len(store) == 27
+
+    assert store.sweep(batch=10) == 25
+    assert len(store) == 2
+    # expiry order: a sweep in the future removes only what expired by then
+    assert store.sweep(now=now + 120) == 1
+    assert store.get("soon") is None and store.get("late").username == "ann"
+    store.stop()
+
+
+def test_sweeper_thread_purges_in_the_background(tmp_path):
+    store = TokenStore(tmp_path / "tokens.db", sweep_interval=0.02)
+    store.issue("brief", "ann", time.time() + 0.05)
+    store.issue("kept", "ann", time.time() + 3600)
+    store.start()
+    try:
+        deadline = time.monotonic() + 2
+        while len(store) > 1 and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert len(store) == 1 and store.get("kept") is not None
+    finally:
+        store.stop()
+    assert store._sweeper is None
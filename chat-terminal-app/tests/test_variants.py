@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import hashlib
+import os
+
+import pytest
+
+from server.variants import CompressedVariants
+
+pytestmark = pytest.mark.anyio
+
+
+def _text(name: str, lines: int = 400) -> bytes:
+    return "".join(f"{index:05d} {name}: the quick brown fox\n" for index in range(lines)).encode()
+
+
+def _publish(storage, write_temp, name: str, data: bytes):
+    return storage.publish(write_temp(data), name, hashlib.sha256(data).hexdigest())
+
+
+async def test_text_download_is_compressed_once(client, server_app):
+    data = _text("served")
+    assert (await client.post("/upload", files={"file": ("served.log", data)})).status_code == 200
+    sha = hashlib.sha256(data).hexdigest()
+    before = server_app.variants.stats()
+
+    response = await client.get("/uploads/served.log", headers={"accept-encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["etag"] == f'"{sha}-gzip"'
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert int(response.headers["content-length"]) < len(data) // 2
+    assert response.content == data
+
+    again = await client.get("/uploads/served.log", headers={"accept-encoding": "gzip"})
+    assert again.content == data
+    stats = server_app.variants.stats()
+    assert stats["compressed"] == before["compressed"] + 1
+    assert stats["hits"] == before["hits"] + 2
+
+    plain = await client.get("/uploads/served.log", headers={"accept-encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+    assert plain.headers["etag"] == f'"{sha}"' and plain.headers["vary"] == "Accept-Encoding"
+    ranged = await client.get("/uploads/served.log", headers={"accept-encoding": "gzip", "range": "bytes=0-9"})
+    assert ranged.status_code == 206 and "content-encoding" not in ranged.headers
+    assert ranged.content == data[:10]
+
+
+async def test_least_recently_served_variant_is_evicted(storage, write_temp):
+    variants = CompressedVariants(storage)
+    variants.open()
+    first, second, third = (_publish(storage, write_temp, f"{name}.txt", _text(name)) for name in ("aaa", "bbb", "ccc"))
+    fp, size, _ = await variants.open_variant(first, "gzip")
+    fp.close()
+    variants.max_bytes = size * 5 // 2  # room for two
+
+    (await variants.open_variant(second, "gzip"))[0].close()
+    (await variants.open_variant(first, "gzip"))[0].close()  # served again: newest
+    (await variants.open_variant(third, "gzip"))[0].close()
+    kept = sorted(os.listdir(variants.directory))
+    assert kept == sorted(f"{entry.sha256}.gzip" for entry in (first, third))
+    assert variants.stats()["variants"] == 2 and variants.stats()["bytes"] <= variants.max_bytes
+    variants.close()
+
+
+async def test_incompressible_contents_are_remembered_up_to_a_cap(storage, write_temp):
+    variants = CompressedVariants(storage, max_incompressible=2)
+    variants.open()
+    entries = [_publish(storage, write_temp, f"noise{index}.txt", os.urandom(4096)) for index in range(3)]
+    for entry in entries:
+        assert await variants.open_variant(entry, "gzip") is None
+    assert variants.stats()["incompressible"] == 2
+    assert list(variants._incompressible) == [f"{entry.sha256}.gzip" for entry in entries[1:]]
+    assert os.listdir(variants.directory) == []
+    variants.close()